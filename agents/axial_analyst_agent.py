@@ -1,16 +1,30 @@
 # agents/axial_analyst_agent.py
 
 import logging
-from typing import List, Dict, Any, Iterator
-from pydantic import ValidationError
-import json
+import sys
+from array import array
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Dict, Any, Iterator, Optional, Tuple, Union
+from pydantic import TypeAdapter, ValidationError
+import orjson
 from dotenv import load_dotenv
 
 # Asumimos que los servicios y utilidades ya existen y son importables.
 # Nota: Necesitaremos añadir una función 'load_jsonl_file' y 'save_jsonl_file' a nuestras utilidades.
 from services.llm_service import LLMService 
-from utils.file_utils import load_json_file, load_jsonl_file, append_to_jsonl_file, extract_json_from_text
-from models.data_models import Category, Insight, AxialAnalysisOutput, CodeAssignment
+from services.llm_response_cache import LLMResponseCache
+from utils.file_utils import load_json_file, load_jsonl_file, write_jsonl_record, extract_json_from_text, load_prompt_template, JSONL_WRITE_BUFFER_SIZE
+from utils.prompt_template import compile_prompt_template
+from models.data_models import Category, CodeAssignment, Insight, AxialAnalysisOutput
+
+# Índice de evidencia en formato "estructura de arrays":
+# - un pool de fragmentos únicos (id_fragmento, fragmento_original) direccionado por un entero denso,
+# - y, por código, un array compacto de enteros sin signo con los índices de sus fragmentos.
+EvidenceIndex = Tuple[List[Tuple[str, str]], Dict[str, array]]
+
+# Valida la lista completa de categorías en una sola llamada al núcleo de Pydantic
+_CATEGORY_LIST_ADAPTER = TypeAdapter(List[Category])
 
 class AxialAnalystAgent:
     """
@@ -24,7 +38,13 @@ class AxialAnalystAgent:
                  categories_path: str = 'data/categorias.json',
                  insights_path: str = 'data/analysis_results.jsonl',
                  prompt_template_path: str = 'prompts/perform_axial_analysis.md',
-                 output_path: str = 'data/analisis_axial.jsonl'):
+                 output_path: str = 'data/analisis_axial.jsonl',
+                 max_concurrency: int = 16,
+                 strict_validation: bool = False,
+                 batch_prompt_template_path: str = 'prompts/perform_axial_analysis_batch.md',
+                 batch_char_limit: int = 60_000,
+                 max_categories_per_batch: int = 8,
+                 cache_enabled: bool = True):
         """
         Inicializa el agente con sus dependencias y rutas de archivos.
 
@@ -34,6 +54,15 @@ class AxialAnalystAgent:
             insights_path: Ruta al archivo que mapea insights con códigos (la evidencia).
             prompt_template_path: Ruta a la plantilla de prompt para el análisis axial.
             output_path: Ruta donde se guardará el análisis axial (formato JSONL).
+            max_concurrency: Número máximo de llamadas al LLM en paralelo (una por categoría).
+            strict_validation: Si es True, valida cada insight con Pydantic al construir el índice
+                               (útil para depurar); por defecto solo se leen los campos necesarios.
+            batch_prompt_template_path: Ruta a la plantilla que analiza varias categorías en una sola llamada.
+            batch_char_limit: Tamaño máximo (en bytes del JSON de evidencia) que puede sumar un lote
+                              de categorías pequeñas. Las categorías que lo superan van solas.
+            max_categories_per_batch: Número máximo de categorías por llamada agrupada (1 desactiva el agrupado).
+            cache_enabled: Si es True, las respuestas válidas del LLM se guardan en una caché en disco
+                           (`<output_path>.llmcache`) y los prompts idénticos no se vuelven a enviar.
         """
         self.logger = logging.getLogger(__name__)
         self.llm_service = llm_service
@@ -41,101 +70,208 @@ class AxialAnalystAgent:
         self.insights_path = insights_path
         self.prompt_template_path = prompt_template_path
         self.output_path = output_path
-        self._prompt_template = None # Para cachear la plantilla de prompt
+        self.max_concurrency = max(1, max_concurrency)
+        self.strict_validation = strict_validation
+        self.batch_prompt_template_path = batch_prompt_template_path
+        self.batch_char_limit = batch_char_limit
+        self.max_categories_per_batch = max(1, max_categories_per_batch)
+        self._cache = LLMResponseCache(self.output_path + '.llmcache') if cache_enabled else None
         self.logger.info("AxialAnalystAgent inicializado correctamente.")
 
     def _get_evidence_for_category(self, 
                                    category: Category, 
-                                   evidence_map: Dict[str, List[Dict[str, Any]]]) -> List[Dict[str, str]]:
+                                   evidence_index: EvidenceIndex) -> List[Dict[str, str]]:
         """
         Recupera los fragmentos de texto originales (evidencia) para una categoría dada,
         utilizando un índice invertido pre-calculado para máxima eficiencia.
 
         Args:
             category: El objeto de la categoría (validado con Pydantic) que se está analizando.
-            evidence_map: El índice invertido (code_id -> lista de fragmentos de evidencia).
+            evidence_index: El índice invertido (pool de fragmentos, code_id -> índices de fragmentos).
 
         Returns:
             Una lista de diccionarios de evidencia únicos para esa categoría.
         """
-        # Usamos un diccionario para las evidencias para que no se repitan
-        # si un mismo fragmento está asociado a múltiples códigos de la categoría.
-        unique_evidence_fragments: Dict[str, Dict[str, str]] = {} 
-        
-        category_code_ids = {assignment.code_id for assignment in category.code_assignments}
+        fragments, code_to_fragment_idx = evidence_index
 
+        # Intersección en C entre los códigos de la categoría (frozenset cacheado en el
+        # modelo) y los códigos con evidencia: saltamos directamente los que no tienen.
+        category_code_ids = category.code_id_set & code_to_fragment_idx.keys()
+
+        # La unión de índices enteros elimina los fragmentos repetidos entre códigos
+        # de la categoría; los diccionarios solo se materializan para la lista final.
+        fragment_indices = set()
         for code_id in category_code_ids:
-            # Búsqueda instantánea en el índice
-            evidences = evidence_map.get(code_id, [])
-            for evidence in evidences:
-                # La clave es el ID del fragmento para garantizar la unicidad.
-                # El valor es el propio objeto de evidencia.
-                unique_evidence_fragments[evidence['id_fragmento']] = evidence
-            
-        self.logger.debug(f"Recuperados {len(unique_evidence_fragments)} fragmentos de evidencia para '{category.category_name}'.")
-        
-        # Devolvemos la lista de diccionarios de evidencia
-        return list(unique_evidence_fragments.values())
+            fragment_indices.update(code_to_fragment_idx[code_id])
+
+        evidence_list = [
+            {"id_fragmento": fragments[idx][0], "fragmento_original": fragments[idx][1]}
+            for idx in sorted(fragment_indices)
+        ]
+        self.logger.debug(f"Recuperados {len(evidence_list)} fragmentos de evidencia para '{category.category_name}'.")
+        return evidence_list
+
+    def _get_cached_response(self, prompt: Union[str, bytes]) -> Optional[str]:
+        """Busca en la caché en disco una respuesta previa para este prompt, modelo y temperatura."""
+        if self._cache is None:
+            return None
+        return self._cache.get(prompt, self.llm_service.model, self.llm_service.temperature)
+
+    def _cache_response(self, prompt: Union[str, bytes], response: str) -> None:
+        """Guarda una respuesta ya validada, para no cachear salidas que habría que repetir."""
+        if self._cache is not None:
+            self._cache.put(prompt, self.llm_service.model, self.llm_service.temperature, response)
 
-    def _prepare_axial_prompt(self, category: Category, evidence_list: List[Dict[str, str]]) -> str:
+    def _prepare_axial_prompt(self, category: Category, evidence_list: List[Dict[str, str]]) -> bytes:
         """
         Prepara el prompt para el análisis axial de una categoría, inyectando
         la definición de la categoría y la evidencia textual en formato JSON.
+        El prompt se construye directamente en UTF-8: el JSON de orjson ya son bytes.
         """
         self.logger.debug(f"Preparando prompt para la categoría '{category.category_name}'...")
         
-        # Cachea la plantilla para evitar leer el archivo repetidamente
-        if self._prompt_template is None:
-            try:
-                with open(self.prompt_template_path, 'r', encoding='utf-8') as f:
-                    self._prompt_template = f.read()
-            except FileNotFoundError:
-                self.logger.error(f"No se pudo encontrar el archivo de plantilla de prompt: {self.prompt_template_path}")
-                raise
+        # La plantilla se carga y se compila en segmentos una sola vez por proceso
+        prompt_template = compile_prompt_template(load_prompt_template(self.prompt_template_path))
         
-        # Serializa la lista de evidencia a un string en formato JSON.
-        evidence_json_string = json.dumps(evidence_list, indent=2, ensure_ascii=False)
+        # Serializa la lista de evidencia a JSON.
+        # orjson serializa en C y emite UTF-8 directamente (equivalente a ensure_ascii=False).
+        evidence_json_bytes = orjson.dumps(evidence_list, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
         
-        # Rellena la plantilla
-        prompt = self._prompt_template.format(
+        # Rellena la plantilla sin pasar el JSON por `str`
+        prompt = prompt_template.render_bytes(
             category_name=category.category_name,
             category_description=category.description or "No hay descripción disponible.",
-            evidence_json=evidence_json_string
+            evidence_json=evidence_json_bytes
         )
         
         return prompt
 
-    def _build_evidence_index(self, insights_iterator: Iterator[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
+    def _prepare_axial_batch_prompt(self,
+                                    categories: List[Category],
+                                    evidence_lists: List[List[Dict[str, str]]]) -> bytes:
+        """
+        Prepara un único prompt para varias categorías, cada una con su definición
+        y su propia evidencia en una sección etiquetada por `category_id`.
+        """
+        self.logger.debug(f"Preparando prompt agrupado para {len(categories)} categorías...")
+        prompt_template = compile_prompt_template(load_prompt_template(self.batch_prompt_template_path))
+
+        categories_payload = [
+            {
+                "category_id": category.category_id,
+                "category_name": category.category_name,
+                "category_description": category.description or "No hay descripción disponible.",
+                "evidence": evidence_list,
+            }
+            for category, evidence_list in zip(categories, evidence_lists)
+        ]
+        categories_json_bytes = orjson.dumps(categories_payload, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+        return prompt_template.render_bytes(categories_json=categories_json_bytes)
+
+    def _pack_category_batches(self,
+                               categories: List[Category],
+                               category_evidence: Dict[str, List[Dict[str, str]]]) -> List[List[Category]]:
+        """
+        Agrupa las categorías en lotes para amortizar la latencia fija de cada llamada al LLM.
+
+        El tamaño de cada categoría se estima con la longitud de su evidencia serializada.
+        Las categorías pequeñas se empaquetan de mayor a menor en el primer lote donde
+        caben (first-fit decreasing) sin superar `batch_char_limit` ni
+        `max_categories_per_batch`; las que superan el límite forman un lote
+        de una sola categoría y siguen el camino individual.
+        """
+        if self.max_categories_per_batch == 1:
+            return [[category] for category in categories]
+
+        singles: List[List[Category]] = []
+        sized: List[Tuple[int, Category]] = []
+        for category in categories:
+            size = len(orjson.dumps(category_evidence[category.category_id]))
+            if size >= self.batch_char_limit:
+                singles.append([category])
+            else:
+                sized.append((size, category))
+
+        sized.sort(key=lambda item: item[0], reverse=True)
+        batches: List[List[Category]] = []
+        batch_sizes: List[int] = []
+        for size, category in sized:
+            for j, batch in enumerate(batches):
+                if len(batch) < self.max_categories_per_batch and batch_sizes[j] + size <= self.batch_char_limit:
+                    batch.append(category)
+                    batch_sizes[j] += size
+                    break
+            else:
+                batches.append([category])
+                batch_sizes.append(size)
+
+        return batches + singles
+
+    def _build_evidence_index(self, insights_iterator: Iterator[Dict[str, Any]]) -> EvidenceIndex:
         """
         Construye un índice invertido desde códigos a fragmentos de evidencia.
+        Cada fragmento se guarda una única vez en un pool; los códigos solo guardan
+        los índices enteros de sus fragmentos en un `array('I')`.
         """
         self.logger.info("Construyendo índice invertido de evidencia para una recuperación eficiente...")
-        code_to_evidence_map = {}
+        fragments: List[Tuple[str, str]] = []
+        fragment_id_to_idx: Dict[str, int] = {}
+        code_to_fragment_idx: Dict[str, array] = defaultdict(lambda: array('I'))
         for i, insight_data in enumerate(insights_iterator):
-            try:
-                insight = Insight.model_validate(insight_data)
-            except ValidationError as e:
-                self.logger.warning(f"Error de validación en insight #{i+1}, se saltará. Error: {e}")
+            if self.strict_validation:
+                try:
+                    insight = Insight.model_validate(insight_data)
+                except ValidationError as e:
+                    self.logger.warning(f"Error de validación en insight #{i+1}, se saltará. Error: {e}")
+                    continue
+                code_ids = insight.unified_code_ids
+                id_fragmento = insight.id_fragmento
+                fragmento_original = insight.fragmento_original
+            else:
+                # Camino rápido: solo leemos los tres campos que usa el índice,
+                # sin construir el modelo Pydantic completo para cada fila.
+                try:
+                    code_ids = insight_data.get("unified_code_ids") or []
+                    id_fragmento = insight_data["id_fragmento"]
+                    fragmento_original = insight_data["fragmento_original"]
+                except (KeyError, AttributeError):
+                    self.logger.warning(f"Insight #{i+1} sin 'id_fragmento' o 'fragmento_original', se saltará.")
+                    continue
+                # Sin Pydantic, los tipos se comprueban aquí: un ID no textual (p. ej. numérico en
+                # un JSONL editado a mano) se salta igual que lo haría la validación
+                if not (isinstance(id_fragmento, str) and isinstance(fragmento_original, str)
+                        and isinstance(code_ids, list) and all(isinstance(code_id, str) for code_id in code_ids)):
+                    self.logger.warning(f"Insight #{i+1} con 'id_fragmento', 'fragmento_original' o 'unified_code_ids' de tipo inválido, se saltará.")
+                    continue
+            if not code_ids:
                 continue
-            
-            for code_id in insight.unified_code_ids:
-                if code_id not in code_to_evidence_map:
-                    code_to_evidence_map[code_id] = []
-                
-                # Usamos los nombres de campo correctos del modelo Insight
-                code_to_evidence_map[code_id].append({
-                    "id_fragmento": insight.id_fragmento,
-                    "fragmento_original": insight.fragmento_original
-                })
-        self.logger.info(f"Índice construido. {len(code_to_evidence_map)} códigos únicos mapeados a evidencia.")
-        return code_to_evidence_map
-
-    def _analyze_category(self, category: Category, code_to_evidence_map: Dict[str, List[Dict[str, Any]]]):
+
+            # Internamos los IDs: miles de fragmentos comparten unos pocos códigos, así que
+            # las claves repetidas pasan a ser el mismo objeto y el hashing compara punteros.
+            id_fragmento = sys.intern(id_fragmento)
+            fragment_idx = fragment_id_to_idx.setdefault(id_fragmento, len(fragments))
+            if fragment_idx == len(fragments):
+                fragments.append((id_fragmento, fragmento_original))
+            for code_id in code_ids:
+                code_to_fragment_idx[sys.intern(code_id)].append(fragment_idx)
+
+        self.logger.info(f"Índice construido. {len(code_to_fragment_idx)} códigos únicos mapeados a {len(fragments)} fragmentos de evidencia.")
+        # Devolvemos un dict normal para que las búsquedas de códigos ausentes no creen entradas vacías.
+        return fragments, dict(code_to_fragment_idx)
+
+    def _analyze_category(self, category: Category, evidence_list: List[Dict[str, str]]) -> Optional[Dict[str, Any]]:
         """
         Realiza el análisis axial completo para una única categoría.
+
+        Args:
+            category: La categoría a analizar.
+            evidence_list: La evidencia ya resuelta para la categoría (ver `run`).
+
+        Returns:
+            El registro a guardar en el JSONL de salida, o None si la categoría se saltó.
+            La escritura la hace `run`, que es el único consumidor del archivo.
         """
-        # a. Recuperar evidencia
-        evidence_list = self._get_evidence_for_category(category, code_to_evidence_map)
+        # a. Comprobar la evidencia (resuelta de antemano en `run`)
         if not evidence_list:
             self.logger.warning(f"No se encontró evidencia para la categoría '{category.category_name}'. Saltando.")
             return
@@ -143,10 +279,15 @@ class AxialAnalystAgent:
         # b. Preparar el prompt
         prompt = self._prepare_axial_prompt(category, evidence_list)
         
-        # c. Invocar al LLM y extraer JSON
-        self.logger.info(f"Invocando LLM para '{category.category_name}'...")
-        llm_response_text = self.llm_service.invoke_llm(prompt)
-        axial_result_raw = extract_json_from_text(llm_response_text)
+        # c. Invocar al LLM (salvo acierto en la caché) y extraer JSON
+        cached_response = self._get_cached_response(prompt)
+        if cached_response is not None:
+            self.logger.info(f"Usando respuesta cacheada para '{category.category_name}'.")
+            llm_response_text = cached_response
+        else:
+            self.logger.info(f"Invocando LLM para '{category.category_name}'...")
+            llm_response_text = self.llm_service.invoke_llm(prompt)
+        axial_result_raw = extract_json_from_text(llm_response_text) if llm_response_text else None
 
         if not axial_result_raw:
             self.logger.error(f"No se pudo extraer un JSON válido de la respuesta del LLM para '{category.category_name}'. Se saltará.")
@@ -159,14 +300,110 @@ class AxialAnalystAgent:
             self.logger.error(f"Error de validación en la respuesta del LLM para la categoría '{category.category_name}'. Se saltará. Error: {e}")
             return # Salta a la siguiente categoría
 
-        # d. Guardar el resultado
-        analysis_to_save = {
+        if cached_response is None:
+            self._cache_response(prompt, llm_response_text)
+
+        # d. Devolver el resultado para que `run` lo guarde
+        return {
             'category_name': category.category_name,
             'category_id': category.category_id,
             'analysis': axial_result.model_dump()
         }
-        append_to_jsonl_file(self.output_path, analysis_to_save)
-        self.logger.info(f"Análisis para '{category.category_name}' guardado en {self.output_path}")
+
+    def _analyze_category_batch(self,
+                                categories: List[Category],
+                                evidence_lists: List[List[Dict[str, str]]]) -> List[Dict[str, Any]]:
+        """
+        Realiza el análisis axial de varias categorías pequeñas en una sola llamada al LLM.
+
+        La respuesta debe ser un array JSON con un objeto por categoría, identificado por
+        `category_id`; cada elemento se valida con `AxialAnalysisOutput`. Las categorías
+        que falten en la respuesta o no validen se reintentan por el camino individual.
+
+        Returns:
+            Los registros a guardar en el JSONL de salida (uno por categoría analizada).
+        """
+        if len(categories) == 1:
+            record = self._analyze_category(categories[0], evidence_lists[0])
+            return [record] if record is not None else []
+
+        prompt = self._prepare_axial_batch_prompt(categories, evidence_lists)
+        category_names = ", ".join(f"'{category.category_name}'" for category in categories)
+        cached_response = self._get_cached_response(prompt)
+        if cached_response is not None:
+            self.logger.info(f"Usando respuesta cacheada para el lote de categorías: {category_names}.")
+            llm_response_text = cached_response
+        else:
+            self.logger.info(f"Invocando LLM para un lote de {len(categories)} categorías: {category_names}...")
+            llm_response_text = self.llm_service.invoke_llm(prompt)
+        batch_result_raw = extract_json_from_text(llm_response_text) if llm_response_text else None
+
+        results_by_id: Dict[str, AxialAnalysisOutput] = {}
+        if isinstance(batch_result_raw, list):
+            for item in batch_result_raw:
+                if not isinstance(item, dict) or item.get('category_id') is None:
+                    continue
+                try:
+                    results_by_id.setdefault(str(item['category_id']), AxialAnalysisOutput.model_validate(item))
+                except ValidationError as e:
+                    self.logger.warning(f"Error de validación en el elemento '{item['category_id']}' de la respuesta agrupada. Error: {e}")
+        else:
+            self.logger.error("No se pudo extraer un array JSON válido de la respuesta agrupada del LLM.")
+        if results_by_id and cached_response is None:
+            self._cache_response(prompt, llm_response_text)
+
+        records: List[Dict[str, Any]] = []
+        for category, evidence_list in zip(categories, evidence_lists):
+            axial_result = results_by_id.get(category.category_id)
+            if axial_result is None:
+                self.logger.warning(f"La respuesta agrupada no incluye un análisis válido para '{category.category_name}'. Se analizará por separado.")
+                record = self._analyze_category(category, evidence_list)
+                if record is not None:
+                    records.append(record)
+                continue
+            records.append({
+                'category_name': category.category_name,
+                'category_id': category.category_id,
+                'analysis': axial_result.model_dump()
+            })
+        return records
+
+    def _merge_raw_categories(self, raw_categories: List[Dict[str, Any]]) -> List[Category]:
+        """
+        Unifica las categorías duplicadas (mismo `category_id`) para asegurar un análisis completo.
+
+        Primero valida los registros crudos (en bloque; solo si falla, uno a uno para saltar
+        los inválidos), de modo que un duplicado mal formado se descarta sin arrastrar a los
+        demás. Después agrupa las categorías válidas por ID y construye cada categoría
+        fusionada una sola vez, con los datos de la primera y la unión de las asignaciones
+        de códigos de todas (se conserva la primera aparición de cada código).
+        """
+        try:
+            categories = _CATEGORY_LIST_ADAPTER.validate_python(raw_categories)
+        except ValidationError:
+            # Algún registro es inválido: repetimos uno a uno para identificarlo y saltarlo
+            categories = []
+            for cat_data in raw_categories:
+                try:
+                    categories.append(Category.model_validate(cat_data))
+                except ValidationError as e:
+                    self.logger.warning(f"Error de validación en un objeto de categoría, se saltará. Error: {e}")
+
+        categories_by_id: Dict[str, List[Category]] = defaultdict(list)
+        for category in categories:
+            categories_by_id[category.category_id].append(category)
+
+        merged_categories: List[Category] = []
+        for duplicates in categories_by_id.values():
+            if len(duplicates) == 1:
+                merged_categories.append(duplicates[0])
+                continue
+            all_assignments: Dict[str, CodeAssignment] = {}
+            for category in duplicates:
+                for assignment in category.code_assignments:
+                    all_assignments.setdefault(assignment.code_id, assignment)
+            merged_categories.append(duplicates[0].model_copy(update={'code_assignments': list(all_assignments.values())}))
+        return merged_categories
 
     def run(self):
         """
@@ -177,38 +414,67 @@ class AxialAnalystAgent:
             # --- FASE 1: CARGAR Y UNIFICAR DATOS ---
             raw_categories = load_json_file(self.categories_path)
             
-            # Unificar categorías duplicadas para asegurar un análisis completo
-            merged_categories: Dict[str, Category] = {}
-            for cat_data in raw_categories:
-                try:
-                    category = Category.model_validate(cat_data)
-                    if category.category_id not in merged_categories:
-                        merged_categories[category.category_id] = category
-                    else:
-                        # Fusionar las asignaciones de códigos de la categoría duplicada
-                        existing_codes = {assign.code_id for assign in merged_categories[category.category_id].code_assignments}
-                        new_codes = {assign.code_id for assign in category.code_assignments}
-                        
-                        # Añadir solo los códigos que no existían
-                        for code_id in new_codes:
-                            if code_id not in existing_codes:
-                                merged_categories[category.category_id].code_assignments.append(CodeAssignment(code_id=code_id))
-
-                except ValidationError as e:
-                    self.logger.warning(f"Error de validación en un objeto de categoría, se saltará. Error: {e}")
-                    continue
-
-            categories_to_analyze = list(merged_categories.values())
+            categories_to_analyze = self._merge_raw_categories(raw_categories)
             self.logger.info(f"{len(raw_categories)} categorías cargadas, unificadas en {len(categories_to_analyze)} categorías únicas para análisis.")
 
             insights_iterator = load_jsonl_file(self.insights_path)
-            code_to_evidence_map = self._build_evidence_index(insights_iterator)
+            evidence_index = self._build_evidence_index(insights_iterator)
+
+            # Descartamos de antemano las categorías sin ningún código con evidencia:
+            # una única comprobación `isdisjoint` (en C) por categoría contra el set cacheado.
+            live_code_ids = evidence_index[1].keys()
+            categories_with_evidence = [
+                category for category in categories_to_analyze
+                if not category.code_id_set.isdisjoint(live_code_ids)
+            ]
+            skipped_count = len(categories_to_analyze) - len(categories_with_evidence)
+            if skipped_count:
+                self.logger.warning(f"{skipped_count} categorías no tienen evidencia en {self.insights_path} y se saltarán.")
+            categories_to_analyze = categories_with_evidence
+
+            # Resolvemos la evidencia de cada categoría una sola vez, antes de lanzar las
+            # llamadas al LLM, y liberamos el índice completo para que el GC lo recoja.
+            category_evidence: Dict[str, List[Dict[str, str]]] = {
+                category.category_id: self._get_evidence_for_category(category, evidence_index)
+                for category in categories_to_analyze
+            }
+            del evidence_index
             
-            # --- FASE 2: ANÁLISIS ITERATIVO POR CATEGORÍA ---
-            self.logger.info(f"Iniciando análisis para {len(categories_to_analyze)} categorías únicas.")
-            for i, category in enumerate(categories_to_analyze):
-                self.logger.info(f"Procesando categoría {i+1}/{len(categories_to_analyze)}: '{category.category_name}'")
-                self._analyze_category(category, code_to_evidence_map)
+            # --- FASE 2: ANÁLISIS EN PARALELO POR LOTES DE CATEGORÍAS ---
+            # Las categorías pequeñas se agrupan para compartir una misma llamada al LLM;
+            # las grandes van solas. Tras construir el índice no hay estado compartido
+            # entre lotes, así que las llamadas (limitadas por red) se solapan en un pool de hilos.
+            batches = self._pack_category_batches(categories_to_analyze, category_evidence)
+            self.logger.info(f"Iniciando análisis para {len(categories_to_analyze)} categorías únicas en {len(batches)} llamadas con {self.max_concurrency} hilos.")
+            processed = 0
+            # Un único handle con buffer durante toda la fase: el hilo principal es el único
+            # que escribe (a medida que terminan los futures), así que no hace falta un lock.
+            with open(self.output_path, 'ab', buffering=JSONL_WRITE_BUFFER_SIZE) as output_file, \
+                    ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+                futures = {
+                    executor.submit(
+                        self._analyze_category_batch,
+                        batch,
+                        [category_evidence[category.category_id] for category in batch]
+                    ): batch
+                    for batch in batches
+                }
+                for i, future in enumerate(as_completed(futures), 1):
+                    batch = futures[future]
+                    batch_names = ", ".join(f"'{category.category_name}'" for category in batch)
+                    try:
+                        analyses_to_save = future.result()
+                    except Exception as e:
+                        self.logger.error(f"Error inesperado analizando las categorías {batch_names}: {e}", exc_info=True)
+                        analyses_to_save = []
+                    for analysis_to_save in analyses_to_save:
+                        write_jsonl_record(output_file, analysis_to_save)
+                        self.logger.info(f"Análisis para '{analysis_to_save['category_name']}' guardado en {self.output_path}")
+                    # Volcamos el buffer una vez por cada tanda de trabajadores
+                    if i % self.max_concurrency == 0:
+                        output_file.flush()
+                    processed += len(batch)
+                    self.logger.info(f"Progreso: {processed}/{len(categories_to_analyze)} categorías procesadas ({batch_names}).")
 
             # --- FASE 3: COMPLETADO ---
             self.logger.info("Análisis de todas las categorías completado.")
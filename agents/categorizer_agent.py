@@ -1,15 +1,73 @@
 # agents/categorizer_agent.py
 
-import json
+import asyncio
+import hashlib
+import unicodedata
+from collections import deque
+from difflib import SequenceMatcher
 import os
 import logging
-from typing import List, Dict, Any, Optional
+import orjson
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Dict, Any, BinaryIO, Iterator, Optional, Set, Tuple, Union
 from dotenv import load_dotenv
-from pydantic import ValidationError
+from pydantic import TypeAdapter, ValidationError
 
-from utils.file_utils import load_json_file, save_json_file, extract_json_from_text
-from models.data_models import Codebook, Category, CategorizationResult
+from utils.file_utils import load_json_file, load_json_file_cached, save_json_file, save_json_array_stream, write_jsonl_record, load_prompt_template, JSONL_READ_BUFFER_SIZE, JSONL_WRITE_BUFFER_SIZE
+from utils.prompt_template import CompiledPromptTemplate, compile_prompt_template
+from models.data_models import Codebook, Category, CategorizationResult, CodeAssignment
 from services.llm_service import LLMService
+from services.llm_response_cache import LLMResponseCache
+
+# Valida todos los resultados de un lote en una sola llamada al núcleo de Pydantic
+_CATEGORIZATION_LIST_ADAPTER = TypeAdapter(List[CategorizationResult])
+
+# Serializador de una categoría directamente a bytes JSON (para el log de deltas y la salida)
+_CATEGORY_ADAPTER = TypeAdapter(Category)
+
+# Formato de salida forzado, construido una sola vez por proceso: el JSON schema de la
+# lista de resultados, que el proveedor aplica al generar (liteLLM lo traduce a
+# `response_schema` en Gemini), así la respuesta llega ya como JSON con esta forma.
+_CATEGORIZATION_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "categorization_results",
+        "schema": _CATEGORIZATION_LIST_ADAPTER.json_schema(),
+    },
+}
+
+
+# Se añade al prompt cuando la primera respuesta no se pudo parsear o validar
+_REPAIR_INSTRUCTION = (
+    "\n\nIMPORTANTE: tu respuesta anterior no era JSON válido o no seguía la estructura requerida. "
+    "Devuelve ÚNICAMENTE el array JSON con la estructura especificada, sin texto adicional.\n"
+)
+
+
+# Palabras que no distinguen dos nombres de categoría en la reconciliación
+# ("Confianza en la IA" y "Confianza hacia la IA" son la misma categoría)
+_NAME_STOPWORDS = frozenset({
+    'a', 'al', 'con', 'de', 'del', 'e', 'el', 'en', 'entre', 'hacia', 'la', 'las', 'lo', 'los',
+    'o', 'para', 'por', 'sobre', 'su', 'sus', 'u', 'un', 'una', 'y',
+    'and', 'for', 'in', 'of', 'on', 'the', 'to',
+})
+
+def _to_tabular(records: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Convierte una lista de diccionarios homogéneos a forma tabular
+    (`{"schema": [columnas], "rows": [[valores], ...]}`): los nombres de las claves
+    se envían una sola vez en lugar de repetirse en cada objeto del prompt.
+    """
+    schema = list(dict.fromkeys(key for record in records for key in record))
+    return {"schema": schema, "rows": [[record.get(key) for key in schema] for record in records]}
+
+
+def _compact_seed_category(category: Dict[str, Any]) -> Dict[str, Any]:
+    """Abrevia una categoría semilla a las claves cortas documentadas en el prompt (n, d, k)."""
+    compact = {"n": category.get("category_name", ""), "d": category.get("description") or ""}
+    if category.get("keywords"):
+        compact["k"] = category["keywords"]
+    return compact
 
 class CategorizerAgent:
     """
@@ -27,206 +85,755 @@ class CategorizerAgent:
                  categories_path: str = 'data/categorias.json',
                  prompt_template_path: str = 'prompts/categorize_code.md',
                  config_path: str = 'config_proyecto.json',
-                 batch_size: int = 50):
+                 batch_size: int = 50,
+                 cache_enabled: bool = True,
+                 cache_dir: Optional[str] = None,
+                 max_concurrency: int = 1,
+                 max_prompt_tokens: int = 800_000,
+                 reconcile_similarity: float = 0.9):
         """
         Inicializa el agente con sus dependencias.
+
+        Con `max_concurrency` > 1 los lotes se envían al LLM de forma concurrente
+        (asyncio) y sus resultados se fusionan en orden de llegada; con 1 se conserva
+        el procesamiento secuencial, en el que cada lote ve todas las categorías previas.
+        Como los lotes concurrentes no ven las categorías que crean los demás, al terminar
+        se hace una pasada de reconciliación que fusiona las categorías con nombres casi
+        iguales (similitud >= `reconcile_similarity`, sin tildes, mayúsculas ni palabras vacías).
+
+        Los lotes se planifican por presupuesto de tokens: se agrupan códigos hasta acercarse
+        a `max_prompt_tokens` (contexto del modelo), con `batch_size` como máximo de códigos
+        por lote, ya que cada código también genera salida (asignación y justificación).
+
+        Si `cache_enabled` es True, las respuestas válidas del LLM se guardan en una
+        caché en disco (`cache_dir`, por defecto `<categories_path>.llmcache`) para no
+        repetir prompts idénticos. La clave es el hash del prompt ya renderizado junto
+        con el modelo y la temperatura, así que editar la plantilla invalida las entradas.
         """
         self.logger = logging.getLogger(__name__)
         self.llm_service = llm_service
         self.codebook_path = codebook_path
         self.categories_path = categories_path
+        # Log JSONL de deltas (categorías nuevas y códigos añadidos) escrito lote a lote;
+        # `_save_output` lo compacta en el JSON canónico al final.
+        self.categories_log_path = os.path.splitext(categories_path)[0] + '.jsonl'
+        # Punto de control de la ejecución en curso: qué códigos ya se procesaron y hasta
+        # qué byte del log de deltas es consistente. Permite reanudar tras una interrupción.
+        self.checkpoint_path = os.path.splitext(categories_path)[0] + '.checkpoint.json'
+        # Log JSONL de solo anexado con los code_ids de cada lote procesado (una línea por lote);
+        # el punto de control anota hasta qué byte es consistente, igual que con el log de deltas.
+        self.processed_log_path = os.path.splitext(categories_path)[0] + '.processed.jsonl'
+        # Huella de las entradas que produjeron el archivo de categorías actual (ver `run`)
+        self.run_key_path = categories_path + '.key'
         self.prompt_template_path = prompt_template_path
         self.batch_size = batch_size
-        self._prompt_template = None
+        self.max_prompt_tokens = max_prompt_tokens
+        self.max_concurrency = max(1, max_concurrency)
+        self.reconcile_similarity = reconcile_similarity
+        self._cache = LLMResponseCache(cache_dir or self.categories_path + '.llmcache') if cache_enabled else None
+        # Estado de la fusión entre lotes: categoría por nombre normalizado y sus code_ids ya asignados.
+        # Se reinicia en cada `categorize_codes` y se actualiza en sitio lote a lote.
+        self._category_map: Dict[str, Category] = {}
+        self._category_code_sets: Dict[str, Set[str]] = {}
+        self._run_hash: Optional[str] = None
+        self._processed_code_ids: Set[str] = set()
+        # Plantilla con las partes estáticas (preguntas de investigación y mapa del codebook)
+        # ya rellenadas; se prepara una vez por ejecución en `_prepare_static_prompt_data`.
+        self._static_prompt_template: Optional[CompiledPromptTemplate] = None
+        self._id_to_label_map: Dict[str, str] = {}
+        # Codebook validado y mtime del archivo del que se cargó: si el agente se reutiliza
+        # y el archivo no ha cambiado, no se vuelve a leer ni a validar.
+        self._codebook: Optional[Codebook] = None
+        self._codebook_mtime_ns: Optional[int] = None
         try:
-            self.config_data = load_json_file(config_path)
+            # Solo se lee: se puede compartir la copia memorizada entre instancias
+            self.config_data = load_json_file_cached(config_path)
         except FileNotFoundError:
             self.logger.warning(f"Archivo de configuración no encontrado en {config_path}. Se usarán valores por defecto.")
             self.config_data = {}
 
-    def _load_prompt_template(self) -> str:
+    def _prepare_static_prompt_data(self) -> Codebook:
         """
-        Carga la plantilla de prompt desde el archivo .md, usando caché.
-        """
-        if self._prompt_template is None:
-            try:
-                with open(self.prompt_template_path, 'r', encoding='utf-8') as f:
-                    self._prompt_template = f.read()
-            except FileNotFoundError:
-                self.logger.error(f"Template de prompt no encontrado: {self.prompt_template_path}")
-                raise
-        return self._prompt_template
+        Carga y valida el codebook y prepara las partes del prompt que no cambian
+        entre lotes: el mapa de significados (id -> label) del que se extrae el de
+        cada lote, y las preguntas de investigación, que se funden en la plantilla.
 
-    def _prepare_prompt(self, codes_to_categorize: List[Dict[str, Any]], known_categories: List[Category]) -> str:
-        """
-        Prepara el prompt final inyectando un "mapa de significados" optimizado
-        y las categorías ya conocidas para mantener la consistencia.
+        Se llama al inicio de cada `categorize_codes` (no en `__init__`), porque el
+        orquestador crea el agente antes de que exista el codebook. Si el archivo no ha
+        cambiado desde la última carga (mismo mtime), se reutiliza lo ya preparado.
+
+        Returns:
+            El codebook validado, para que el llamador pueda reutilizarlo.
         """
-        self.logger.info("Preparando prompt optimizado...")
-        
-        # Cargar datos necesarios usando las utilidades y validando con Pydantic
-        codebook_data = load_json_file(self.codebook_path)
-        prompt_template = self._load_prompt_template()
+        codebook_mtime_ns = os.stat(self.codebook_path).st_mtime_ns
+        if self._codebook is not None and codebook_mtime_ns == self._codebook_mtime_ns:
+            self.logger.debug("El codebook no ha cambiado desde la última carga; se reutiliza.")
+            return self._codebook
 
         try:
-            codebook = Codebook.model_validate(codebook_data)
+            # Los bytes van directos a pydantic-core: parseo y validación en una sola pasada
+            with open(self.codebook_path, 'rb') as f:
+                codebook = Codebook.model_validate_json(f.read())
         except ValidationError as e:
             self.logger.error(f"El codebook en {self.codebook_path} tiene un formato inválido: {e}")
             raise
 
-        id_to_label_map = {code.id: code.label for code in codebook.codes}
-        
+        self._id_to_label_map = {code.id: code.label for code in codebook.codes}
         research_questions = self.config_data.get("research_questions", [])
-        
+        research_questions_text = "\n".join(f"- {q}" for q in research_questions)
+
+        prompt_template = compile_prompt_template(load_prompt_template(self.prompt_template_path))
+        self._static_prompt_template = prompt_template.partial(research_questions=research_questions_text)
+        self._codebook = codebook
+        self._codebook_mtime_ns = codebook_mtime_ns
+        return codebook
+
+    def _prepare_batch_fields(self, codes_to_categorize: List[Dict[str, Any]]) -> Dict[str, bytes]:
+        """
+        Serializa los campos del prompt que solo dependen de los códigos del lote
+        (su mapa de significados y la tabla de códigos). No dependen de las categorías
+        conocidas, así que pueden prepararse antes de que termine el lote anterior.
+        """
+        # Solo los significados de los códigos del lote: las categorías conocidas se envían
+        # como nombre y descripción, así que el resto del codebook no tendría referencia.
+        # Dos columnas (`id<TAB>label`, una línea por código): sin llaves, comillas ni
+        # claves repetidas, que solo suman tokens de entrada.
+        relevant_codebook_map = "\n".join(
+            f"{code['code_id']}\t{' '.join(str(self._id_to_label_map[code['code_id']]).split())}"
+            for code in codes_to_categorize if code.get('code_id') in self._id_to_label_map
+        )
+        return {
+            'relevant_codebook_map_tsv': relevant_codebook_map.encode('utf-8'),
+            'codes_to_categorize_json': orjson.dumps(_to_tabular(codes_to_categorize), option=orjson.OPT_NON_STR_KEYS),
+        }
+
+    def _prepare_prompt(self,
+                        codes_to_categorize: List[Dict[str, Any]],
+                        known_categories: List[Category],
+                        batch_fields: Optional[Dict[str, bytes]] = None) -> bytes:
+        """
+        Prepara el prompt final inyectando un "mapa de significados" optimizado
+        y las categorías ya conocidas para mantener la consistencia.
+
+        Solo se construyen los campos que cambian por lote (el mapa de significados
+        de sus códigos, las categorías y los códigos); el resto del prompt viene ya
+        rellenado desde `_prepare_static_prompt_data`. Si se pasan `batch_fields`
+        (de `_prepare_batch_fields`), solo queda serializar las categorías.
+        """
+        self.logger.info("Preparando prompt optimizado...")
+        if self._static_prompt_template is None:
+            self._prepare_static_prompt_data()
+        if batch_fields is None:
+            batch_fields = self._prepare_batch_fields(codes_to_categorize)
+
+        # Formato compacto documentado en la plantilla: claves cortas para las categorías
+        # y una tabla (schema + rows) para los códigos del lote.
         if known_categories:
             seed_categories_for_prompt = [
-                {"category_name": cat.category_name, "description": cat.description or ""}
+                {"n": cat.category_name, "d": cat.description or ""}
                 for cat in known_categories
             ]
         else:
-            seed_categories_for_prompt = self.config_data.get("seed_categories", [])
-        
-        research_questions_text = "\n".join(f"- {q}" for q in research_questions)
-        seed_categories_json = json.dumps(seed_categories_for_prompt, indent=2, ensure_ascii=False)
-        codebook_map_json = json.dumps(id_to_label_map, indent=2, ensure_ascii=False)
-        codes_to_categorize_json = json.dumps(codes_to_categorize, indent=2, ensure_ascii=False)
-        
-        final_prompt = prompt_template.format(
-            research_questions=research_questions_text,
-            seed_categories_json=seed_categories_json,
-            codebook_map_json=codebook_map_json,
-            codes_to_categorize_json=codes_to_categorize_json
+            seed_categories_for_prompt = [
+                _compact_seed_category(category) for category in self.config_data.get("seed_categories", [])
+            ]
+
+        final_prompt = self._static_prompt_template.render_bytes(
+            seed_categories_json=orjson.dumps(seed_categories_for_prompt, option=orjson.OPT_NON_STR_KEYS),
+            **batch_fields
         )
         
         self.logger.info("Prompt optimizado preparado exitosamente.")
         return final_prompt
 
-    def _invoke_llm(self, prompt: str) -> List[CategorizationResult]:
+    def _invoke_llm(self, prompt: Union[str, bytes]) -> List[CategorizationResult]:
         """
         Invoca al LLM con el prompt final, confiando en que el LLMService
         ya está configurado para el modo JSON, y valida la respuesta.
         """
         self.logger.info("Invocando LLM para categorización...")
-        
+        cached_response = self._get_cached_response(prompt)
+        if cached_response is not None:
+            self.logger.info("Usando respuesta cacheada para este lote.")
+            return self._parse_llm_response(prompt, cached_response, from_cache=True)
+        response_text = self.llm_service.invoke_llm(prompt, response_format=_CATEGORIZATION_RESPONSE_FORMAT)
+        try:
+            return self._parse_llm_response(prompt, response_text, from_cache=False)
+        except ValueError:
+            # Un único reintento de reparación antes de dar el lote por perdido
+            self.logger.warning("La respuesta del LLM no era JSON válido según el esquema; se reintenta una vez.")
+            response_text = self.llm_service.invoke_llm(self._build_repair_prompt(prompt), response_format=_CATEGORIZATION_RESPONSE_FORMAT)
+            return self._parse_llm_response(prompt, response_text, from_cache=False)
+
+    async def _ainvoke_llm(self, prompt: Union[str, bytes]) -> List[CategorizationResult]:
+        """Versión asíncrona de `_invoke_llm` (misma caché y misma validación)."""
+        self.logger.info("Invocando LLM (async) para categorización...")
+        cached_response = self._get_cached_response(prompt)
+        if cached_response is not None:
+            self.logger.info("Usando respuesta cacheada para este lote.")
+            return self._parse_llm_response(prompt, cached_response, from_cache=True)
+        response_text = await self.llm_service.ainvoke_llm(prompt, response_format=_CATEGORIZATION_RESPONSE_FORMAT)
+        try:
+            return self._parse_llm_response(prompt, response_text, from_cache=False)
+        except ValueError:
+            self.logger.warning("La respuesta del LLM no era JSON válido según el esquema; se reintenta una vez.")
+            response_text = await self.llm_service.ainvoke_llm(self._build_repair_prompt(prompt), response_format=_CATEGORIZATION_RESPONSE_FORMAT)
+            return self._parse_llm_response(prompt, response_text, from_cache=False)
+
+    @staticmethod
+    def _build_repair_prompt(prompt: Union[str, bytes]) -> Union[str, bytes]:
+        """
+        Añade al prompt original la instrucción de reparación. La respuesta reparada
+        se valida y se cachea bajo el prompt original, no bajo este.
+        """
+        if isinstance(prompt, bytes):
+            return prompt + _REPAIR_INSTRUCTION.encode('utf-8')
+        return prompt + _REPAIR_INSTRUCTION
+
+    def _get_cached_response(self, prompt: Union[str, bytes]) -> Optional[str]:
+        """Busca en la caché en disco una respuesta previa para este prompt, modelo y temperatura."""
+        if self._cache is None:
+            return None
+        return self._cache.get(prompt, self.llm_service.model, self.llm_service.temperature)
+
+    def _parse_llm_response(self,
+                            prompt: Union[str, bytes],
+                            response_text: Optional[str],
+                            from_cache: bool) -> List[CategorizationResult]:
+        """
+        Extrae y valida la lista de categorías de la respuesta del LLM. Las respuestas
+        válidas que no vienen de la caché se guardan en ella.
+        """
         try:
-            response_text = self.llm_service.invoke_llm(prompt)
-            
-            self.logger.debug(f"Respuesta raw del LLM: {repr(response_text[:200])}...")
-            
             if not response_text:
                 self.logger.error("La respuesta del LLM para la categorización estaba vacía.")
                 return []
 
-            # Extraer el JSON de la respuesta
-            json_output = extract_json_from_text(response_text)
-            if not json_output:
-                self.logger.error("No se pudo extraer un JSON válido de la respuesta del LLM para la categorización.")
-                return []
+            self.logger.debug(f"Respuesta raw del LLM: {repr(response_text[:200])}...")
 
-            # Validación con Pydantic: potente, declarativa y en una línea.
-            validated_results = [CategorizationResult.model_validate(item) for item in json_output]
+            # La respuesta se genera restringida al JSON schema de `_CATEGORIZATION_RESPONSE_FORMAT`,
+            # así que se espera JSON puro: parseo y validación en una sola pasada de pydantic-core,
+            # sin buscar bloques ```json```. Si aun así no lo es, el error dispara la reparación.
+            validated_results = _CATEGORIZATION_LIST_ADAPTER.validate_json(response_text.strip())
+            if self._cache is not None and not from_cache:
+                self._cache.put(prompt, self.llm_service.model, self.llm_service.temperature, response_text)
             
             self.logger.info(f"LLM procesó y validó exitosamente {len(validated_results)} categorías.")
             return validated_results
             
-        except json.JSONDecodeError as e:
-            self.logger.error(f"Respuesta del LLM no es JSON válido. Error: {e}. Respuesta: {repr(response_text)}")
-            raise ValueError(f"Respuesta del LLM no es JSON válido: {e}")
         except ValidationError as e:
             self.logger.error(f"La respuesta del LLM no cumple con el modelo CategorizationResult. Error: {e}. Respuesta: {repr(response_text)}")
             raise ValueError(f"La respuesta del LLM tiene un formato inesperado: {e}")
         except Exception as e:
             self.logger.error(f"Error en invocación del LLM: {e}")
-            if 'response_text' in locals() and response_text:
+            if response_text:
                 self.logger.error(f"Respuesta que causó el error: {repr(response_text)}")
             raise
 
+    @staticmethod
+    def _normalize_category_name(category_name: str) -> str:
+        """Clave de fusión de una categoría: nombre sin espacios sobrantes y sin distinguir mayúsculas."""
+        return ' '.join(category_name.split()).casefold()
+
     def _update_known_categories(self,
-                                 known_categories: List[Category],
-                                 new_batch_results: List[CategorizationResult]) -> List[Category]:
+                                 new_batch_results: List[CategorizationResult],
+                                 delta_log: Optional[BinaryIO] = None) -> List[Category]:
         """
         Fusiona inteligentemente los resultados de un nuevo lote con las categorías ya conocidas.
+
+        El mapa de categorías y el set de code_ids de cada una viven en la instancia,
+        así que la pertenencia de un código es O(1) y nada se reconstruye entre lotes.
+        Si se pasa `delta_log`, se escribe una línea JSONL por cada categoría creada
+        o ampliada, solo con las asignaciones nuevas.
         """
-        self.logger.debug(f"Iniciando fusión. {len(known_categories)} categorías conocidas, {len(new_batch_results)} resultados nuevos.")
-        
-        category_map = {cat.category_name: cat for cat in known_categories}
+        self.logger.debug(f"Iniciando fusión. {len(self._category_map)} categorías conocidas, {len(new_batch_results)} resultados nuevos.")
 
         for new_cat_result in new_batch_results:
-            if new_cat_result.category_name in category_map:
-                # La categoría ya existe, añadir nuevos códigos si no están ya
-                existing_cat = category_map[new_cat_result.category_name]
-                existing_code_ids = {assign.code_id for assign in existing_cat.code_assignments}
-                
-                for new_assignment in new_cat_result.code_assignments:
-                    if new_assignment.code_id not in existing_code_ids:
-                        existing_cat.code_assignments.append(new_assignment)
+            # Asignaciones del resultado por code_id (la primera aparición gana), para operar
+            # con conjuntos en lugar de comprobar la pertenencia código a código.
+            incoming_assignments: Dict[str, CodeAssignment] = {}
+            for assign in new_cat_result.code_assignments:
+                incoming_assignments.setdefault(assign.code_id, assign)
+
+            # El LLM suele devolver variantes de mayúsculas/espacios de un mismo nombre
+            # ("Social Capital" vs "social capital "): se fusionan bajo la misma clave.
+            name_key = self._normalize_category_name(new_cat_result.category_name)
+            if name_key in self._category_map:
+                # La categoría ya existe: solo se añaden los códigos que aún no tiene
+                existing_cat = self._category_map[name_key]
+                code_set = self._category_code_sets[name_key]
+
+                missing_ids = incoming_assignments.keys() - code_set
+                if not missing_ids:
+                    continue
+                # Se recorre el dict (y no el set) para conservar el orden de llegada
+                added_assignments = [assign for code_id, assign in incoming_assignments.items() if code_id in missing_ids]
+                existing_cat.code_assignments.extend(added_assignments)
+                code_set |= missing_ids
+                if delta_log is not None:
+                    write_jsonl_record(delta_log, {
+                        'category_id': existing_cat.category_id,
+                        'code_assignments': [assign.model_dump() for assign in added_assignments]
+                    })
             else:
                 # Es una categoría completamente nueva
                 # La creamos usando nuestro modelo `Category`
+                # (se conserva el nombre tal como llegó la primera vez)
                 new_category = Category(
-                    category_id=f"cat_{len(category_map) + 1}", # Generar un ID simple
-                    category_name=new_cat_result.category_name,
+                    category_id=f"cat_{len(self._category_map) + 1}", # Generar un ID simple
+                    category_name=new_cat_result.category_name.strip(),
                     description=new_cat_result.description,
-                    code_assignments=new_cat_result.code_assignments
+                    code_assignments=list(incoming_assignments.values())
                 )
-                category_map[new_cat_result.category_name] = new_category
+                self._category_map[name_key] = new_category
+                self._category_code_sets[name_key] = set(incoming_assignments)
+                if delta_log is not None:
+                    write_jsonl_record(delta_log, _CATEGORY_ADAPTER.dump_json(new_category))
+
+        return list(self._category_map.values())
+
+    @classmethod
+    def _reconciliation_key(cls, category_name: str) -> str:
+        """Nombre normalizado, sin tildes ni palabras vacías, para comparar nombres casi iguales."""
+        decomposed = unicodedata.normalize('NFKD', cls._normalize_category_name(category_name))
+        without_accents = ''.join(char for char in decomposed if not unicodedata.combining(char))
+        return ' '.join(word for word in without_accents.split() if word not in _NAME_STOPWORDS)
+
+    def _reconcile_categories(self, delta_log: BinaryIO) -> List[Category]:
+        """
+        Fusiona las categorías con nombres casi iguales (p. ej. "Confianza en la IA" y
+        "Confianza hacia la IA"), que aparecen cuando lotes concurrentes crean a la vez la
+        misma categoría sin verse entre sí. La categoría creada antes conserva su ID, nombre
+        y descripción y recibe las asignaciones que le falten de la otra, que se marca como
+        eliminada en el log de deltas.
+        """
+        name_keys = list(self._category_map)
+        comparison_keys = {name_key: self._reconciliation_key(self._category_map[name_key].category_name) for name_key in name_keys}
+        absorbed: Set[str] = set()
+        for i, target_key in enumerate(name_keys):
+            if target_key in absorbed:
+                continue
+            target = self._category_map[target_key]
+            code_set = self._category_code_sets[target_key]
+            for other_key in name_keys[i + 1:]:
+                if other_key in absorbed:
+                    continue
+                matcher = SequenceMatcher(None, comparison_keys[target_key], comparison_keys[other_key])
+                if matcher.ratio() < self.reconcile_similarity:
+                    continue
+                other = self._category_map[other_key]
+                added_assignments = [assign for assign in other.code_assignments if assign.code_id not in code_set]
+                target.code_assignments.extend(added_assignments)
+                code_set.update(assign.code_id for assign in added_assignments)
+                if added_assignments:
+                    write_jsonl_record(delta_log, {
+                        'category_id': target.category_id,
+                        'code_assignments': [assign.model_dump() for assign in added_assignments]
+                    })
+                write_jsonl_record(delta_log, {'category_id': other.category_id, 'deleted': True})
+                absorbed.add(other_key)
+                self.logger.info(f"Reconciliación: '{other.category_name}' se fusiona en '{target.category_name}'.")
+        for name_key in absorbed:
+            del self._category_map[name_key]
+            del self._category_code_sets[name_key]
+        if absorbed:
+            self.logger.info(f"Reconciliación completada: {len(absorbed)} categorías casi duplicadas fusionadas.")
+        return list(self._category_map.values())
+
+    def _iter_compacted_categories(self) -> Iterator[Dict[str, Any]]:
+        """
+        Reconstruye las categorías a partir del log de deltas, una a una: la primera línea
+        de cada `category_id` es la categoría completa y las siguientes solo añaden
+        asignaciones; una línea `{"category_id": ..., "deleted": true}` (categoría absorbida
+        por otra en la reconciliación) la descarta. Trabaja con diccionarios, sin volver a
+        pasar por Pydantic.
+
+        Una primera pasada indexa los offsets de las líneas de cada categoría; la segunda
+        lee y fusiona solo las de la categoría en curso, así que en memoria nunca hay más
+        que una categoría completa.
+        """
+        line_offsets: Dict[str, List[int]] = {}
+        deleted_ids: Set[str] = set()
+        with open(self.categories_log_path, 'rb', buffering=JSONL_READ_BUFFER_SIZE) as log_file:
+            offset = 0
+            for line in log_file:
+                if line.strip():
+                    delta = orjson.loads(line)
+                    if delta.get('deleted'):
+                        deleted_ids.add(delta['category_id'])
+                    else:
+                        line_offsets.setdefault(delta['category_id'], []).append(offset)
+                offset += len(line)
+
+            for category_id, offsets in line_offsets.items():
+                if category_id in deleted_ids:
+                    continue
+                category = None
+                for offset in offsets:
+                    log_file.seek(offset)
+                    delta = orjson.loads(log_file.readline())
+                    if category is None:
+                        category = delta
+                    else:
+                        category['code_assignments'].extend(delta['code_assignments'])
+                yield category
+
+    def _compute_run_hash(self, codes_to_categorize: List[Dict[str, Any]]) -> str:
+        """
+        Identifica las entradas de una ejecución (codebook, configuración, plantilla del prompt,
+        modelo, temperatura y códigos a categorizar): un punto de control solo se reutiliza
+        si este hash coincide, para no fusionar categorías generadas con otras entradas.
+        """
+        hasher = hashlib.blake2b(digest_size=16)
+        with open(self.codebook_path, 'rb') as f:
+            hasher.update(f.read())
+        hasher.update(orjson.dumps(self.config_data, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS))
+        hasher.update(load_prompt_template(self.prompt_template_path).encode('utf-8'))
+        hasher.update(orjson.dumps(codes_to_categorize, option=orjson.OPT_NON_STR_KEYS))
+        hasher.update(f"{self.llm_service.model}|{self.llm_service.temperature}".encode('utf-8'))
+        return hasher.hexdigest()
+
+    def _save_checkpoint(self, batch: List[Dict[str, Any]], delta_log: BinaryIO, processed_log: BinaryIO) -> None:
+        """
+        Registra un lote como procesado tras fusionarlo. Sus code_ids se anexan al log de
+        procesados (no se reescribe la lista completa en cada lote) y se vuelcan antes ambos
+        logs para que los tamaños anotados correspondan exactamente al estado fusionado;
+        el punto de control se escribe de forma atómica.
+        """
+        batch_ids = [code['code_id'] for code in batch]
+        self._processed_code_ids.update(batch_ids)
+        processed_log.write(orjson.dumps(batch_ids) + b'\n')
+        delta_log.flush()
+        processed_log.flush()
+        save_json_file(self.checkpoint_path, {
+            'run_hash': self._run_hash,
+            'delta_log_size': delta_log.tell(),
+            'processed_log_size': processed_log.tell()
+        })
+
+    def _resume_from_checkpoint(self) -> bool:
+        """
+        Intenta reanudar una ejecución interrumpida con las mismas entradas. El log de deltas
+        se recorta al tamaño registrado (descartando un lote escrito a medias) y se vuelve
+        a cargar en el mapa de categorías.
+
+        Returns:
+            True si se reanudó; False si no hay un punto de control válido para esta ejecución.
+        """
+        if not os.path.exists(self.checkpoint_path):
+            return False
+        try:
+            checkpoint = load_json_file(self.checkpoint_path)
+        except Exception as e:
+            self.logger.warning(f"Punto de control ilegible en {self.checkpoint_path}, se ignorará: {e}")
+            return False
+        if checkpoint.get('run_hash') != self._run_hash:
+            self.logger.info("El punto de control corresponde a otras entradas; se empieza desde cero.")
+            return False
 
-        return list(category_map.values())
+        delta_log_size = checkpoint['delta_log_size']
+        processed_log_size = checkpoint.get('processed_log_size')
+        if not os.path.exists(self.categories_log_path) or os.path.getsize(self.categories_log_path) < delta_log_size:
+            self.logger.warning("El log de deltas no cubre el punto de control; se empieza desde cero.")
+            return False
+        if (processed_log_size is None or not os.path.exists(self.processed_log_path)
+                or os.path.getsize(self.processed_log_path) < processed_log_size):
+            self.logger.warning("El log de códigos procesados no cubre el punto de control; se empieza desde cero.")
+            return False
+        with open(self.categories_log_path, 'r+b') as log_file:
+            log_file.truncate(delta_log_size)
+        with open(self.processed_log_path, 'r+b') as log_file:
+            log_file.truncate(processed_log_size)
+            log_file.seek(0)
+            self._processed_code_ids = {code_id for line in log_file for code_id in orjson.loads(line)}
 
-    def _save_output(self, categorized_data: List[Category]) -> None:
+        for category_data in self._iter_compacted_categories():
+            category = Category.model_validate(category_data)
+            name_key = self._normalize_category_name(category.category_name)
+            self._category_map[name_key] = category
+            self._category_code_sets[name_key] = {assign.code_id for assign in category.code_assignments}
+        self.logger.info(
+            f"Reanudando ejecución interrumpida: {len(self._processed_code_ids)} códigos ya procesados, "
+            f"{len(self._category_map)} categorías recuperadas."
+        )
+        return True
+
+    def _save_output(self, categorized_data: Optional[List[Category]] = None) -> None:
         """
-        Guarda la lista final de categorías en un archivo JSON.
+        Guarda la lista final de categorías en un archivo JSON, escribiéndola en streaming
+        (una categoría por línea) sin construir el documento completo en memoria.
+
+        Si existe el log de deltas de la última ejecución, se compacta en el JSON
+        canónico y se elimina; si no, se serializan las categorías recibidas.
         """
-        self.logger.info(f"Guardando {len(categorized_data)} categorías en {self.categories_path}")
-        # Convertimos los objetos Pydantic a una lista de diccionarios para guardarlos
-        data_to_save = [cat.model_dump() for cat in categorized_data]
         try:
-            save_json_file(self.categories_path, data_to_save)
+            # El archivo de categorías va a cambiar: la huella anterior deja de describirlo
+            if os.path.exists(self.run_key_path):
+                os.remove(self.run_key_path)
+            if os.path.exists(self.categories_log_path):
+                records = self._iter_compacted_categories()
+            else:
+                # Pydantic serializa cada categoría directamente a JSON (en Rust),
+                # sin construir antes los diccionarios intermedios de `model_dump`
+                records = (_CATEGORY_ADAPTER.dump_json(cat) for cat in categorized_data or [])
+            saved_count = save_json_array_stream(self.categories_path, records)
+            self.logger.info(f"Guardadas {saved_count} categorías en {self.categories_path}")
+            if os.path.exists(self.categories_log_path):
+                os.remove(self.categories_log_path)
+            if os.path.exists(self.checkpoint_path):
+                os.remove(self.checkpoint_path)
+            if os.path.exists(self.processed_log_path):
+                os.remove(self.processed_log_path)
         except Exception as e:
             self.logger.error(f"No se pudo guardar el archivo de salida: {e}")
             raise
 
+    async def _categorize_batches_async(self,
+                                        batches: List[List[Dict[str, Any]]],
+                                        delta_log: BinaryIO,
+                                        processed_log: BinaryIO) -> List[Category]:
+        """
+        Procesa los lotes con hasta `max_concurrency` llamadas al LLM en vuelo.
+
+        El prompt de cada lote se construye justo al obtener su turno en el semáforo,
+        con las categorías fusionadas hasta ese momento, para que los lotes tardíos
+        sigan viendo la memoria acumulada. Si con ellas el prompt supera `max_prompt_tokens`,
+        el lote se parte en dos mitades que se encolan como tareas nuevas (igual que en el
+        modo secuencial). Los resultados se fusionan en orden de llegada; la fusión y la
+        escritura del log ocurren siempre en el hilo del bucle de eventos.
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        known_categories: List[Category] = list(self._category_map.values())
+        batch_counter = 0
+
+        async def process_batch(batch: List[Dict[str, Any]]):
+            nonlocal batch_counter
+            async with semaphore:
+                prompt = self._prepare_prompt(batch, list(self._category_map.values()))
+                if len(batch) > 1 and self._prompt_exceeds_budget(prompt):
+                    # Las categorías conocidas han crecido: el lote se devuelve para partirlo
+                    return batch, None
+                batch_counter += 1
+                self.logger.info(f"Procesando lote {batch_counter}...")
+                return batch, await self._ainvoke_llm(prompt)
+
+        pending = {asyncio.ensure_future(process_batch(batch)) for batch in batches}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                try:
+                    batch, new_batch_results = task.result()
+                    if new_batch_results is None:
+                        self.logger.info(f"El lote de {len(batch)} códigos supera el presupuesto de tokens; se divide.")
+                        middle = len(batch) // 2
+                        pending.add(asyncio.ensure_future(process_batch(batch[:middle])))
+                        pending.add(asyncio.ensure_future(process_batch(batch[middle:])))
+                        continue
+                    known_categories = self._update_known_categories(new_batch_results, delta_log)
+                    self._save_checkpoint(batch, delta_log, processed_log)
+                except Exception as e:
+                    self.logger.error(f"Fallo al procesar el lote. Saltando al siguiente. Error: {e}")
+                    continue
+                finally:
+                    delta_log.flush()
+        return known_categories
+
+    def _categorize_batches_sequentially(self,
+                                         batches: List[List[Dict[str, Any]]],
+                                         delta_log: BinaryIO,
+                                         processed_log: BinaryIO) -> List[Category]:
+        """
+        Procesa los lotes uno a uno: cada lote ve todas las categorías fusionadas de los anteriores.
+
+        Mientras se espera la respuesta del LLM de un lote, un hilo auxiliar serializa los
+        campos del siguiente que no dependen de las categorías (`_prepare_batch_fields`),
+        de modo que ese trabajo de CPU queda oculto tras la latencia de red.
+        """
+        known_categories: List[Category] = list(self._category_map.values())
+        pending_batches = deque(batches)
+        batch_number = 0
+        # (lote, future) con los campos ya preparados del próximo lote, si los hay
+        prefetched: Optional[Tuple[List[Dict[str, Any]], Future]] = None
+        with ThreadPoolExecutor(max_workers=1) as prep_executor:
+            while pending_batches:
+                batch = pending_batches.popleft()
+
+                batch_fields = None
+                if prefetched is not None and prefetched[0] is batch:
+                    batch_fields = prefetched[1].result()
+                prefetched = None
+
+                prompt = self._prepare_prompt(batch, known_categories, batch_fields)
+                if len(batch) > 1 and self._prompt_exceeds_budget(prompt):
+                    # Las categorías conocidas han crecido: se parte el lote en dos
+                    self.logger.info(f"El lote de {len(batch)} códigos supera el presupuesto de tokens; se divide.")
+                    middle = len(batch) // 2
+                    pending_batches.appendleft(batch[middle:])
+                    pending_batches.appendleft(batch[:middle])
+                    continue
+                batch_number += 1
+                self.logger.info(f"Procesando lote {batch_number}...")
+
+                if pending_batches:
+                    next_batch = pending_batches[0]
+                    prefetched = (next_batch, prep_executor.submit(self._prepare_batch_fields, next_batch))
+
+                try:
+                    new_batch_results = self._invoke_llm(prompt)
+                    known_categories = self._update_known_categories(new_batch_results, delta_log)
+                    self._save_checkpoint(batch, delta_log, processed_log)
+                except Exception as e:
+                    self.logger.error(f"Fallo al procesar el lote. Saltando al siguiente. Error: {e}")
+                    continue # Opcional: decidir si parar o continuar
+                finally:
+                    # Un volcado por lote: si el proceso se interrumpe, el log conserva lo ya fusionado
+                    delta_log.flush()
+        return known_categories
+
+    def _estimate_code_tokens(self, code: Dict[str, Any]) -> int:
+        """Aproxima (~4 caracteres por token) lo que aporta un código al prompt: su fila y su línea del mapa."""
+        label = self._id_to_label_map.get(code.get('code_id'), '')
+        return (len(orjson.dumps(code)) + len(str(label)) + 4) // 4 + 1
+
+    def _plan_batches(self, codes_to_categorize: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+        """
+        Agrupa los códigos en lotes por presupuesto de tokens en lugar de por un número fijo.
+
+        El prompt de un lote vacío (plantilla, preguntas y categorías semilla) se mide una
+        vez con el tokenizador real; después los códigos se empaquetan con la aproximación
+        de `_estimate_code_tokens` hasta agotar el resto de `max_prompt_tokens` o llegar a
+        `batch_size` códigos.
+        """
+        base_prompt_tokens = self.llm_service.count_tokens(self._prepare_prompt([], []))
+        code_budget = max(1, self.max_prompt_tokens - base_prompt_tokens)
+
+        batches: List[List[Dict[str, Any]]] = []
+        current_batch: List[Dict[str, Any]] = []
+        current_tokens = 0
+        for code in codes_to_categorize:
+            code_tokens = self._estimate_code_tokens(code)
+            if current_batch and (len(current_batch) >= self.batch_size or current_tokens + code_tokens > code_budget):
+                batches.append(current_batch)
+                current_batch, current_tokens = [], 0
+            current_batch.append(code)
+            current_tokens += code_tokens
+        if current_batch:
+            batches.append(current_batch)
+        return batches
+
+    def _prompt_exceeds_budget(self, prompt: bytes) -> bool:
+        """
+        Comprueba si un prompt ya construido supera `max_prompt_tokens` (p. ej. porque las
+        categorías conocidas han crecido). Solo se llama al tokenizador real cuando la
+        aproximación por longitud se acerca al límite.
+        """
+        if len(prompt) // 4 < self.max_prompt_tokens * 0.9:
+            return False
+        return self.llm_service.count_tokens(prompt) > self.max_prompt_tokens
+
     def categorize_codes(self, codes_to_categorize: Optional[List[Dict[str, Any]]] = None) -> List[Category]:
         """
         Orquesta el proceso de categorización de códigos en lotes.
         """
+        # El codebook se carga una sola vez por ejecución: sirve para la parte estática
+        # del prompt y, si no se pasan códigos, como fuente de los códigos a categorizar.
+        try:
+            codebook = self._prepare_static_prompt_data()
+        except ValidationError:
+            return []
+
         if codes_to_categorize is None:
-            self.logger.info("No se proporcionaron códigos. Cargando desde el codebook...")
-            codebook_data = load_json_file(self.codebook_path)
-            try:
-                codebook = Codebook.model_validate(codebook_data)
-                codes_to_categorize = [{"code_id": code.id} for code in codebook.codes]
-            except ValidationError as e:
-                self.logger.error(f"Formato de codebook inválido: {e}")
-                return []
+            self.logger.info("No se proporcionaron códigos. Se usarán todos los del codebook...")
+            codes_to_categorize = [{"code_id": code.id} for code in codebook.codes]
         
-        self.logger.info(f"Iniciando la categorización para {len(codes_to_categorize)} códigos en lotes de {self.batch_size}.")
-        
-        known_categories: List[Category] = []
+        self._category_map = {}
+        self._category_code_sets = {}
+        self._processed_code_ids = set()
+        self._run_hash = self._compute_run_hash(codes_to_categorize)
+
+        # Si una ejecución anterior con las mismas entradas se interrumpió, se reanuda:
+        # se reconstruye la fusión desde el log y solo se planifican los códigos pendientes.
+        resumed = self._resume_from_checkpoint()
+        if resumed:
+            codes_to_categorize = [code for code in codes_to_categorize if code['code_id'] not in self._processed_code_ids]
         
-        for i in range(0, len(codes_to_categorize), self.batch_size):
-            batch = codes_to_categorize[i:i + self.batch_size]
-            self.logger.info(f"Procesando lote {i//self.batch_size + 1}...")
-            
-            prompt = self._prepare_prompt(batch, known_categories)
-            
-            try:
-                new_batch_results = self._invoke_llm(prompt)
-                known_categories = self._update_known_categories(known_categories, new_batch_results)
-            except Exception as e:
-                self.logger.error(f"Fallo al procesar el lote. Saltando al siguiente. Error: {e}")
-                continue # Opcional: decidir si parar o continuar
+        known_categories: List[Category] = list(self._category_map.values())
+        batches = self._plan_batches(codes_to_categorize)
+        self.logger.info(
+            f"Iniciando la categorización para {len(codes_to_categorize)} códigos en {len(batches)} lotes "
+            f"(máximo {self.batch_size} códigos y {self.max_prompt_tokens} tokens por lote)."
+        )
+
+        # Los logs de deltas y de procesados se truncan al empezar (reflejan solo la ejecución
+        # en curso), salvo al reanudar, en cuyo caso se sigue escribiendo a continuación.
+        log_mode = 'ab' if resumed else 'wb'
+        with open(self.categories_log_path, log_mode, buffering=JSONL_WRITE_BUFFER_SIZE) as delta_log, \
+                open(self.processed_log_path, log_mode) as processed_log:
+            if self.max_concurrency > 1:
+                known_categories = asyncio.run(self._categorize_batches_async(batches, delta_log, processed_log))
+                # Los lotes concurrentes no se vieron entre sí: se unifican los casi duplicados
+                known_categories = self._reconcile_categories(delta_log)
+            else:
+                known_categories = self._categorize_batches_sequentially(batches, delta_log, processed_log)
         
         self.logger.info("Todos los lotes han sido procesados.")
         return known_categories
 
-    def run(self, codes_to_categorize: Optional[List[Dict[str, Any]]] = None) -> None:
-        """Punto de entrada principal para ejecutar el agente."""
+    def _compute_run_key(self, codes_to_categorize: Optional[List[Dict[str, Any]]]) -> str:
+        """
+        Huella SHA-256 de todo lo que determina el resultado de una ejecución: codebook,
+        configuración, plantilla del prompt, modelo, temperatura, parámetros de los lotes
+        (tamaño, presupuesto de tokens, concurrencia y umbral de reconciliación) y
+        (si se pasan) los códigos a categorizar.
+        """
+        hasher = hashlib.sha256()
+        with open(self.codebook_path, 'rb') as f:
+            hasher.update(f.read())
+        hasher.update(orjson.dumps(self.config_data, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS))
+        hasher.update(load_prompt_template(self.prompt_template_path).encode('utf-8'))
+        hasher.update(str(self.llm_service.model).encode('utf-8'))
+        hasher.update(orjson.dumps({
+            'temperature': self.llm_service.temperature,
+            'batch_size': self.batch_size,
+            'max_prompt_tokens': self.max_prompt_tokens,
+            'max_concurrency': self.max_concurrency,
+            'reconcile_similarity': self.reconcile_similarity,
+        }, option=orjson.OPT_SORT_KEYS))
+        hasher.update(orjson.dumps(codes_to_categorize, option=orjson.OPT_NON_STR_KEYS))
+        return hasher.hexdigest()
+
+    def _output_is_up_to_date(self, run_key: str) -> bool:
+        """True si el archivo de categorías existe, se puede leer y se generó con estas mismas entradas."""
+        if not os.path.exists(self.categories_path):
+            return False
+        try:
+            with open(self.run_key_path, 'r', encoding='utf-8') as f:
+                if f.read().strip() != run_key:
+                    return False
+            load_json_file(self.categories_path)
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def run(self, codes_to_categorize: Optional[List[Dict[str, Any]]] = None, force: bool = False) -> None:
+        """
+        Punto de entrada principal para ejecutar el agente.
+
+        Si el archivo de categorías ya se generó con exactamente las mismas entradas,
+        la ejecución se omite; `force=True` obliga a categorizar de nuevo.
+        """
         self.logger.info("--- Iniciando CategorizerAgent ---")
         try:
+            run_key = self._compute_run_key(codes_to_categorize)
+            if not force and self._output_is_up_to_date(run_key):
+                self.logger.info(f"--- Se omite la categorización: las entradas no han cambiado desde la última ejecución ({self.categories_path}). ---")
+                return
+
             final_categories = self.categorize_codes(codes_to_categorize)
             if final_categories:
                 self._save_output(final_categories)
+                with open(self.run_key_path, 'w', encoding='utf-8') as f:
+                    f.write(run_key)
                 self.logger.info(f"--- Proceso completado. {len(final_categories)} categorías guardadas. ---")
             else:
                 self.logger.warning("--- Proceso completado, pero no se generaron categorías. ---")
@@ -234,7 +841,6 @@ class CategorizerAgent:
             self.logger.error(f"El agente falló de forma inesperada. Error: {e}", exc_info=True)
             raise
 
-
 if __name__ == '__main__':
     """
     Permite ejecutar el agente directamente desde la terminal para pruebas y desarrollo.
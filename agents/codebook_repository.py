@@ -1,51 +1,305 @@
 import logging
+import os
 from pathlib import Path
-from pydantic import ValidationError
+from typing import Any, Dict, Iterable, Set
+import numpy as np
+import orjson
+from pydantic import TypeAdapter, ValidationError
 
-from models.data_models import Codebook
-from utils.file_utils import load_json_file, save_json_file
+from models.data_models import Codebook, Code
+from utils.file_utils import save_json_object_stream, JSONL_READ_BUFFER_SIZE
 
 # Usamos el mismo logger configurado para consistencia
 logger = logging.getLogger(__name__)
 
+# Marca de confianza que `save` escribe en el archivo: un codebook que la lleva lo generó
+# este repositorio a partir de un modelo ya validado, así que al cargarlo puede omitirse
+# la validación. Se incrementa si cambia el esquema de `Codebook`/`Code`.
+CODEBOOK_SCHEMA_VERSION = 1
+
+# Serializa cada código directamente a bytes JSON (en Rust), sin el dict intermedio de `model_dump`
+_CODE_ADAPTER = TypeAdapter(Code)
+
+# Directorios ya creados en este proceso: crear varios repositorios sobre la misma
+# carpeta no repite el `mkdir` (y su llamada al sistema) cada vez.
+_ensured_dirs: Set[Path] = set()
+
 class CodebookRepository:
     """
     Repositorio robusto para manejar la persistencia del codebook.
     Utiliza Pydantic para la validación de datos y centraliza la I/O.
     """
     
-    def __init__(self, codebook_path: str = "data/codebook.json"):
+    def __init__(self,
+                 codebook_path: str = "data/codebook.json",
+                 fsync_every: int = 64,
+                 compact_every: int = 1000):
         """
         Inicializa el repositorio con la ruta del archivo de codebook.
+
+        Los embeddings de los códigos no van en el JSON sino en `<codebook>.embeddings.npy`.
+
+        Además del JSON completo, el repositorio mantiene un log de escritura anticipada
+        (`<codebook>.wal.jsonl`) donde `append` añade solo los códigos nuevos o modificados,
+        sin reescribir el archivo entero. De un código que ya estaba en el codebook solo se
+        registran los campos cambiados (sin el embedding). `load` reaplica el log sobre el
+        JSON y `compact` (o `save`) lo consolida.
         
         Args:
             codebook_path: Ruta del archivo JSON donde se almacena el codebook
+            fsync_every: Cada cuántas entradas del log se fuerza `os.fsync` (agrupar las
+                sincronizaciones a disco multiplica el rendimiento de escritura).
+            compact_every: Número mínimo de entradas del log para que `needs_compaction` sea
+                True; con codebooks grandes el umbral pasa a ser el doble de su número de códigos.
         """
         self.codebook_path = Path(codebook_path)
-        logger.info(f"📁 CodebookRepository inicializado con ruta: {self.codebook_path}")
+        self.wal_path = self.codebook_path.with_suffix('.wal.jsonl')
+        # Los embeddings se guardan aparte, en binario float16 (una fila por código, en el
+        # mismo orden que en el JSON): el JSON queda solo con metadatos y se carga mucho antes
+        self.embeddings_path = self.codebook_path.with_suffix('.embeddings.npy')
+        self.fsync_every = max(1, fsync_every)
+        self.compact_every = compact_every
+        self._wal_entries = 0
+        self._unsynced_entries = 0
+        # IDs ya presentes en el JSON o en el log: sus cambios se registran como actualizaciones parciales
+        self._known_ids: Set[str] = set()
+        logger.info("📁 CodebookRepository inicializado con ruta: %s", self.codebook_path)
         
-        # Crear el directorio padre si no existe
-        self.codebook_path.parent.mkdir(parents=True, exist_ok=True)
+        # Crear el directorio padre si no existe (una sola vez por proceso)
+        parent_dir = self.codebook_path.parent
+        if parent_dir not in _ensured_dirs:
+            parent_dir.mkdir(parents=True, exist_ok=True)
+            _ensured_dirs.add(parent_dir)
     
     def load(self) -> Codebook:
+        """
+        Carga el codebook desde el archivo JSON y reaplica encima el log de escritura
+        anticipada, si lo hay.
+        """
+        codebook = self._load_base()
+        self._attach_embeddings(codebook)
+        self._replay_wal(codebook)
+        self._known_ids = {code.id for code in codebook.codes}
+        return codebook
+
+    def _attach_embeddings(self, codebook: Codebook) -> None:
+        """
+        Rellena los embeddings de los códigos que no los traen en el JSON a partir del archivo
+        `.npy` (mapeado en memoria: no se parsea nada). Las filas se asocian por posición:
+        los códigos solo se añaden al final o se sustituyen en su sitio, así que si una
+        escritura se interrumpió entre el `.npy` y el JSON, las filas comunes siguen alineadas.
+        """
+        try:
+            matrix = np.load(self.embeddings_path, mmap_mode='r')
+        except FileNotFoundError:
+            missing = sum(1 for code in codebook.codes if code.embedding is None)
+            if missing:
+                logger.warning(
+                    "⚠️ No existe %s y %d de %d códigos no traen embedding en el JSON: se cargan sin "
+                    "vector y no se detectarán duplicados semánticos con ellos. ¿Se versionó el JSON sin el .npy?",
+                    self.embeddings_path, missing, len(codebook.codes))
+            return
+        except (OSError, ValueError) as e:
+            logger.warning("⚠️ No se pudieron leer los embeddings de %s: %s. Se ignorarán.", self.embeddings_path, e)
+            return
+        if matrix.ndim != 2:
+            logger.warning("⚠️ Los embeddings de %s tienen una forma inesperada %s; se ignorarán.", self.embeddings_path, matrix.shape)
+            return
+        if matrix.shape[0] != len(codebook.codes):
+            logger.warning("⚠️ %s tiene %d filas para %d códigos (escritura interrumpida); se usan las comunes.",
+                           self.embeddings_path, matrix.shape[0], len(codebook.codes))
+        # Una sola conversión float16 -> float32 -> listas en C para todas las filas comunes,
+        # en lugar de una copia y un `tolist` por fila
+        common = min(matrix.shape[0], len(codebook.codes))
+        rows = matrix[:common].astype(np.float32)
+        # Las filas de códigos sin embedding se guardan como NaN; una fila con cualquier valor
+        # no finito (NaN parcial o desbordamiento de float16) tampoco se asocia
+        has_embedding = np.isfinite(rows).all(axis=1)
+        attached = 0
+        for code, row, valid in zip(codebook.codes, rows.tolist(), has_embedding.tolist()):
+            if code.embedding is None and valid:
+                code.embedding = row
+                attached += 1
+        logger.info("🧮 %d embeddings cargados desde %s", attached, self.embeddings_path)
+
+    def _save_embeddings(self, codebook: Codebook) -> None:
+        """
+        Escribe de forma atómica (temporal + `os.replace`) los embeddings en float16, una fila
+        por código; los códigos sin embedding quedan como filas NaN.
+        """
+        dimension = next((len(code.embedding) for code in codebook.codes if code.embedding), 0)
+        if not dimension:
+            self.embeddings_path.unlink(missing_ok=True)
+            return
+        matrix = np.full((len(codebook.codes), dimension), np.nan, dtype=np.float16)
+        for i, code in enumerate(codebook.codes):
+            if code.embedding and len(code.embedding) == dimension:
+                matrix[i] = code.embedding
+        tmp_path = self.embeddings_path.with_name(self.embeddings_path.name + '.tmp')
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.save(f, matrix)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.embeddings_path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+
+    def _load_base(self) -> Codebook:
         """
         Carga y valida el codebook desde el archivo JSON.
-        Si el archivo no existe o está corrupto, retorna un codebook vacío.
+        Si el archivo no existe, retorna un codebook vacío. Si existe pero está corrupto
+        o no es válido, lanza la excepción: sustituirlo por uno vacío haría que el
+        siguiente `save` borrase los datos. Como `save` escribe de forma atómica,
+        un archivo corrupto solo puede venir de una edición externa.
         """
-        if not self.codebook_path.exists():
-            logger.info(f"📝 Archivo de codebook no existe, creando estructura vacía: {self.codebook_path}")
+        # Se intenta leer directamente (una llamada al sistema en vez de `exists` + `open`)
+        try:
+            raw_codebook = self.codebook_path.read_bytes()
+        except FileNotFoundError:
+            logger.info("📝 Archivo de codebook no existe, creando estructura vacía: %s", self.codebook_path)
             return Codebook(codes=[])
-        
+
         try:
-            logger.info(f"📖 Cargando codebook desde: {self.codebook_path}")
-            data = load_json_file(str(self.codebook_path))
-            codebook = Codebook.model_validate(data)
-            logger.info(f"✅ Codebook cargado y validado exitosamente con {len(codebook.codes)} códigos")
+            logger.info("📖 Cargando codebook desde: %s", self.codebook_path)
+            # Con CODEBOOK_STRICT=1 todo se valida: los bytes van directos a pydantic-core,
+            # que parsea y valida en una sola pasada sin construir dicts intermedios.
+            if os.getenv("CODEBOOK_STRICT") == "1":
+                codebook = Codebook.model_validate_json(raw_codebook)
+                logger.info("✅ Codebook cargado y validado exitosamente con %d códigos", len(codebook.codes))
+                return codebook
+
+            data = orjson.loads(raw_codebook)
+            if self._is_trusted(data):
+                codebook = self._construct_trusted(data)
+                logger.info("✅ Codebook cargado (escrito por este repositorio, sin revalidar) con %d códigos", len(codebook.codes))
+            else:
+                codebook = Codebook.model_validate(data)
+                logger.info("✅ Codebook cargado y validado exitosamente con %d códigos", len(codebook.codes))
             return codebook
-        except (ValidationError, Exception) as e:
-            logger.error(f"❌ Error al cargar o validar el codebook: {e}. Se creará un codebook nuevo.")
-            return Codebook(codes=[])
+        except (ValidationError, orjson.JSONDecodeError) as e:
+            logger.error("❌ El codebook en %s está corrupto o no es válido: %s. Revísalo o restáuralo antes de continuar.", self.codebook_path, e)
+            raise
     
+    def _replay_wal(self, codebook: Codebook) -> None:
+        """
+        Aplica sobre el codebook las entradas del log: cada línea es un código completo que
+        sustituye al del mismo ID o se añade al final, o bien (`"op": "update"`) solo los
+        campos modificados de un código existente. Las entradas las escribió `append` a
+        partir de modelos ya validados, así que se construyen sin revalidar. Una línea
+        incompleta (escritura interrumpida) se descarta. Si no hay log, no hace nada.
+        """
+        try:
+            wal_file = open(self.wal_path, 'rb', buffering=JSONL_READ_BUFFER_SIZE)
+        except FileNotFoundError:
+            return
+        index_by_id = {code.id: i for i, code in enumerate(codebook.codes)}
+        replayed = 0
+        valid_size = 0
+        with wal_file:
+            for line in wal_file:
+                if not line.endswith(b'\n'):
+                    # Última línea sin terminar: la escritura se interrumpió a mitad
+                    logger.warning("⚠️ Entrada incompleta al final del log %s; se descarta.", self.wal_path)
+                    break
+                if line.strip():
+                    try:
+                        entry = orjson.loads(line)
+                    except orjson.JSONDecodeError:
+                        logger.warning("⚠️ Entrada ilegible en el log %s (escritura interrumpida); se descarta.", self.wal_path)
+                        continue
+                    position = index_by_id.get(entry.get('id'))
+                    if entry.pop('op', None) == 'update':
+                        # Actualización parcial: conserva el embedding y demás campos no incluidos
+                        if position is not None:
+                            codebook.codes[position] = codebook.codes[position].model_copy(update=entry)
+                    elif position is None:
+                        index_by_id[entry['id']] = len(codebook.codes)
+                        codebook.codes.append(Code.model_construct(**entry))
+                    else:
+                        codebook.codes[position] = Code.model_construct(**entry)
+                    replayed += 1
+                valid_size = wal_file.tell()
+            wal_size = os.fstat(wal_file.fileno()).st_size
+        # Si el final del log quedó a medias, se recorta para que la próxima
+        # entrada de `append` no se concatene a esa línea incompleta.
+        if valid_size < wal_size:
+            os.truncate(self.wal_path, valid_size)
+        self._wal_entries = replayed
+        logger.info("📜 Reaplicadas %d entradas del log %s (%d códigos en total)", replayed, self.wal_path, len(codebook.codes))
+
+    def append(self, codes: Iterable[Code]) -> None:
+        """
+        Registra en el log los códigos nuevos o modificados, una línea JSON por código,
+        en lugar de reescribir el codebook completo. El coste es proporcional al cambio,
+        no al tamaño del codebook. `os.fsync` se agrupa cada `fsync_every` entradas.
+
+        Los códigos nuevos se escriben completos; de los ya conocidos, cuyo embedding no
+        cambia, solo se escribe una actualización con el resto de campos.
+
+        Args:
+            codes: Los códigos añadidos o actualizados desde la última escritura.
+        """
+        lines = []
+        new_ids = []
+        for code in codes:
+            if code.id in self._known_ids:
+                lines.append(b'{"op":"update",' + _CODE_ADAPTER.dump_json(code, exclude={'embedding'})[1:] + b'\n')
+            else:
+                lines.append(_CODE_ADAPTER.dump_json(code) + b'\n')
+                new_ids.append(code.id)
+        if not lines:
+            return
+        try:
+            with open(self.wal_path, 'ab') as wal_file:
+                wal_file.write(b''.join(lines))
+                self._unsynced_entries += len(lines)
+                if self._unsynced_entries >= self.fsync_every:
+                    wal_file.flush()
+                    os.fsync(wal_file.fileno())
+                    self._unsynced_entries = 0
+            self._wal_entries += len(lines)
+            self._known_ids.update(new_ids)
+            logger.info("📝 %d códigos registrados en el log del codebook (%d entradas pendientes de compactar)", len(lines), self._wal_entries)
+        except Exception as e:
+            logger.error("❌ Error al escribir en el log del codebook: %s", e)
+            raise
+
+    def needs_compaction(self) -> bool:
+        """
+        True si el log ha crecido lo suficiente como para consolidarlo en el JSON: al menos
+        `compact_every` entradas y el doble de códigos del codebook, para que el coste de
+        reescribirlo entero se reparta entre un número de cambios proporcional a su tamaño.
+        """
+        return self._wal_entries >= max(self.compact_every, 2 * len(self._known_ids))
+
+    def compact(self, codebook: Codebook) -> None:
+        """
+        Consolida el estado en memoria en el JSON completo y vacía el log. Debe llamarse
+        antes de que otros componentes lean el archivo del codebook directamente.
+        """
+        self.save(codebook)
+
+    @staticmethod
+    def _is_trusted(data: Any) -> bool:
+        """
+        True si el archivo lleva la marca de esquema de `save`. Un archivo editado a mano
+        o generado por otra versión no la lleva y se valida completo.
+        """
+        return isinstance(data, dict) and data.get("schema_version") == CODEBOOK_SCHEMA_VERSION
+
+    @staticmethod
+    def _construct_trusted(data: Dict[str, Any]) -> Codebook:
+        """
+        Construye el codebook sin pasar por la validación de Pydantic. `model_construct`
+        no es recursivo, así que los códigos anidados se construyen uno a uno.
+        """
+        return Codebook.model_construct(
+            codes=[Code.model_construct(**code) for code in data["codes"]],
+            metadata=data.get("metadata", {})
+        )
+
     def save(self, codebook: Codebook) -> None:
         """
         Guarda un objeto Codebook validado en el archivo JSON.
@@ -54,11 +308,24 @@ class CodebookRepository:
             codebook: El objeto Codebook a guardar.
         """
         try:
-            logger.info(f"💾 Guardando codebook en: {self.codebook_path}")
-            # Convertimos el modelo Pydantic a un diccionario antes de guardarlo.
-            data_to_save = codebook.model_dump(mode='json')
-            save_json_file(str(self.codebook_path), data_to_save)
-            logger.info(f"✅ Codebook guardado exitosamente con {len(codebook.codes)} códigos")
+            logger.info("💾 Guardando codebook en: %s", self.codebook_path)
+            # Los embeddings primero: si la escritura se interrumpe entre los dos archivos, el
+            # JSON anterior es un prefijo del nuevo y sus filas del `.npy` siguen alineadas
+            self._save_embeddings(codebook)
+            # Se escribe en streaming, un código por línea serializado directamente por Pydantic:
+            # ni el diccionario completo del codebook ni el documento entero pasan por memoria.
+            save_json_object_stream(
+                str(self.codebook_path),
+                "codes",
+                (_CODE_ADAPTER.dump_json(code, exclude={'embedding'}) for code in codebook.codes),
+                extra_fields={"metadata": codebook.metadata, "schema_version": CODEBOOK_SCHEMA_VERSION}
+            )
+            # El JSON recién escrito ya incluye todo lo registrado en el log
+            self.wal_path.unlink(missing_ok=True)
+            self._known_ids = {code.id for code in codebook.codes}
+            self._wal_entries = 0
+            self._unsynced_entries = 0
+            logger.info("✅ Codebook guardado exitosamente con %d códigos", len(codebook.codes))
         except Exception as e:
-            logger.error(f"❌ Error al guardar codebook: {e}")
+            logger.error("❌ Error al guardar codebook: %s", e)
             raise 
\ No newline at end of file
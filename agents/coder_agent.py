@@ -1,13 +1,39 @@
 import google.generativeai as genai
-import json
-from typing import Dict, Any, List, Union, Optional
-from pydantic import ValidationError
+import asyncio
+import hashlib
+import os
+import re
+import orjson
+from typing import Dict, Any, AsyncIterator, Iterator, List, Tuple, Union, Optional
+from pydantic import TypeAdapter, ValidationError
 import logging
-from tenacity import retry, stop_after_attempt, wait_exponential
+from tenacity import retry, stop_after_attempt, wait_random_exponential
 
 from models.data_models import CodingResult
 from services.llm_service import LLMService
-from utils.file_utils import extract_json_from_text
+from services.llm_response_cache import LLMResponseCache
+from services.semantic_response_cache import SemanticResponseCache
+from agents.embedding_client import EmbeddingClient, is_valid_embedding
+from utils.file_utils import extract_json_from_text, load_prompt_template
+from utils.prompt_template import CompiledPromptTemplate, compile_prompt_template
+
+# Usamos el mismo logger configurado para consistencia
+logger = logging.getLogger(__name__)
+
+# Valida de una sola pasada (en pydantic-core) la lista JSON devuelta para un lote
+_CODING_RESULT_LIST_ADAPTER = TypeAdapter(List[CodingResult])
+
+# Puntuación y espacios que no distinguen dos insights a efectos de deduplicación
+_PUNCTUATION_RE = re.compile(r"[^\w\s]+")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+# Reintentos de llamada + validación: backoff con jitter (4s..10s) para que los workers
+# concurrentes no reintenten todos a la vez. Los `Retry-After` del proveedor ya los atiende
+# `LLMService` (que captura sus errores), así que aquí no llegan.
+_CODING_RETRY_WAIT = wait_random_exponential(multiplier=1, min=4, max=10)
+
+# Resultado de codificar un insight: (insight, resultado, error); exactamente uno de los dos últimos es None
+CodingOutcome = Tuple[Dict[str, Any], Optional[CodingResult], Optional[Exception]]
 
 class CoderAgent:
     """
@@ -89,43 +115,198 @@ VERIFICAR FORMATO FINAL: ¿La salida que voy a producir es un único objeto JSON
 <output_del_modelo>
 """
 
-    def __init__(self, llm_service: LLMService, prompt_template_path: str = 'prompts/open_coding.md'):
+    def __init__(self,
+                 llm_service: LLMService,
+                 prompt_template_path: str = 'prompts/open_coding.md',
+                 batch_prompt_template_path: str = 'prompts/open_coding_batch.md',
+                 batch_size: int = 1,
+                 prompt_caching: bool = False,
+                 cache_enabled: bool = True,
+                 cache_dir: str = 'data/open_coding.llmcache',
+                 embedding_client: Optional[EmbeddingClient] = None,
+                 semantic_cache_threshold: float = 0.95):
         """
         Inicializa el CoderAgent con sus dependencias.
 
         Args:
             llm_service: Una instancia de un servicio para interactuar con el LLM.
             prompt_template_path: La ruta al archivo de plantilla del prompt.
+            batch_prompt_template_path: Plantilla para codificar varios insights en una
+                sola llamada (`generate_codes_batched`); se carga al primer uso.
+            batch_size: Insights por llamada al LLM por defecto en `generate_codes_batched`
+                y `generate_codes_batch` (1 = un prompt por insight).
+            prompt_caching: Si es True, la parte fija de la plantilla (todo lo anterior a
+                `{json_input}`: persona, reglas y ejemplo) se envía como mensaje de sistema
+                cacheable por el proveedor y solo el insight va en el mensaje de usuario
+                (si el prefijo no alcanza el mínimo de la caché del modelo, se envía completo).
+            cache_enabled: Si es True, las respuestas válidas del LLM se guardan en disco
+                (`cache_dir`) y una nueva ejecución con el mismo prompt no vuelve a llamar
+                al LLM. La clave es el hash del prompt completo (plantilla incluida), el
+                modelo y la temperatura, así que editar la plantilla invalida la caché.
+                Además, los códigos se guardan por texto del insight: un fragmento idéntico
+                con otro ID reutiliza el resultado sin llamar al LLM.
+            embedding_client: Si se proporciona (y la caché está activa), se activa también
+                la caché semántica: un insight cuyo embedding tenga similitud coseno
+                >= `semantic_cache_threshold` con uno ya codificado reutiliza sus códigos.
         """
-        self.logger = logging.getLogger(__name__)
         self.llm_service = llm_service
         self.prompt_template_path = prompt_template_path
-        self._prompt_template: Optional[str] = None # Para carga perezosa (lazy loading)
+        self.batch_prompt_template_path = batch_prompt_template_path
+        self.batch_size = max(1, batch_size)
+        self.prompt_caching = prompt_caching
+        self._cache = LLMResponseCache(cache_dir) if cache_enabled else None
+        self.embedding_client = embedding_client
+        # Embeddings calculados para insights aún sin resultado, por texto (se guardan al codificarlos)
+        self._pending_vectors: Dict[str, List[float]] = {}
+        # Plantilla compilada al crear el agente (falla pronto si el archivo no existe).
+        # Lectura y compilación están memorizadas a nivel de proceso, así que varias
+        # instancias con la misma ruta comparten el mismo objeto.
+        self._prompt_template = compile_prompt_template(self._load_prompt_template())
+        # Versión del prompt para las cachés por texto: cambiar la plantilla las invalida
+        self._prompt_version = hashlib.blake2b(self._prompt_template.template.encode('utf-8'), digest_size=16).hexdigest()
+        self._semantic_cache: Optional[SemanticResponseCache] = None
+        if cache_enabled and embedding_client is not None:
+            self._semantic_cache = SemanticResponseCache(
+                os.path.join(cache_dir, 'semantic_index.jsonl'),
+                namespace=f"{llm_service.model}|{llm_service.temperature!r}|{self._prompt_version}|{embedding_client.model_name}",
+                threshold=semantic_cache_threshold
+            )
 
     def _load_prompt_template(self) -> str:
         """
-        Carga la plantilla de prompt desde el archivo .md, usando un sistema de caché simple.
+        Carga la plantilla de prompt desde el archivo .md. La lectura la memoriza
+        `load_prompt_template` por (ruta, mtime), así que editar el archivo la recarga.
         """
-        if self._prompt_template is None:
-            try:
-                with open(self.prompt_template_path, 'r', encoding='utf-8') as f:
-                    self._prompt_template = f.read()
-            except FileNotFoundError:
-                self.logger.error(f"Archivo de plantilla de prompt no encontrado en: {self.prompt_template_path}")
-                raise
-        return self._prompt_template
-
-    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
-    def generate_codes(self, insight: Dict[str, Any]) -> CodingResult:
+        try:
+            return load_prompt_template(self.prompt_template_path)
+        except FileNotFoundError:
+            logger.error("Archivo de plantilla de prompt no encontrado en: %s", self.prompt_template_path)
+            raise
+
+    def _get_cached_response(self, prompt: bytes) -> Optional[str]:
+        """Devuelve la respuesta cacheada para el prompt, o None si no hay caché o no existe."""
+        if self._cache is None:
+            return None
+        return self._cache.get(prompt, self.llm_service.model, self.llm_service.temperature)
+
+    def _cache_response(self, prompt: bytes, llm_response_text: str) -> None:
+        """Guarda en la caché una respuesta ya validada."""
+        if self._cache is not None:
+            self._cache.put(prompt, self.llm_service.model, self.llm_service.temperature, llm_response_text)
+
+    def _text_cache_key(self, insight: Dict[str, Any]) -> bytes:
+        """Clave de la caché por texto: versión del prompt + texto del insight (sin su ID)."""
+        return f"texto\x00{self._prompt_version}\x00{insight.get('text') or ''}".encode('utf-8')
+
+    @staticmethod
+    def _canonicalize(text: str) -> str:
+        """Forma canónica de un texto para deduplicar: sin mayúsculas, puntuación ni espacios repetidos."""
+        return _WHITESPACE_RE.sub(' ', _PUNCTUATION_RE.sub(' ', text.casefold())).strip()
+
+    def _deduplicate(self, insights: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], Dict[int, List[Dict[str, Any]]]]:
         """
-        Genera códigos para un único insight y devuelve un objeto validado.
+        Agrupa los insights cuyo texto canónico coincide. Devuelve un representante por
+        grupo (en orden de aparición) y, por `id()` del representante, sus duplicados.
+        """
+        groups: Dict[bytes, List[Dict[str, Any]]] = {}
+        for insight in insights:
+            canon = self._canonicalize(insight.get("text") or '')
+            groups.setdefault(hashlib.blake2b(canon.encode('utf-8'), digest_size=16).digest(), []).append(insight)
+        representatives = [group[0] for group in groups.values()]
+        duplicates = {id(group[0]): group[1:] for group in groups.values() if len(group) > 1}
+        if duplicates:
+            logger.info("Deduplicación: %d insights únicos de %d (%.0f%% ahorrado).",
+                        len(representatives), len(insights), 100 * (1 - len(representatives) / len(insights)))
+        return representatives, duplicates
 
-        Args:
-            insight: Un diccionario que representa un insight, debe contener 'id' y 'text'.
+    def _fan_out(self, outcome: CodingOutcome, duplicates: Dict[int, List[Dict[str, Any]]]) -> List[CodingOutcome]:
+        """Extiende el resultado de un representante a sus duplicados, con su propio ID y texto."""
+        insight, coding_result, error = outcome
+        outcomes = [outcome]
+        for duplicate in duplicates.get(id(insight), ()):
+            if coding_result is None:
+                outcomes.append((duplicate, None, error))
+            else:
+                outcomes.append((duplicate, coding_result.model_copy(update={
+                    'id_fragmento': str(duplicate.get("id")),
+                    'fragmento_original': duplicate.get("text") or '',
+                }), None))
+        return outcomes
 
-        Returns:
-            Un objeto CodingResult validado.
+    def _result_from_codes(self, insight: Dict[str, Any], codes_json: str) -> CodingResult:
+        """Reconstruye el resultado de un insight a partir de códigos reutilizados de otro."""
+        return CodingResult(
+            id_fragmento=str(insight.get("id")),
+            fragmento_original=insight.get("text") or '',
+            codigos_abiertos=orjson.loads(codes_json)
+        )
+
+    def _embed_pending(self, insights: List[Dict[str, Any]]) -> None:
+        """Calcula en una sola llamada los embeddings que falten para los textos de `insights`."""
+        texts = list(dict.fromkeys(
+            text for text in (insight.get("text") for insight in insights)
+            if isinstance(text, str) and text.strip() and text not in self._pending_vectors
+        ))
+        if not texts:
+            return
+        try:
+            vectors = self.embedding_client.get_embeddings(texts)
+        except Exception as e:
+            logger.warning("No se pudieron calcular embeddings para la caché semántica: %s", e)
+            return
+        for text, vector in zip(texts, vectors):
+            if is_valid_embedding(vector):
+                self._pending_vectors[text] = vector
+
+    def _reuse_results(self, insights: List[Dict[str, Any]]) -> Tuple[List[CodingOutcome], List[Dict[str, Any]]]:
+        """
+        Busca resultados reutilizables sin llamar al LLM: primero por texto exacto y, si
+        está activa, en la caché semántica. Devuelve los resultados encontrados y los
+        insights que siguen pendientes.
         """
+        if self._cache is None:
+            return [], insights
+        outcomes: List[CodingOutcome] = []
+        remaining: List[Dict[str, Any]] = []
+        for insight in insights:
+            codes_json = self._cache.get(self._text_cache_key(insight), self.llm_service.model, self.llm_service.temperature)
+            if codes_json is None:
+                remaining.append(insight)
+            else:
+                outcomes.append((insight, self._result_from_codes(insight, codes_json), None))
+        if self._semantic_cache is not None and remaining:
+            self._embed_pending(remaining)
+            still_pending: List[Dict[str, Any]] = []
+            for insight in remaining:
+                vector = self._pending_vectors.get(insight.get("text"))
+                codes_json = self._semantic_cache.get(vector) if vector is not None else None
+                if codes_json is None:
+                    still_pending.append(insight)
+                else:
+                    outcomes.append((insight, self._result_from_codes(insight, codes_json), None))
+            remaining = still_pending
+        if outcomes:
+            logger.info("%d insights reutilizan códigos de la caché por texto/semántica.", len(outcomes))
+        return outcomes, remaining
+
+    async def _areuse_results(self, insights: List[Dict[str, Any]]) -> Tuple[List[CodingOutcome], List[Dict[str, Any]]]:
+        """Versión asíncrona de `_reuse_results` (los embeddings se piden en un hilo aparte)."""
+        if self._semantic_cache is None:
+            return self._reuse_results(insights)
+        return await asyncio.to_thread(self._reuse_results, insights)
+
+    def _remember_result(self, insight: Dict[str, Any], coding_result: CodingResult) -> None:
+        """Guarda los códigos de un resultado válido en las cachés por texto y semántica."""
+        if self._cache is None or coding_result.error:
+            return
+        codes_json = orjson.dumps(coding_result.codigos_abiertos).decode('utf-8')
+        self._cache.put(self._text_cache_key(insight), self.llm_service.model, self.llm_service.temperature, codes_json)
+        vector = self._pending_vectors.pop(insight.get("text"), None)
+        if self._semantic_cache is not None and vector is not None:
+            self._semantic_cache.put(vector, codes_json)
+
+    def _build_prompt(self, insight: Dict[str, Any]) -> bytes:
+        """Construye el prompt de codificación (en UTF-8) para un insight."""
         # 1. Transformar el insight al formato esperado por el prompt.
         # El prompt espera 'id_fragmento' y 'fragmento_original'.
         insight_for_prompt = {
@@ -133,20 +314,87 @@ VERIFICAR FORMATO FINAL: ¿La salida que voy a producir es un único objeto JSON
             "fragmento_original": insight.get("text"),
             "codigos_abiertos": []
         }
-        json_input_str = json.dumps(insight_for_prompt, indent=2, ensure_ascii=False)
+        # orjson serializa directamente a UTF-8 (sin escapar no-ASCII), listo para el prompt en bytes.
+        # JSON compacto: la indentación solo suma tokens de entrada y el modelo no la necesita
+        # (el ejemplo de la plantilla sí va indentado, por legibilidad).
+        json_input = orjson.dumps(insight_for_prompt)
+
+        # 2. Rellenar la plantilla (compilada una sola vez en segmentos) con el JSON.
+        # Solo se concatenan el prefijo estático, el JSON y el sufijo, sin pasar por `str.format`.
+        return self._prompt_template.render_bytes(json_input=json_input)
+
+    def _batch_prompt_template(self) -> CompiledPromptTemplate:
+        """Plantilla de lote compilada (memorizada por ruta y mtime, compilada una vez por proceso)."""
+        return compile_prompt_template(load_prompt_template(self.batch_prompt_template_path))
+
+    def _build_batch_prompt(self, insights: List[Dict[str, Any]]) -> bytes:
+        """Construye un único prompt (en UTF-8) con la lista de insights a codificar."""
+        insights_for_prompt = [
+            {"id_fragmento": insight.get("id"), "fragmento_original": insight.get("text"), "codigos_abiertos": []}
+            for insight in insights
+        ]
+        return self._batch_prompt_template().render_bytes(json_input=orjson.dumps(insights_for_prompt))
+
+    def _llm_prompt_args(self, prompt: bytes, template: CompiledPromptTemplate) -> Dict[str, bytes]:
+        """
+        Argumentos de prompt para el LLMService. Con `prompt_caching`, el prefijo fijo de la
+        plantilla se separa como `system_prompt` (cacheable) y el resto va como prompt, solo
+        si alcanza el tamaño mínimo que el proveedor acepta en su caché de contexto.
+        El prompt completo sigue siendo la clave de la caché en disco.
+        """
+        static_prefix = template.static_prefix
+        if not self.prompt_caching or not static_prefix or not prompt.startswith(static_prefix):
+            return {"prompt": prompt}
+        if not self.llm_service.supports_prefix_caching(static_prefix):
+            return {"prompt": prompt}
+        return {"prompt": prompt[len(static_prefix):], "system_prompt": static_prefix}
+
+    def _parse_batch_response(self, llm_response_text: Optional[str]) -> Dict[str, CodingResult]:
+        """
+        Valida cada elemento de la lista devuelta para un lote, indexado por `id_fragmento`.
+        Los elementos inválidos se descartan (sus insights se recodifican individualmente).
+        """
+        stripped_response = llm_response_text.strip() if llm_response_text else ''
+        if stripped_response.startswith('['):
+            # Camino rápido: lista JSON pura y válida, parseada y validada en una sola pasada
+            try:
+                coding_results = _CODING_RESULT_LIST_ADAPTER.validate_json(stripped_response)
+                return {coding_result.id_fragmento: coding_result for coding_result in reversed(coding_results)}
+            except ValidationError:
+                pass  # Texto alrededor o algún elemento inválido: se valida elemento a elemento
+
+        json_output = extract_json_from_text(llm_response_text) if llm_response_text else None
+        if not isinstance(json_output, list):
+            logger.warning("La respuesta del lote no es una lista JSON; se codificará cada insight por separado.")
+            return {}
+        results: Dict[str, CodingResult] = {}
+        for item in json_output:
+            try:
+                coding_result = CodingResult.model_validate(item)
+            except ValidationError as e:
+                logger.warning("Elemento inválido en la respuesta del lote; se descarta: %s", e)
+                continue
+            results.setdefault(coding_result.id_fragmento, coding_result)
+        return results
 
-        # 2. Cargar la plantilla y rellenarla con el string JSON.
-        prompt_template = self._load_prompt_template()
-        final_prompt = prompt_template.format(json_input=json_input_str)
-        
+    def _parse_response(self, insight: Dict[str, Any], final_prompt: bytes, llm_response_text: Optional[str]) -> CodingResult:
+        """Extrae y valida el resultado de codificación de la respuesta del LLM."""
         try:
-            # 3. Llamar a la API a través del servicio centralizado.
-            llm_response_text = self.llm_service.invoke_llm(final_prompt)
-            
-            # 4. Usar nuestra utilidad experta para extraer y parsear el JSON de la respuesta.
             if not llm_response_text:
                 raise ValueError("La respuesta del LLM estaba vacía.")
 
+            stripped_response = llm_response_text.strip()
+            if stripped_response.startswith('{'):
+                # Camino rápido para JSON puro: parseo y validación en una sola pasada
+                # de pydantic-core, sin construir los dicts intermedios en Python.
+                try:
+                    return CodingResult.model_validate_json(stripped_response)
+                except ValidationError as e:
+                    if not any(error['type'] == 'json_invalid' for error in e.errors()):
+                        raise
+                    # No es JSON puro (p. ej. texto alrededor): se intenta extraer abajo
+
+            # 4. Usar nuestra utilidad experta para extraer y parsear el JSON de la respuesta.
             json_output = extract_json_from_text(llm_response_text)
             
             if not json_output:
@@ -155,7 +403,7 @@ VERIFICAR FORMATO FINAL: ¿La salida que voy a producir es un único objeto JSON
                 print(f"DEBUG: REPORTE DE FALLO DE PARSEO PARA INSIGHT ID: {insight.get('id')}")
                 print("="*80)
                 print("\n[PROMPT ENVIADO AL MODELO]\n")
-                print(final_prompt)
+                print(final_prompt.decode('utf-8'))
                 print("\n" + "-"*80 + "\n")
                 print("[RESPUESTA CRUDA RECIBIDA DEL MODELO]\n")
                 print(llm_response_text)
@@ -170,11 +418,182 @@ VERIFICAR FORMATO FINAL: ¿La salida que voy a producir es un único objeto JSON
             return validated_output
 
         except (ValueError, ValidationError) as e:
-            self.logger.error(f"Error fatal de validación/parseo para el insight {insight.get('id')}: {e}.")
+            logger.error("Error fatal de validación/parseo para el insight %s: %s.", insight.get('id'), e)
             # Relanzamos la excepción para detener la ejecución (lógica Fail-Fast).
             # El reporte de depuración con print() ya se mostró antes de este punto.
             raise e
             
         except Exception as e:
-            self.logger.error(f"Error inesperado al procesar el insight {insight.get('id')}: {e}")
+            logger.error("Error inesperado al procesar el insight %s: %s", insight.get('id'), e)
             raise e
+
+    @retry(stop=stop_after_attempt(3), wait=_CODING_RETRY_WAIT)
+    def _invoke_and_parse(self, insight: Dict[str, Any], final_prompt: bytes) -> CodingResult:
+        """
+        Llama al LLM y valida la respuesta. Es lo único que se reintenta: el prompt se
+        construye una sola vez en `generate_codes` y se reutiliza en cada intento.
+        """
+        # 3. Llamar a la API a través del servicio centralizado.
+        llm_response_text = self.llm_service.invoke_llm(**self._llm_prompt_args(final_prompt, self._prompt_template))
+        coding_result = self._parse_response(insight, final_prompt, llm_response_text)
+        # Solo se cachean respuestas que superaron la validación
+        self._cache_response(final_prompt, llm_response_text)
+        self._remember_result(insight, coding_result)
+        return coding_result
+
+    @retry(stop=stop_after_attempt(3), wait=_CODING_RETRY_WAIT)
+    async def _ainvoke_and_parse(self, insight: Dict[str, Any], final_prompt: bytes) -> CodingResult:
+        """Versión asíncrona de `_invoke_and_parse`."""
+        llm_response_text = await self.llm_service.ainvoke_llm(**self._llm_prompt_args(final_prompt, self._prompt_template))
+        coding_result = self._parse_response(insight, final_prompt, llm_response_text)
+        # La escritura en la caché se hace en un hilo para no bloquear el bucle de eventos
+        await asyncio.to_thread(self._cache_response, final_prompt, llm_response_text)
+        await asyncio.to_thread(self._remember_result, insight, coding_result)
+        return coding_result
+
+    def generate_codes(self, insight: Dict[str, Any]) -> CodingResult:
+        """
+        Genera códigos para un único insight y devuelve un objeto validado.
+
+        Args:
+            insight: Un diccionario que representa un insight, debe contener 'id' y 'text'.
+
+        Returns:
+            Un objeto CodingResult validado.
+        """
+        final_prompt = self._build_prompt(insight)
+        cached_response = self._get_cached_response(final_prompt)
+        if cached_response is not None:
+            logger.debug("Usando respuesta cacheada para el insight %s.", insight.get('id'))
+            return self._parse_response(insight, final_prompt, cached_response)
+        reused, _ = self._reuse_results([insight])
+        if reused:
+            return reused[0][1]
+        return self._invoke_and_parse(insight, final_prompt)
+
+    async def generate_codes_async(self, insight: Dict[str, Any]) -> CodingResult:
+        """Versión asíncrona de `generate_codes` (mismo prompt, validación y reintentos)."""
+        final_prompt = self._build_prompt(insight)
+        cached_response = self._get_cached_response(final_prompt)
+        if cached_response is not None:
+            logger.debug("Usando respuesta cacheada para el insight %s.", insight.get('id'))
+            return self._parse_response(insight, final_prompt, cached_response)
+        reused, _ = await self._areuse_results([insight])
+        if reused:
+            return reused[0][1]
+        return await self._ainvoke_and_parse(insight, final_prompt)
+
+    def _match_group_results(self,
+                             insights: List[Dict[str, Any]],
+                             results_by_id: Dict[str, CodingResult]) -> Tuple[List[CodingOutcome], List[Dict[str, Any]]]:
+        """Empareja cada insight con su resultado del lote; devuelve también los que quedaron sin resultado."""
+        outcomes: List[CodingOutcome] = []
+        missing: List[Dict[str, Any]] = []
+        for insight in insights:
+            coding_result = results_by_id.get(str(insight.get("id")))
+            if coding_result is None:
+                missing.append(insight)
+            else:
+                outcomes.append((insight, coding_result, None))
+        if missing:
+            logger.warning("%d de %d insights sin resultado válido en el lote; se codificarán por separado.", len(missing), len(insights))
+        return outcomes, missing
+
+    def generate_codes_group(self, insights: List[Dict[str, Any]]) -> List[CodingOutcome]:
+        """
+        Codifica varios insights en una única llamada al LLM, de modo que las reglas y el
+        ejemplo del prompt se envían una vez por lote y no una vez por insight.
+
+        Los insights que no aparecen (o no son válidos) en la respuesta se codifican con
+        `generate_codes`. Devuelve `(insight, resultado, error)` por cada insight.
+        """
+        outcomes, insights = self._reuse_results(insights)
+        if len(insights) <= 1:
+            missing = insights
+        else:
+            batch_prompt = self._build_batch_prompt(insights)
+            llm_response_text = self._get_cached_response(batch_prompt)
+            from_cache = llm_response_text is not None
+            if not from_cache:
+                llm_response_text = self.llm_service.invoke_llm(**self._llm_prompt_args(batch_prompt, self._batch_prompt_template()))
+            matched, missing = self._match_group_results(insights, self._parse_batch_response(llm_response_text))
+            if not missing and not from_cache:
+                # Solo se cachea un lote que cubrió todos sus insights
+                self._cache_response(batch_prompt, llm_response_text)
+            for insight, coding_result, _ in matched:
+                self._remember_result(insight, coding_result)
+            outcomes.extend(matched)
+        for insight in missing:
+            try:
+                outcomes.append((insight, self.generate_codes(insight), None))
+            except Exception as e:
+                outcomes.append((insight, None, e))
+        return outcomes
+
+    async def generate_codes_group_async(self, insights: List[Dict[str, Any]]) -> List[CodingOutcome]:
+        """Versión asíncrona de `generate_codes_group`."""
+        outcomes, insights = await self._areuse_results(insights)
+        if len(insights) <= 1:
+            missing = insights
+        else:
+            batch_prompt = self._build_batch_prompt(insights)
+            llm_response_text = self._get_cached_response(batch_prompt)
+            from_cache = llm_response_text is not None
+            if not from_cache:
+                llm_response_text = await self.llm_service.ainvoke_llm(**self._llm_prompt_args(batch_prompt, self._batch_prompt_template()))
+            matched, missing = self._match_group_results(insights, self._parse_batch_response(llm_response_text))
+            if not missing and not from_cache:
+                await asyncio.to_thread(self._cache_response, batch_prompt, llm_response_text)
+            for insight, coding_result, _ in matched:
+                await asyncio.to_thread(self._remember_result, insight, coding_result)
+            outcomes.extend(matched)
+        for insight in missing:
+            try:
+                outcomes.append((insight, await self.generate_codes_async(insight), None))
+            except Exception as e:
+                outcomes.append((insight, None, e))
+        return outcomes
+
+    def generate_codes_batched(self, insights: List[Dict[str, Any]], batch_size: Optional[int] = None) -> Iterator[CodingOutcome]:
+        """
+        Codifica los insights secuencialmente en lotes de hasta `batch_size` por llamada
+        (por defecto, el `batch_size` del agente).
+        Produce `(insight, resultado, error)` a medida que termina cada lote. Los insights
+        con el mismo texto canónico se codifican una sola vez.
+        """
+        batch_size = max(1, batch_size or self.batch_size)
+        insights, duplicates = self._deduplicate(insights)
+        for start in range(0, len(insights), batch_size):
+            for outcome in self.generate_codes_group(insights[start:start + batch_size]):
+                yield from self._fan_out(outcome, duplicates)
+
+    async def generate_codes_batch(self,
+                                   insights: List[Dict[str, Any]],
+                                   concurrency: int = 16,
+                                   batch_size: Optional[int] = None) -> AsyncIterator[CodingOutcome]:
+        """
+        Codifica varios insights con hasta `concurrency` llamadas al LLM en vuelo,
+        agrupando hasta `batch_size` insights por llamada (por defecto, el `batch_size` del agente).
+
+        Produce `(insight, resultado, error)` en orden de llegada: exactamente uno de
+        `resultado` y `error` es None, así que un fallo no detiene el resto del lote.
+        El semáforo acota también la memoria: nunca hay más de `concurrency` prompts
+        construidos a la vez. Los insights con el mismo texto canónico se codifican una sola vez.
+        """
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+        batch_size = max(1, batch_size or self.batch_size)
+        insights, duplicates = self._deduplicate(insights)
+
+        async def code_group(group: List[Dict[str, Any]]) -> List[CodingOutcome]:
+            async with semaphore:
+                try:
+                    return await self.generate_codes_group_async(group)
+                except Exception as e:
+                    return [(insight, None, e) for insight in group]
+
+        groups = [insights[start:start + batch_size] for start in range(0, len(insights), batch_size)]
+        tasks = [asyncio.ensure_future(code_group(group)) for group in groups]
+        for next_result in asyncio.as_completed(tasks):
+            for outcome in await next_result:
+                for fanned_out in self._fan_out(outcome, duplicates):
+                    yield fanned_out
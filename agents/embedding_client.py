@@ -1,12 +1,17 @@
 # agents/embedding_client.py
 
 import logging
-import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Optional
 
-import google.generativeai as genai
+import httpx
+import numpy as np
+import orjson
 from google.api_core import exceptions as google_exceptions
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
+from tenacity import retry, stop_after_attempt, retry_if_exception_type
+
+from services.embedding_cache import EmbeddingCache
+from utils.retry_utils import wait_retry_after
 
 # --- Configuración de Logging Estructurado ---
 # Reemplaza los 'print' por un sistema de logging real.
@@ -20,8 +25,23 @@ RETRYABLE_EXCEPTIONS = (
     google_exceptions.InternalServerError,   # Error 500 del servidor de Google
     google_exceptions.TooManyRequests,       # Error 429 por límite de velocidad
     google_exceptions.ServiceUnavailable,    # Error 503 por mantenimiento o sobrecarga
+    google_exceptions.DeadlineExceeded,      # Error 504 / la petición superó el tiempo límite
+    httpx.TransportError,                    # Timeouts y cortes de red al hablar con la API
 )
 
+# Endpoint REST de la API de Gemini; el modelo va en la ruta (`models/...:batchEmbedContents`)
+API_BASE_URL = "https://generativelanguage.googleapis.com/v1beta/"
+
+# Tipo de tarea con el que se piden todos los embeddings (forma parte de la clave de caché)
+TASK_TYPE = "RETRIEVAL_DOCUMENT"
+
+def is_valid_embedding(embedding: Optional[np.ndarray]) -> bool:
+    """
+    Indica si una fila devuelta por `get_embeddings` es un embedding real: las fallidas son NaN,
+    y una fila con algún valor no finito (NaN parcial o desbordamiento de float16) tampoco sirve.
+    """
+    return embedding is not None and embedding.size > 0 and bool(np.isfinite(embedding).all())
+
 class EmbeddingClient:
     """
     Cliente de embeddings robusto y listo para producción.
@@ -30,9 +50,18 @@ class EmbeddingClient:
     - Logging estructurado para monitoreo.
     - Lógica de reintentos con backoff exponencial para errores de API.
     - Procesamiento por lotes (batching) para manejar grandes volúmenes de texto.
+    - Caché persistente en disco: un texto ya embebido no vuelve a pedirse a la API.
+    - Un único cliente HTTP con conexiones persistentes (sin estado global del SDK):
+      cada lote reutiliza la conexión TLS abierta en vez de negociar una nueva.
     - Manejo de errores específico y seguro.
     """
-    def __init__(self, api_key: str, model_name: str = 'models/embedding-001', batch_size: int = 100):
+    def __init__(self,
+                 api_key: str,
+                 model_name: str = 'models/embedding-001',
+                 batch_size: int = 100,
+                 cache_dir: Optional[str] = 'data/embeddings.llmcache',
+                 max_connections: int = 16,
+                 max_concurrency: int = 4):
         """
         Inicializa y configura el cliente de forma segura.
 
@@ -40,22 +69,34 @@ class EmbeddingClient:
             api_key (str): Tu clave API de Google AI. Se valida que no esté vacía.
             model_name (str): El modelo de embedding a utilizar.
             batch_size (int): El número máximo de textos a enviar en una sola llamada a la API.
+            cache_dir (Optional[str]): Directorio de la caché de embeddings; None la desactiva.
+            max_connections (int): Conexiones HTTP que el cliente mantiene abiertas como máximo.
+            max_concurrency (int): Lotes enviados a la API a la vez (1 = secuenciales).
         """
         if not isinstance(api_key, str) or len(api_key) < 10:
             logger.error("API Key inválida o ausente. Por favor, proporciona una clave válida.")
             raise ValueError("API Key inválida.")
             
         self.model_name = model_name
+        # La API admite como máximo 100 textos por llamada a `batchEmbedContents`
         self.batch_size = batch_size
+        self.max_concurrency = max(1, min(max_concurrency, max_connections))
+        self._cache = EmbeddingCache(cache_dir) if cache_dir else None
         
-        try:
-            genai.configure(api_key=api_key)
-            logger.info(f"Cliente de Embeddings configurado para el modelo: '{self.model_name}' con lotes de {self.batch_size}.")
-        except Exception as e:
-            logger.critical(f"Fallo crítico al configurar la API de Google AI: {e}")
-            raise
+        # La clave va en la cabecera de este cliente, no en la configuración global de `genai`
+        self._http = httpx.Client(
+            base_url=API_BASE_URL,
+            headers={"x-goog-api-key": api_key, "Content-Type": "application/json"},
+            timeout=30.0,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+        logger.info(f"Cliente de Embeddings configurado para el modelo: '{self.model_name}' con lotes de {self.batch_size}.")
 
-    def get_embeddings(self, texts: List[str]) -> List[Optional[List[float]]]:
+    def close(self) -> None:
+        """Cierra las conexiones HTTP abiertas del cliente."""
+        self._http.close()
+
+    def get_embeddings(self, texts: List[str]) -> np.ndarray:
         """
         Genera embeddings para una lista de textos, manejando lotes y errores.
 
@@ -63,38 +104,82 @@ class EmbeddingClient:
             texts (List[str]): Una lista de strings para generar embeddings.
         
         Returns:
-            List[Optional[List[float]]]: Una lista de vectores (embeddings). 
-                                          Retorna None para los textos que fallaron.
+            np.ndarray: Matriz `(N, D)` en `float16` con un vector normalizado (norma 1) por
+                        texto de entrada, en el mismo orden. Las filas de los textos que
+                        fallaron (o no eran válidos) son NaN; ver `is_valid_embedding`.
+                        Para productos escalares conviene pasar a `float32` antes.
         """
         # Validación de entrada
         if not texts:
-            return []
+            return np.empty((0, 0), dtype=np.float16)
         
-        valid_texts = [text for text in texts if isinstance(text, str) and text.strip()]
-        if len(valid_texts) != len(texts):
+        valid_indices = [idx for idx, text in enumerate(texts) if isinstance(text, str) and text.strip()]
+        if len(valid_indices) != len(texts):
             logger.warning("Algunos textos de entrada estaban vacíos o no eran strings y fueron omitidos.")
 
-        all_embeddings = []
-        # Implementación de Límite de Lote (batch_size)
-        for i in range(0, len(valid_texts), self.batch_size):
-            batch = valid_texts[i:i + self.batch_size]
-            logger.info(f"Procesando lote {i//self.batch_size + 1} con {len(batch)} textos.")
-            
-            # Llama al método interno que tiene la lógica de reintentos
-            batch_embeddings = self._embed_batch_with_retries(batch)
-            all_embeddings.extend(batch_embeddings)
-            
-            # Rate Limiting simple: Pausa breve entre lotes para ser un buen ciudadano de la API
-            if len(valid_texts) > self.batch_size:
-                time.sleep(1) # Pausa de 1 segundo
+        all_embeddings: List[Optional[np.ndarray]] = [None] * len(texts)
+        # Solo los textos que no están en la caché llegan a la API
+        missing = []
+        for idx in valid_indices:
+            cached = self._cache.get(texts[idx], self.model_name, TASK_TYPE) if self._cache else None
+            if cached is None:
+                missing.append(idx)
+            else:
+                all_embeddings[idx] = cached
+        if len(missing) < len(valid_indices):
+            logger.info(f"{len(valid_indices) - len(missing)} de {len(valid_indices)} embeddings recuperados de la caché.")
+
+        # Implementación de Límite de Lote (batch_size). Los lotes son independientes, así que
+        # se envían hasta `max_concurrency` a la vez sobre el mismo pool de conexiones.
+        batches = [missing[i:i + self.batch_size] for i in range(0, len(missing), self.batch_size)]
+        if len(batches) > 1 and self.max_concurrency > 1:
+            with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(batches))) as executor:
+                batch_results = list(executor.map(lambda indices: self._embed_indices(texts, indices), batches))
+        else:
+            batch_results = [self._embed_indices(texts, indices) for indices in batches]
+        for batch_indices, batch_embeddings in zip(batches, batch_results):
+            for idx, embedding in zip(batch_indices, batch_embeddings):
+                all_embeddings[idx] = embedding
+            # Sin pausa fija entre lotes: ante un 429 (TooManyRequests) el reintento con
+            # backoff de `_embed_batch_with_retries` ya frena el ritmo.
 
-        return all_embeddings
+        return self._to_matrix(all_embeddings)
+
+    def _embed_indices(self, texts: List[str], batch_indices: List[int]) -> List[Optional[np.ndarray]]:
+        """Embebe un lote (por índices de `texts`) y guarda en la caché los vectores obtenidos."""
+        batch = [texts[idx] for idx in batch_indices]
+        logger.info(f"Procesando lote de {len(batch)} textos.")
+        
+        # Llama al método interno que tiene la lógica de reintentos
+        results: List[Optional[np.ndarray]] = []
+        for text, embedding in zip(batch, self._embed_batch_with_retries(batch)):
+            if embedding is None:
+                results.append(None)
+                continue
+            vector = np.asarray(embedding, dtype=np.float32)
+            if self._cache:
+                self._cache.put(text, self.model_name, TASK_TYPE, vector)
+            results.append(vector)
+        return results
+
+    @staticmethod
+    def _to_matrix(embeddings: List[Optional[np.ndarray]]) -> np.ndarray:
+        """Apila los vectores en una matriz `float16` normalizada; los huecos quedan como filas NaN."""
+        dimension = next((embedding.shape[0] for embedding in embeddings if embedding is not None), 0)
+        matrix = np.full((len(embeddings), dimension), np.nan, dtype=np.float32)
+        for idx, embedding in enumerate(embeddings):
+            if embedding is not None and embedding.shape[0] == dimension:
+                matrix[idx] = embedding
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        # Un vector nulo no tiene dirección: se trata como fallido
+        norms[norms == 0] = np.nan
+        return (matrix / norms).astype(np.float16)
 
     @retry(
-        wait=wait_exponential(multiplier=1, min=2, max=60), # Espera 2s, 4s, 8s... hasta 60s
+        wait=wait_retry_after(), # Retry-After del servidor o backoff exponencial con jitter (1s..60s)
         stop=stop_after_attempt(5), # Reintenta un máximo de 5 veces
         retry=retry_if_exception_type(RETRYABLE_EXCEPTIONS), # Solo reintenta en errores específicos
-        before_sleep=lambda retry_state: logger.warning(f"Error de API, reintentando... Intento {retry_state.attempt_number}, esperando {retry_state.next_action.sleep}s.")
+        before_sleep=lambda retry_state: logger.warning(f"Error de API, reintentando... Intento {retry_state.attempt_number}, esperando {retry_state.next_action.sleep:.1f}s.")
     )
     def _embed_batch_with_retries(self, batch: List[str]) -> List[Optional[List[float]]]:
         """
@@ -102,24 +187,30 @@ class EmbeddingClient:
         con la lógica de reintentos de Tenacity.
         """
         try:
-            # Para cada texto en el lote, hacer una llamada individual
-            # Esto es necesario porque la API de Google no soporta lotes múltiples en una sola llamada
-            embeddings = []
-            for text in batch:
-                response = genai.embed_content(
-                    model=self.model_name,
-                    content=text,
-                    task_type="RETRIEVAL_DOCUMENT"
-                )
-                
-                # La respuesta es {'embedding': [valores...]}
-                if 'embedding' in response and response['embedding']:
-                    embeddings.append(response['embedding'])
+            # Una sola llamada `batchEmbedContents` para todo el lote; devuelve
+            # {'embeddings': [{'values': [...]}, {'values': [...]}, ...]} en el mismo orden
+            body = {"requests": [
+                {"model": self.model_name, "content": {"parts": [{"text": text}]}, "taskType": TASK_TYPE}
+                for text in batch
+            ]}
+            response = self._http.post(f"{self.model_name}:batchEmbedContents", content=orjson.dumps(body))
+            if response.is_error:
+                # Misma jerarquía de errores que el SDK (429 -> TooManyRequests, ...), con la
+                # respuesta adjunta para que el reintento pueda leer su `Retry-After`
+                raise google_exceptions.from_http_response(response)
+            embeddings = [item.get('values') for item in orjson.loads(response.content).get('embeddings') or []]
+            if not embeddings or len(embeddings) != len(batch):
+                logger.warning(f"Respuesta de embeddings inesperada para un lote de {len(batch)} textos; se descarta.")
+                return [None] * len(batch)
+
+            results: List[Optional[List[float]]] = []
+            for text, embedding in zip(batch, embeddings):
+                if embedding:
+                    results.append(embedding)
                 else:
                     logger.warning(f"No se pudo obtener embedding para el texto: '{text[:50]}...'")
-                    embeddings.append(None)
-                    
-            return embeddings
+                    results.append(None)
+            return results
             
         except RETRYABLE_EXCEPTIONS as e:
             logger.error(f"Error reintentable de API en lote: {e}")
@@ -1,14 +1,27 @@
 import os
-import json
-from typing import Dict, Any, List
+import mmap
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from collections import Counter
+from itertools import chain
+from typing import Dict, Any, List, Optional, Tuple
+
+import orjson
 
 from services.llm_service import LLMService
-from utils.file_utils import load_jsonl_file, append_to_jsonl_file, extract_json_from_text
+from utils.file_utils import load_jsonl_file, count_jsonl_records, write_jsonl_record, extract_json_from_text, load_prompt_template, JSONL_WRITE_BUFFER_SIZE
+from utils.prompt_template import compile_prompt_template
+
+# Token budget for the evidence part of the prompt, measured with the model's tokenizer.
+# E.g., for a 128k context model, keeping evidence under ~25k tokens is safe.
+EVIDENCE_TOKEN_LIMIT = 25000
+
+# Above this size the insights source is not loaded into a dict: only an id -> (offset, length)
+# index is kept, and referenced texts are parsed on demand from a memory-mapped file.
+INSIGHTS_INDEX_THRESHOLD_BYTES = 64 * 1024 * 1024
 
-# A reasonable heuristic: 1 token ~= 4 characters. 
-# Let's set a conservative limit for the evidence part of the prompt.
-# E.g., for a 128k context model, keeping evidence under 100k chars is safe.
-EVIDENCE_CHAR_LIMIT = 100000 
+def _dumps(obj: Any) -> str:
+    """Pretty-prints JSON for prompts with orjson (UTF-8, unescaped, 2-space indent)."""
+    return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode('utf-8')
 
 class NarratorAgent:
     """
@@ -16,25 +29,30 @@ class NarratorAgent:
     into a rich, dense narrative.
     """
 
-    def __init__(self, llm_service: LLMService):
+    def __init__(self, llm_service: LLMService, concurrency: int = 8):
         """
         Initializes the NarratorAgent.
 
         Args:
             llm_service: An instance of LLMService to interact with the language model.
+            concurrency: Maximum number of categories narrated in parallel (LLM calls in flight).
         """
         self.llm_service = llm_service
+        self.concurrency = concurrency
         self.narrative_prompt_template = self._load_prompt("prompts/narrate_category.md")
+        # Parsed once into literal segments; rendering is a plain join (no per-call format scan)
+        self._compiled_narrative_template = compile_prompt_template(self.narrative_prompt_template)
         self.insights_source_path = "data/data.jsonl"
         self.axial_analysis_path = "data/analisis_axial.jsonl"
         self.output_path = "data/narrativas_por_categoria.jsonl"
+        self._insights_mmap: Optional[mmap.mmap] = None
+        self._insights_offsets: Dict[str, Tuple[int, int]] = {}
         self.all_insights_map = self._get_all_insights_map()
 
     def _load_prompt(self, filepath: str) -> str:
-        """Loads a prompt template from a file."""
+        """Loads a prompt template from a file (memoized per path and mtime)."""
         try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                return f.read()
+            return load_prompt_template(filepath)
         except FileNotFoundError:
             print(f"Error: Prompt file not found at {filepath}")
             return ""
@@ -43,17 +61,63 @@ class NarratorAgent:
         """
         Loads the raw insights from the .jsonl source file and creates a mapping 
         from insight ID to its text for quick lookup.
+
+        Large sources (see INSIGHTS_INDEX_THRESHOLD_BYTES) are indexed instead and
+        this returns an empty dict; use `_lookup_insight_text` for lookups.
         """
         insights_map = {}
         try:
+            if os.path.getsize(self.insights_source_path) > INSIGHTS_INDEX_THRESHOLD_BYTES:
+                self._build_insights_index()
+                return insights_map
             for insight in load_jsonl_file(self.insights_source_path):
                 if "id" in insight and "text" in insight:
                     insights_map[insight["id"]] = insight["text"]
             return insights_map
         except Exception as e:
             print(f"Error reading insights source file at {self.insights_source_path}: {e}")
+            # A partially built index would silently miss every insight after the bad line
+            self._close_insights_index()
             return {}
 
+    def _build_insights_index(self):
+        """
+        Scans the memory-mapped source once, recording where each insight's line starts
+        and ends. Texts are not kept; memory grows with the number of ids, not their size.
+        """
+        with open(self.insights_source_path, 'rb') as f:
+            self._insights_mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        mm = self._insights_mmap
+        offset, size = 0, len(mm)
+        while offset < size:
+            line_end = mm.find(b'\n', offset)
+            if line_end == -1:
+                line_end = size
+            line = mm[offset:line_end]
+            if line.strip():
+                insight = orjson.loads(line)
+                if "id" in insight and "text" in insight:
+                    self._insights_offsets[insight["id"]] = (offset, line_end - offset)
+            offset = line_end + 1
+        print(f"Indexed {len(self._insights_offsets)} insights from {self.insights_source_path} (loaded on demand).")
+
+    def _close_insights_index(self):
+        """Unmaps the indexed source (if any) and drops its offsets."""
+        if self._insights_mmap is not None:
+            self._insights_mmap.close()
+            self._insights_mmap = None
+        self._insights_offsets = {}
+
+    def _lookup_insight_text(self, insight_id: str) -> Optional[str]:
+        """Returns the text of an insight, parsing it from the mapped file if the source was indexed."""
+        if self._insights_mmap is None:
+            return self.all_insights_map.get(insight_id)
+        location = self._insights_offsets.get(insight_id)
+        if location is None:
+            return None
+        offset, length = location
+        return orjson.loads(self._insights_mmap[offset:offset + length]).get("text")
+
     def run(self):
         """
         Executes the narrative generation process for all categories.
@@ -61,57 +125,75 @@ class NarratorAgent:
         generates the narrative using the LLM, and saves the results.
         """
         print("Starting narrative generation process...")
-        
+        # The index is released at the end of each run; a later run maps the source again
+        if self._insights_mmap is None and not self.all_insights_map:
+            self.all_insights_map = self._get_all_insights_map()
+        try:
+            self._run()
+        finally:
+            self._close_insights_index()
+
+    def _run(self):
+        """Body of `run`; the caller releases the insights index when it returns."""
+        # Categories are streamed from the file instead of loaded up front; counting the
+        # lines (without parsing them) is enough for the progress display.
         try:
-            axial_data = list(load_jsonl_file(self.axial_analysis_path))
+            total_categories = count_jsonl_records(self.axial_analysis_path)
         except Exception as e:
             print(f"Error: Could not read axial analysis file from {self.axial_analysis_path}: {e}")
             return
+        axial_data = load_jsonl_file(self.axial_analysis_path)
+        # Bounded in-flight window: only a couple of categories per worker are parsed and
+        # queued at any time, so memory does not grow with the size of the axial analysis.
+        max_in_flight = 2 * max(1, self.concurrency)
 
         narratives = []
         failed_categories = []
         
-        # Clear the output file before starting
-        with open(self.output_path, 'w') as f:
-            f.write('')
-
-        for i, category_data in enumerate(axial_data):
-            category_name = category_data.get("category_name", "N/A")
-            category_id = category_data.get("category_id")
-            print(f"Processing category {i+1}/{len(axial_data)}: {category_name}")
-
-            try:
-                evidence_map = self._get_evidence_for_category(category_data)
-                prompt = self._prepare_narrative_prompt(category_data, evidence_map)
-                
-                # 1. Llamar a la API a través del servicio centralizado.
-                llm_response_text = self.llm_service.invoke_llm(prompt)
-
-                if not llm_response_text:
-                    raise ValueError("La respuesta del LLM estaba vacía.")
-
-                # 2. Usar nuestra utilidad experta para extraer y parsear el JSON de la respuesta.
-                structured_response = extract_json_from_text(llm_response_text)
-                
-                if not structured_response:
-                    print(f"DEBUG: Fallo de parseo de JSON para la categoría: {category_name}")
-                    raise ValueError("No se pudo extraer un JSON válido de la respuesta del LLM.")
-
-                if "narrative_blocks" in structured_response:
-                    narrative_output = {
-                        "category_id": category_id,
-                        "category_name": category_name,
-                        "narrative_blocks": structured_response["narrative_blocks"]
-                    }
-                    append_to_jsonl_file(self.output_path, narrative_output)
-                    narratives.append(narrative_output)
-                else:
-                    print(f"  [Warning] 'narrative_blocks' not found in LLM response for {category_name}.")
-                    failed_categories.append(f"{category_name} (ID: {category_id}) - Malformed response")
+        # LLM calls are I/O-bound, so several categories are narrated at once. Results are
+        # written from this thread only, in completion order, over a single handle opened
+        # (and truncated) once for the whole run, so no lock is needed.
+        with open(self.output_path, 'wb', buffering=JSONL_WRITE_BUFFER_SIZE) as output_file, \
+                ThreadPoolExecutor(max_workers=max(1, self.concurrency)) as executor:
+            futures = {}
+            done = 0
+            exhausted = False
+            while True:
+                while not exhausted and len(futures) < max_in_flight:
+                    try:
+                        category_data = next(axial_data)
+                    except StopIteration:
+                        exhausted = True
+                    except Exception as e:
+                        print(f"Error: Could not read axial analysis file from {self.axial_analysis_path}: {e}")
+                        exhausted = True
+                    else:
+                        futures[executor.submit(self._process_one_category, category_data)] = category_data
+                if not futures:
+                    break
 
-            except Exception as e:
-                print(f"  [Error] Failed to process category {category_name}: {e}")
-                failed_categories.append(f"{category_name} (ID: {category_id}) - {e}")
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    category_data = futures.pop(future)
+                    category_name = category_data.get("category_name", "N/A")
+                    category_id = category_data.get("category_id")
+                    done += 1
+                    print(f"Finished category {done}/{total_categories}: {category_name}")
+                    try:
+                        narrative_output = future.result()
+                    except Exception as e:
+                        print(f"  [Error] Failed to process category {category_name}: {e}")
+                        failed_categories.append(f"{category_name} (ID: {category_id}) - {e}")
+                        continue
+
+                    if narrative_output is None:
+                        print(f"  [Warning] 'narrative_blocks' not found in LLM response for {category_name}.")
+                        failed_categories.append(f"{category_name} (ID: {category_id}) - Malformed response")
+                        continue
+                    write_jsonl_record(output_file, narrative_output)
+                    # One write per narrative: an interrupted run keeps every completed one
+                    output_file.flush()
+                    narratives.append(narrative_output)
 
         print("\n--- Narrative Generation Summary ---")
         print(f"Successfully generated narratives for {len(narratives)} categories.")
@@ -122,34 +204,64 @@ class NarratorAgent:
         print(f"Results saved to {self.output_path}")
         print("------------------------------------")
 
-    def _get_evidence_for_category(self, category_analysis: Dict[str, Any]) -> Dict[str, str]:
+    def _process_one_category(self, category_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """
-        Gathers all unique insight verbatim texts for a given category's analysis.
+        Generates the narrative for a single category. Runs in a worker thread.
+
+        Returns:
+            The narrative record, or None if the LLM response has no 'narrative_blocks'.
+            Raises on empty or unparseable responses.
+        """
+        category_name = category_data.get("category_name", "N/A")
+        evidence_map = self._trim_evidence_to_budget(category_data, self._get_evidence_for_category(category_data))
+        prompt = self._prepare_narrative_prompt(category_data, evidence_map)
+
+        # 1. Llamar a la API a través del servicio centralizado.
+        llm_response_text = self.llm_service.invoke_llm(prompt)
+
+        if not llm_response_text:
+            raise ValueError("La respuesta del LLM estaba vacía.")
+
+        # 2. Usar nuestra utilidad experta para extraer y parsear el JSON de la respuesta.
+        structured_response = extract_json_from_text(llm_response_text)
+
+        if not structured_response:
+            print(f"DEBUG: Fallo de parseo de JSON para la categoría: {category_name}")
+            raise ValueError("No se pudo extraer un JSON válido de la respuesta del LLM.")
+
+        if "narrative_blocks" not in structured_response:
+            return None
+        return {
+            "category_id": category_data.get("category_id"),
+            "category_name": category_name,
+            "narrative_blocks": structured_response["narrative_blocks"]
+        }
+
+    def _count_evidence_citations(self, category_analysis: Dict[str, Any]) -> Counter:
+        """
+        Counts how many times each insight is cited across the category's paradigm model
+        and properties, in first-citation order.
         """
-        referenced_ids = set()
         analysis = category_analysis.get("analysis", {})
+        paradigm_model = analysis.get("paradigm_model") or {}
+        properties = analysis.get("properties_and_dimensions") or []
 
-        # Extract from paradigm model
-        paradigm_model = analysis.get("paradigm_model", {})
-        if paradigm_model:
-            for component in paradigm_model.values():
-                if isinstance(component, list):
-                    for item in component:
-                        if isinstance(item, dict):
-                            for insight_id in item.get("evidence_insight_ids", []):
-                                referenced_ids.add(insight_id)
-
-        # Extract from properties and dimensions
-        properties = analysis.get("properties_and_dimensions", [])
-        if properties:
-            for prop in properties:
-                if isinstance(prop, dict):
-                    for insight_id in prop.get("evidence_insight_ids", []):
-                        referenced_ids.add(insight_id)
-        
+        # Single pass over every item that can carry evidence: paradigm components and properties
+        items = chain(
+            chain.from_iterable(c for c in paradigm_model.values() if isinstance(c, list)),
+            properties,
+        )
+        return Counter(chain.from_iterable(
+            item.get("evidence_insight_ids", ()) for item in items if isinstance(item, dict)
+        ))
+
+    def _get_evidence_for_category(self, category_analysis: Dict[str, Any]) -> Dict[str, str]:
+        """
+        Gathers all unique insight verbatim texts for a given category's analysis.
+        """
         evidence_map = {}
-        for insight_id in referenced_ids:
-            evidence_text = self.all_insights_map.get(insight_id)
+        for insight_id in self._count_evidence_citations(category_analysis):
+            evidence_text = self._lookup_insight_text(insight_id)
             if evidence_text:
                 evidence_map[insight_id] = evidence_text
             else:
@@ -167,9 +279,9 @@ class NarratorAgent:
         properties = analysis.get("properties_and_dimensions", [])
 
         # The prompt expects these as JSON strings
-        paradigm_model_json = json.dumps(paradigm_model, indent=4, ensure_ascii=False)
-        properties_json = json.dumps(properties, indent=4, ensure_ascii=False)
-        evidence_json = json.dumps(evidence_map, indent=4, ensure_ascii=False)
+        paradigm_model_json = _dumps(paradigm_model)
+        properties_json = _dumps(properties)
+        evidence_json = _dumps(evidence_map)
 
         # A better heuristic might be to find a specific property or a description field.
         # For now, let's take the first property's description as a stand-in.
@@ -179,7 +291,7 @@ class NarratorAgent:
         category_description = "No central phenomenon description found." # This will be removed from format call
 
 
-        prompt = self.narrative_prompt_template.format(
+        prompt = self._compiled_narrative_template.render(
             category_name=category_data.get("category_name", "N/A"),
             paradigm_model_json=paradigm_model_json,
             properties_json=properties_json,
@@ -187,29 +299,27 @@ class NarratorAgent:
         )
         return prompt
 
-    def _get_summarized_evidence_json(self, category_data: Dict[str, Any], all_insights_map: Dict[str, Any]) -> str:
+    def _trim_evidence_to_budget(self, category_data: Dict[str, Any], evidence_map: Dict[str, str]) -> Dict[str, str]:
         """
-        Gets all evidence for a category. If it's too large, it asks the LLM
-        to summarize it before returning it as a JSON string.
+        Keeps the evidence within EVIDENCE_TOKEN_LIMIT tokens (model tokenizer) without an
+        extra LLM call: if it does not fit, the most-cited excerpts are kept first and the
+        rest are dropped.
         """
-        evidence_map = self._get_evidence_for_category(category_data)
-        evidence_json_str = json.dumps(evidence_map, indent=2, ensure_ascii=False)
-        
-        if len(evidence_json_str) > EVIDENCE_CHAR_LIMIT:
-            print(f"  [Info] Evidence for '{category_data['category_name']}' is too large ({len(evidence_json_str)} chars). Summarizing...")
-            summarization_prompt = (
-                "The following is a JSON object containing raw text excerpts used as evidence in a qualitative study. "
-                "Please synthesize the key themes, patterns, and core ideas from this evidence into a concise summary. "
-                "Focus on the main points that emerge from the data as a whole.\n\n"
-                f"Evidence to summarize:\n{evidence_json_str}"
-            )
-            
-            summary_text = self.llm_service.generate_response(summarization_prompt)
-            
-            # Return a structured summary instead of the full evidence
-            return json.dumps({
-                "summary_note": "The original evidence was too large for the context window and has been summarized below.",
-                "evidence_summary": summary_text
-            }, indent=2, ensure_ascii=False)
-
-        return evidence_json_str
\ No newline at end of file
+        # Every token spans at least one character, so this bound avoids tokenizing small maps
+        if sum(len(text) for text in evidence_map.values()) <= EVIDENCE_TOKEN_LIMIT:
+            return evidence_map
+        token_counts = {insight_id: self.llm_service.count_tokens(text) for insight_id, text in evidence_map.items()}
+        if sum(token_counts.values()) <= EVIDENCE_TOKEN_LIMIT:
+            return evidence_map
+
+        citations = self._count_evidence_citations(category_data)
+        trimmed_map = {}
+        used_tokens = 0
+        for insight_id in sorted(evidence_map, key=lambda i: citations[i], reverse=True):
+            if used_tokens + token_counts[insight_id] > EVIDENCE_TOKEN_LIMIT:
+                continue
+            trimmed_map[insight_id] = evidence_map[insight_id]
+            used_tokens += token_counts[insight_id]
+        print(f"  [Info] Evidence for '{category_data.get('category_name', 'N/A')}' exceeds {EVIDENCE_TOKEN_LIMIT} tokens; "
+              f"keeping the {len(trimmed_map)}/{len(evidence_map)} most-cited excerpts ({used_tokens} tokens).")
+        return trimmed_map
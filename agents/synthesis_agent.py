@@ -3,12 +3,18 @@ Synthesis Agent para generar reporte de síntesis teórica en Markdown.
 Transforma las narrativas por categoría en un modelo teórico integrado.
 """
 
-import json
+import asyncio
+import hashlib
 import logging
-from typing import List, Dict, Any
+import os
+from typing import List, Dict, Any, Iterable, Optional, Tuple, Union
 
+from agents.embedding_client import EmbeddingClient, is_valid_embedding
 from services.llm_service import LLMService
-from utils.file_utils import load_jsonl_file, load_prompt_template, write_text_file
+from services.llm_response_cache import LLMResponseCache
+from services.semantic_response_cache import SemanticResponseCache
+from utils.file_utils import load_jsonl_file, count_jsonl_records, load_prompt_template, write_text_file
+from utils.prompt_template import compile_prompt_template
 
 
 class SynthesisAgent:
@@ -17,23 +23,58 @@ class SynthesisAgent:
     Genera un informe estructurado en Markdown optimizado para Notion.
     """
     
-    def __init__(self, llm_service: LLMService, config: Dict[str, Any]):
+    def __init__(self,
+                 llm_service: LLMService,
+                 config: Dict[str, Any],
+                 embedding_client: Optional[EmbeddingClient] = None,
+                 cache_enabled: bool = True,
+                 cache_dir: str = 'data/synthesis.llmcache',
+                 semantic_cache_threshold: float = 0.97):
         """
         Inicializa el agente de síntesis.
         
         Args:
             llm_service: Servicio de LLM compartido.
             config: Configuración del proyecto.
+            embedding_client: Si se proporciona (y la caché está activa), una categoría cuya
+                narrativa tenga similitud coseno >= `semantic_cache_threshold` con una ya
+                sintetizada reutiliza esa síntesis sin llamar al LLM.
+            cache_enabled: Si es True, las síntesis por categoría y el informe final se guardan
+                en disco (`cache_dir`) por hash del prompt completo, el modelo y la temperatura,
+                y una nueva ejecución con las mismas entradas no vuelve a llamar al LLM.
         """
         self.llm_service = llm_service
         self.config = config
         
         # Guardar el nombre del modelo avanzado para este agente
         self.advanced_model_name = self.config["llm"]["advanced_model"]
+        # Llamadas al LLM en vuelo durante la síntesis por categoría (1 = secuencial)
+        self.max_concurrency = max(1, self.config["llm"].get("max_concurrency", 1))
+        # Envía las instrucciones fijas del prompt por categoría como prefijo cacheable por el proveedor
+        self.prompt_caching = self.config["llm"].get("prompt_caching", False)
+        # Con un LLM local, todas las síntesis por categoría se lanzan a la vez con
+        # `invoke_llm_batch` (llamadas en paralelo) para que el motor las genere como un lote
+        self.use_batch_mode = self.config["llm"].get("batch_mode", False)
         
         # Cargar templates de prompts
         self.category_prompt = load_prompt_template(self.config["prompts"]["synthesize_category"])
         self.final_report_prompt = load_prompt_template(self.config["prompts"]["synthesize_final_report"])
+        # Las instrucciones van antes que la categoría y su narrativa: todo lo anterior al
+        # primer campo es idéntico en cada llamada y forma el prefijo cacheable
+        self._compiled_category_prompt = compile_prompt_template(self.category_prompt)
+        self._compiled_final_report_prompt = compile_prompt_template(self.final_report_prompt)
+
+        self._cache = LLMResponseCache(cache_dir) if cache_enabled else None
+        self.embedding_client = embedding_client
+        self._semantic_cache: Optional[SemanticResponseCache] = None
+        if cache_enabled and embedding_client is not None:
+            # Cambiar la plantilla, el modelo o el modelo de embeddings invalida la caché semántica
+            prompt_version = hashlib.blake2b(self.category_prompt.encode('utf-8'), digest_size=16).hexdigest()
+            self._semantic_cache = SemanticResponseCache(
+                os.path.join(cache_dir, 'semantic_index.jsonl'),
+                namespace=f"{self.advanced_model_name}|{llm_service.temperature!r}|{prompt_version}|{embedding_client.model_name}",
+                threshold=semantic_cache_threshold
+            )
         
         # Mapeo de nombres de categorías para el clustering
         self.category_mapping = {
@@ -64,14 +105,15 @@ class SynthesisAgent:
         narratives_file_path = self.config["data"]["narrativas_por_categoria"]
         output_file_path = self.config["data"]["reporte_sintesis_teorica"]
         
-        # Cargar datos
-        logging.info(f"Cargando narrativas desde: {narratives_file_path}")
-        narratives_data = list(load_jsonl_file(narratives_file_path))
-        logging.info(f"Cargadas {len(narratives_data)} categorías")
+        # Las narrativas se leen de forma perezosa durante la fase 1; contar las líneas (sin
+        # parsearlas) basta para mostrar el progreso
+        logging.info(f"Leyendo narrativas desde: {narratives_file_path}")
+        total_categories = count_jsonl_records(narratives_file_path)
+        logging.info(f"Encontradas {total_categories} categorías")
         
         # Fase 1: Síntesis Intra-Categoría
         logging.info("=== FASE 1: SÍNTESIS INTRA-CATEGORÍA ===")
-        synthesized_narratives = self._synthesize_categories(narratives_data)
+        synthesized_narratives = self._synthesize_categories(load_jsonl_file(narratives_file_path), total_categories)
         
         # Fase 2: Generación del Informe Final
         logging.info("=== FASE 2: GENERACIÓN DEL INFORME FINAL ===")
@@ -84,42 +126,188 @@ class SynthesisAgent:
         logging.info("=== SYNTHESIS AGENT COMPLETADO ===")
         return output_file_path
 
-    def _synthesize_categories(self, narratives_data: List[Dict]) -> Dict[str, str]:
+    def _synthesize_categories(self, narratives_data: Iterable[Dict], total: Optional[int] = None) -> Dict[str, str]:
         """
         Sintetiza cada categoría individualmente preservando su estructura teórica.
+        Las categorías son independientes entre sí, así que se envían al LLM de forma
+        concurrente (hasta `max_concurrency` llamadas en vuelo); el resultado conserva
+        el orden de `narratives_data`.
+
+        `narratives_data` puede ser un iterador perezoso: solo se leen unas pocas
+        categorías por delante de las que están en vuelo, así que la memoria depende de
+        la concurrencia y no del tamaño del archivo de narrativas.
+
+        Con `batch_mode` en la configuración, todas las categorías se envían a la vez
+        (ver `_synthesize_categories_in_batch_mode`).
         """
-        synthesized = {}
-        
-        for i, category_data in enumerate(narratives_data, 1):
+        if self.use_batch_mode:
+            return self._synthesize_categories_in_batch_mode(narratives_data, total)
+        return asyncio.run(self._synthesize_categories_async(narratives_data, total))
+
+    async def _synthesize_categories_async(self, narratives_data: Iterable[Dict], total: Optional[int] = None) -> Dict[str, str]:
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        max_pending = 2 * self.max_concurrency
+        categories = enumerate(narratives_data, 1)
+        pending: Dict[asyncio.Task, int] = {}
+        results: Dict[int, Tuple[str, str]] = {}
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < max_pending:
+                next_category = next(categories, None)
+                if next_category is None:
+                    exhausted = True
+                    break
+                i, category_data = next_category
+                task = asyncio.ensure_future(self._synthesize_one(semaphore, i, total or '?', category_data))
+                pending[task] = i
+            if not pending:
+                break
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                results[pending.pop(task)] = task.result()
+        return dict(results[i] for i in sorted(results))
+
+    def _synthesize_categories_in_batch_mode(self, narratives_data: Iterable[Dict], total: Optional[int] = None) -> Dict[str, str]:
+        """
+        Sintetiza todas las categorías con una sola llamada a `invoke_llm_batch`, que lanza
+        todas las peticiones en tiempo real en paralelo (no es una API de lotes del proveedor).
+        Pensado para modelos locales: un servidor como Ollama o vLLM atiende las peticiones
+        simultáneas como un lote y aprovecha mucho mejor la GPU/CPU. Las categorías con síntesis
+        en caché (exacta o semántica) no se vuelven a enviar; el resultado conserva el orden
+        de `narratives_data`.
+        """
+        categories: List[Tuple[str, str, bytes]] = []
+        responses: List[Optional[str]] = []
+        for category_data in narratives_data:
             category_name = category_data.get("category_name")
-            logging.info(f"  [{i}/{len(narratives_data)}] Sintetizando: {category_name}")
-            
             full_narrative = self._build_full_narrative(category_data.get("narrative_blocks", []))
-            
-            prompt = self.category_prompt.format(
+            prompt = self._compiled_category_prompt.render_bytes(
                 category_name=category_name,
                 full_narrative=full_narrative
             )
-            
+            categories.append((category_name, full_narrative, prompt))
+            responses.append(self._get_cached_response(prompt))
+
+        vectors: Dict[int, Any] = {}
+        pending_indices: List[int] = []
+        for i, (category_name, full_narrative, _) in enumerate(categories):
+            if responses[i]:
+                logging.info(f"  [{i + 1}/{total or len(categories)}] {category_name}: síntesis recuperada de la caché")
+                continue
+            vector = self._embed_narrative(category_name, full_narrative)
+            if vector is not None:
+                responses[i] = self._semantic_cache.get(vector)
+                if responses[i]:
+                    logging.info(f"  [{i + 1}/{total or len(categories)}] {category_name}: síntesis reutilizada de una narrativa casi idéntica")
+                    continue
+                vectors[i] = vector
+            pending_indices.append(i)
+
+        if pending_indices:
+            logging.info(f"Sintetizando {len(pending_indices)} categorías en paralelo con invoke_llm_batch ({len(categories) - len(pending_indices)} en caché)...")
+            # Todas las categorías salen de la misma plantilla: el prefijo fijo (si se separa) es común
+            prompt_args = [self._category_prompt_args(categories[i][2]) for i in pending_indices]
+            batch_responses = self.llm_service.invoke_llm_batch(
+                [args["prompt"] for args in prompt_args],
+                model=self.advanced_model_name,
+                system_prompt=prompt_args[0].get("system_prompt")
+            )
+            for i, synthesized_text in zip(pending_indices, batch_responses):
+                category_name, _, prompt = categories[i]
+                if synthesized_text:
+                    logging.info(f"    ✓ {category_name} completado ({len(synthesized_text)} caracteres)")
+                    self._cache_response(prompt, vectors.get(i), synthesized_text)
+                    responses[i] = synthesized_text
+                else:
+                    logging.error(f"    ✗ Error: LLM retornó None para {category_name}")
+
+        return {
+            category_name: response or f"Error al procesar la categoría: {full_narrative}"
+            for (category_name, full_narrative, _), response in zip(categories, responses)
+        }
+
+    async def _synthesize_one(self,
+                              semaphore: asyncio.Semaphore,
+                              i: int,
+                              total: Union[int, str],
+                              category_data: Dict) -> Tuple[str, str]:
+        """Sintetiza una categoría; ante un error devuelve el texto de respaldo en su lugar."""
+        category_name = category_data.get("category_name")
+        full_narrative = self._build_full_narrative(category_data.get("narrative_blocks", []))
+        
+        prompt = self._compiled_category_prompt.render_bytes(
+            category_name=category_name,
+            full_narrative=full_narrative
+        )
+        
+        cached_text = self._get_cached_response(prompt)
+        if cached_text:
+            logging.info(f"  [{i}/{total}] {category_name}: síntesis recuperada de la caché")
+            return category_name, cached_text
+        
+        async with semaphore:
+            vector = await asyncio.to_thread(self._embed_narrative, category_name, full_narrative)
+            if vector is not None:
+                cached_text = self._semantic_cache.get(vector)
+                if cached_text:
+                    logging.info(f"  [{i}/{total}] {category_name}: síntesis reutilizada de una narrativa casi idéntica")
+                    return category_name, cached_text
+            logging.info(f"  [{i}/{total}] Sintetizando: {category_name}")
             try:
                 # Llamada al LLM a través del servicio, especificando el modelo avanzado
-                synthesized_text = self.llm_service.invoke_llm(
-                    prompt, 
+                synthesized_text = await self.llm_service.ainvoke_llm(
+                    **self._category_prompt_args(prompt),
                     model=self.advanced_model_name
                 )
-                
-                if synthesized_text:
-                    synthesized[category_name] = synthesized_text
-                    logging.info(f"    ✓ Completado ({len(synthesized_text)} caracteres)")
-                else:
-                    logging.error(f"    ✗ Error: LLM retornó None para {category_name}")
-                    synthesized[category_name] = f"Error al procesar la categoría: {full_narrative}"
-                
             except Exception as e:
                 logging.error(f"    ✗ Error sintetizando {category_name}: {e}")
-                synthesized[category_name] = f"Error al procesar la categoría: {full_narrative}"
+                return category_name, f"Error al procesar la categoría: {full_narrative}"
         
-        return synthesized
+        if synthesized_text:
+            logging.info(f"    ✓ {category_name} completado ({len(synthesized_text)} caracteres)")
+            # Solo se cachean síntesis válidas; la escritura va en un hilo para no bloquear el bucle
+            await asyncio.to_thread(self._cache_response, prompt, vector, synthesized_text)
+            return category_name, synthesized_text
+        logging.error(f"    ✗ Error: LLM retornó None para {category_name}")
+        return category_name, f"Error al procesar la categoría: {full_narrative}"
+
+    def _get_cached_response(self, prompt: Union[str, bytes]) -> Optional[str]:
+        """Devuelve la respuesta cacheada para el prompt exacto, o None si no hay caché o no existe."""
+        if self._cache is None:
+            return None
+        return self._cache.get(prompt, self.advanced_model_name, self.llm_service.temperature)
+
+    def _embed_narrative(self, category_name: str, full_narrative: str) -> Optional[Any]:
+        """Embedding de la categoría y su narrativa para la caché semántica, o None si no aplica."""
+        if self._semantic_cache is None:
+            return None
+        try:
+            vector = self.embedding_client.get_embeddings([f"{category_name}\n\n{full_narrative}"])[0]
+        except Exception as e:
+            logging.warning(f"No se pudo calcular el embedding para la caché semántica de {category_name}: {e}")
+            return None
+        return vector if is_valid_embedding(vector) else None
+
+    def _cache_response(self, prompt: bytes, vector: Optional[Any], synthesized_text: str) -> None:
+        """Guarda una síntesis válida en la caché exacta y, si hay embedding, en la semántica."""
+        if self._cache is not None:
+            self._cache.put(prompt, self.advanced_model_name, self.llm_service.temperature, synthesized_text)
+        if self._semantic_cache is not None and vector is not None:
+            self._semantic_cache.put(vector, synthesized_text)
+
+    def _category_prompt_args(self, prompt: bytes) -> Dict[str, Union[str, bytes]]:
+        """
+        Argumentos de prompt para el LLMService. Con `prompt_caching`, las instrucciones fijas
+        se separan como `system_prompt` (bloque `cache_control: ephemeral`) y solo la categoría
+        y su narrativa van como prompt, siempre que alcancen el tamaño mínimo que la caché de
+        contexto exige al modelo avanzado (con los "pro", bastante mayor).
+        """
+        static_prefix = self._compiled_category_prompt.static_prefix
+        if not self.prompt_caching or not static_prefix or not prompt.startswith(static_prefix):
+            return {"prompt": prompt}
+        if not self.llm_service.supports_prefix_caching(static_prefix, self.advanced_model_name):
+            return {"prompt": prompt}
+        return {"prompt": prompt[len(static_prefix):], "system_prompt": static_prefix}
 
     def _build_full_narrative(self, narrative_blocks: List[Dict]) -> str:
         """
@@ -140,16 +328,24 @@ class SynthesisAgent:
         """
         logging.info("  Estructurando narrativas por clusters...")
         
-        all_narratives_text = "\n\n" + "="*80 + "\n\n"
+        # Se acumulan las piezas en una lista y se unen una sola vez (sin `+=` repetidos)
+        separator = "="*80 + "\n\n"
+        parts = ["\n\n", separator]
         for category_name, narrative in synthesized_narratives.items():
-            all_narratives_text += f"## CATEGORÍA: {category_name}\n\n"
-            all_narratives_text += f"{narrative}\n\n"
-            all_narratives_text += "="*80 + "\n\n"
+            parts.append(f"## CATEGORÍA: {category_name}\n\n{narrative}\n\n")
+            parts.append(separator)
         
-        prompt = self.final_report_prompt.format(
-            synthesized_narratives=all_narratives_text
+        prompt = self._compiled_final_report_prompt.render(
+            synthesized_narratives="".join(parts)
         )
         
+        # El prompt solo cambia si cambia alguna síntesis por categoría: si ninguna cambió,
+        # el informe de la ejecución anterior sigue siendo válido
+        cached_report = self._get_cached_response(prompt)
+        if cached_report:
+            logging.info("  ✓ Informe final recuperado de la caché")
+            return cached_report
+        
         logging.info("  Generando informe integrado con modelo avanzado...")
         
         try:
@@ -161,6 +357,8 @@ class SynthesisAgent:
             
             if final_report:
                 logging.info("  ✓ Informe final generado exitosamente")
+                if self._cache is not None:
+                    self._cache.put(prompt, self.advanced_model_name, self.llm_service.temperature, final_report)
                 return final_report
             else:
                 logging.error("  ✗ Error: LLM retornó None para el informe final")
@@ -174,12 +372,8 @@ class SynthesisAgent:
         """
         Crea un informe básico en caso de error en la generación con LLM.
         """
-        report = "# Modelo Teórico de Bienestar Financiero Digital\n\n"
-        report += "## Informe de Síntesis Teórica\n\n"
-        
+        parts = ["# Modelo Teórico de Bienestar Financiero Digital\n\n", "## Informe de Síntesis Teórica\n\n"]
         for category_name, narrative in synthesized_narratives.items():
-            report += f"### {category_name}\n\n"
-            report += f"{narrative}\n\n"
-            report += "---\n\n"
+            parts.append(f"### {category_name}\n\n{narrative}\n\n---\n\n")
         
-        return report 
\ No newline at end of file
+        return "".join(parts) 
\ No newline at end of file
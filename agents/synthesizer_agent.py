@@ -2,16 +2,19 @@
 
 import uuid
 import logging
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
-from agents.embedding_client import EmbeddingClient
+from agents.embedding_client import EmbeddingClient, is_valid_embedding
 from agents.codebook_repository import CodebookRepository
 from models.data_models import Codebook, Code
 
 # Usamos el mismo logger configurado en el cliente para consistencia
 logger = logging.getLogger(__name__)
 
+# Máximo de similitudes (filas nuevas x códigos existentes) calculadas a la vez al buscar
+# duplicados: ~64 MiB en float32, sea cual sea el tamaño del codebook
+SIMILARITY_BLOCK_ELEMENTS = 1 << 24
+
 class SynthesizerAgent:
     """
     Agente Sintetizador-Auditor simplificado.
@@ -26,6 +29,9 @@ class SynthesizerAgent:
         # El repositorio ahora devuelve un objeto Codebook validado.
         self.codebook: Codebook = self.repository.load()
         self.embedding_dim = 768 # Valor por defecto, se puede sobreescribir si hay metadata
+        # IDs de códigos creados o modificados desde la última escritura (dict como set ordenado),
+        # para registrar en el log del repositorio solo lo que ha cambiado.
+        self._dirty_code_ids: Dict[str, None] = {}
 
         self._ensure_metadata_structure()
         self._rebuild_internal_caches()
@@ -49,12 +55,14 @@ class SynthesizerAgent:
         
         codes_with_embeddings = [c for c in self.codebook.codes if c.embedding and isinstance(c.embedding, list) and len(c.embedding) > 0]
         
+        # Filas normalizadas (norma 1) en float32: la similitud coseno es un producto escalar.
+        # Se guardan en un búfer con capacidad de sobra que se duplica al llenarse, así que
+        # añadir vectores cuesta O(1) amortizado en lugar de copiar toda la matriz.
+        self.ordered_code_ids = [c.id for c in codes_with_embeddings]
+        self._embedding_count = 0
+        self._embedding_buffer = np.empty((max(1024, 2 * len(codes_with_embeddings)), self.embedding_dim), dtype=np.float32)
         if codes_with_embeddings:
-            self.ordered_code_ids = [c.id for c in codes_with_embeddings]
-            self.embedding_matrix = np.array([c.embedding for c in codes_with_embeddings])
-        else:
-            self.ordered_code_ids = []
-            self.embedding_matrix = np.empty((0, self.embedding_dim))
+            self._append_embeddings(self._normalize_rows(np.array([c.embedding for c in codes_with_embeddings], dtype=np.float32)))
         logger.info(f"⚡️ Cachés construidos. Matriz de embeddings tiene {self.embedding_matrix.shape[0]} vectores.")
 
     def process_batch(self, new_code_labels: List[str]) -> Dict[str, str]:
@@ -80,15 +88,91 @@ class SynthesizerAgent:
             # Pasamos el mapa para que sea poblado por el método secuencial.
             self._process_new_codes_sequentially(codes_to_create, translation_map)
 
-        self.repository.save(self.codebook)
+        self._persist_changes()
         logger.info(f"✅ Lote procesado. Codebook tiene ahora {len(self.codebook.codes)} códigos únicos.")
         
         # Devolvemos el mapa de traducción completo.
         return translation_map
 
+    def _persist_changes(self):
+        """
+        Registra en el log del repositorio solo los códigos creados o modificados en el lote
+        (coste proporcional al cambio, no al codebook); si el log ha crecido demasiado, se compacta.
+        """
+        self.repository.append(self.codes_by_id[code_id] for code_id in self._dirty_code_ids)
+        self._dirty_code_ids.clear()
+        if self.repository.needs_compaction():
+            self.repository.compact(self.codebook)
+
+    def compact_codebook(self):
+        """
+        Consolida el codebook en su archivo JSON. Debe llamarse antes de que otros agentes
+        lean el codebook directamente del disco.
+        """
+        self.repository.compact(self.codebook)
+
+    @property
+    def embedding_matrix(self) -> np.ndarray:
+        """Vista (sin copia) de las filas ocupadas del búfer, alineadas con `ordered_code_ids`."""
+        return self._embedding_buffer[:self._embedding_count]
+
+    def _append_embeddings(self, rows: np.ndarray) -> None:
+        """Añade filas ya normalizadas al búfer, duplicando su capacidad cuando se llena."""
+        if self._embedding_count == 0 and rows.shape[1] != self._embedding_buffer.shape[1]:
+            # Aún vacío y con otra dimensión (p. ej. otro modelo de embeddings): se adapta
+            self._embedding_buffer = np.empty((self._embedding_buffer.shape[0], rows.shape[1]), dtype=np.float32)
+        needed = self._embedding_count + rows.shape[0]
+        if needed > self._embedding_buffer.shape[0]:
+            capacity = self._embedding_buffer.shape[0]
+            while capacity < needed:
+                capacity *= 2
+            grown = np.empty((capacity, self._embedding_buffer.shape[1]), dtype=np.float32)
+            grown[:self._embedding_count] = self._embedding_buffer[:self._embedding_count]
+            self._embedding_buffer = grown
+        self._embedding_buffer[self._embedding_count:needed] = rows
+        self._embedding_count = needed
+
+    @staticmethod
+    def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+        """
+        Normaliza cada fila a norma 1 en el sitio (las filas nulas se dejan a cero) y devuelve
+        la misma matriz. Quien llama pasa siempre una copia propia, así que no hace falta otra.
+        """
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        matrix /= norms
+        return matrix
+
+    def _best_existing_matches(self, new_matrix: np.ndarray) -> Tuple[Optional[np.ndarray], Optional[np.ndarray]]:
+        """
+        Para cada fila de `new_matrix`, índice y similitud del código existente más parecido
+        (None si el codebook no tiene vectores). La búsqueda es exacta pero se hace por
+        bloques de filas, así que nunca se materializa la matriz completa nuevas x existentes.
+        """
+        existing = self.embedding_matrix
+        if existing.shape[0] == 0:
+            return None, None
+        best_idx = np.empty(new_matrix.shape[0], dtype=np.intp)
+        best_similarity = np.empty(new_matrix.shape[0], dtype=np.float32)
+        block_rows = min(new_matrix.shape[0], max(1, SIMILARITY_BLOCK_ELEMENTS // existing.shape[0]))
+        # Un único búfer de salida reutilizado en todos los bloques, sin reservar memoria por bloque
+        buffer = np.empty((block_rows, existing.shape[0]), dtype=np.float32)
+        for start in range(0, new_matrix.shape[0], block_rows):
+            block = new_matrix[start:start + block_rows]
+            similarities = np.matmul(block, existing.T, out=buffer[:block.shape[0]])
+            block_idx = np.argmax(similarities, axis=1)
+            best_idx[start:start + block.shape[0]] = block_idx
+            best_similarity[start:start + block.shape[0]] = np.take_along_axis(similarities, block_idx[:, None], axis=1)[:, 0]
+        return best_idx, best_similarity
+
     def _process_new_codes_sequentially(self, labels: List[str], translation_map: Dict[str, str]):
         """
-        Procesa nuevos códigos uno por uno, poblando el mapa de traducción.
+        Procesa nuevos códigos en orden, poblando el mapa de traducción.
+
+        Cada código se compara con los ya existentes y con los nuevos aceptados antes que
+        él en el mismo lote, igual que si se añadieran uno a uno; pero todas las
+        similitudes se calculan de una vez con dos productos de matrices (contra el
+        codebook y dentro del lote) en lugar de una llamada por código.
         """
         logger.info(f"🧠 Procesando secuencialmente {len(labels)} nuevos códigos candidatos...")
         
@@ -96,14 +180,34 @@ class SynthesizerAgent:
             return
 
         all_embeddings = self.client.get_embeddings(labels)
-
-        for label, embedding_list in zip(labels, all_embeddings):
-            if not embedding_list:
+        valid_rows = [i for i, embedding in enumerate(all_embeddings) if is_valid_embedding(embedding)]
+        for i, label in enumerate(labels):
+            if not is_valid_embedding(all_embeddings[i]):
                 logger.warning(f"Se omitió el código '{label}' porque no se pudo generar su embedding.")
-                continue
+        if not valid_rows:
+            return
+
+        # Los embeddings llegan en float16; la similitud se calcula en float32
+        new_matrix = self._normalize_rows(all_embeddings[valid_rows].astype(np.float32))
+        existing_best_idx, existing_best_similarity = self._best_existing_matches(new_matrix)
+        batch_similarities = new_matrix @ new_matrix.T
 
-            embedding = np.array(embedding_list)
-            existing_id = self._find_semantic_duplicate(embedding)
+        accepted_rows: List[int] = []
+        for row, label_idx in enumerate(valid_rows):
+            label = labels[label_idx]
+            # Mejor coincidencia entre los códigos existentes y los nuevos ya aceptados
+            # (a igual similitud gana el existente, que va antes en la matriz)
+            existing_id, best_similarity = None, -1.0
+            if existing_best_idx is not None:
+                existing_id = self.ordered_code_ids[existing_best_idx[row]]
+                best_similarity = existing_best_similarity[row]
+            if accepted_rows:
+                candidates = batch_similarities[row, accepted_rows]
+                best_idx = int(np.argmax(candidates))
+                if candidates[best_idx] > best_similarity:
+                    existing_id, best_similarity = self.ordered_code_ids[-len(accepted_rows) + best_idx], candidates[best_idx]
+            if best_similarity < self.similarity_threshold:
+                existing_id = None
             
             if existing_id:
                 self._update_code_count(existing_id)
@@ -112,35 +216,24 @@ class SynthesizerAgent:
             else:
                 new_id = f"code_{uuid.uuid4()}"
                 # Creamos un objeto Code validado
-                new_code_obj = Code(id=new_id, label=label, count=1, embedding=embedding_list)
-                self._add_single_code_to_cache(new_code_obj, embedding)
+                new_code_obj = Code(id=new_id, label=label, count=1, embedding=new_matrix[row].tolist())
+                self._add_single_code_to_cache(new_code_obj)
+                accepted_rows.append(row)
                 # Se creó un código nuevo. Registramos la traducción.
                 translation_map[label] = new_id
+
+        # Los vectores de los códigos nuevos se añaden al búfer de una sola vez
+        if accepted_rows:
+            self._append_embeddings(new_matrix[accepted_rows])
                 
-    def _add_single_code_to_cache(self, code: Code, embedding: np.ndarray):
-        """Añade un único objeto Code nuevo a todos los cachés en memoria."""
+    def _add_single_code_to_cache(self, code: Code):
+        """Añade un único objeto Code nuevo a los cachés en memoria (su vector lo añade quien lo llama)."""
         logger.info(f"➕ Añadiendo nuevo código único al codebook: '{code.label}'")
         self.codebook.codes.append(code)
         self.codes_by_id[code.id] = code
+        self._dirty_code_ids[code.id] = None
         self.label_to_id[code.label] = code.id
         self.ordered_code_ids.append(code.id)
-        
-        if self.embedding_matrix.shape[0] == 0:
-            self.embedding_matrix = embedding.reshape(1, -1)
-        else:
-            self.embedding_matrix = np.vstack([self.embedding_matrix, embedding])
-
-    def _find_semantic_duplicate(self, new_embedding: np.ndarray) -> Optional[str]:
-        """Encuentra duplicados semánticos usando la matriz de embeddings actual."""
-        if self.embedding_matrix.shape[0] == 0:
-            return None
-        
-        similarities = cosine_similarity(new_embedding.reshape(1, -1), self.embedding_matrix)[0]
-        max_similarity_idx = np.argmax(similarities)
-        
-        if similarities[max_similarity_idx] >= self.similarity_threshold:
-            return self.ordered_code_ids[max_similarity_idx]
-        return None
 
     def _update_code_count(self, code_id: str):
         """Incrementa el contador de un código existente."""
@@ -152,5 +245,6 @@ class SynthesizerAgent:
                 code_to_update.count += 1
             else:
                 code_to_update.count = 2 # Si no existía, se encontró una vez antes y ahora otra
+            self._dirty_code_ids[code_id] = None
         else:
             logger.warning(f"Advertencia de integridad: Se intentó actualizar el ID '{code_id}' no encontrado en caché.")
@@ -37,6 +37,11 @@ def main():
         nargs='?', # El argumento es opcional, 'pipeline' es el default
         help="Especifica la tarea a ejecutar: 'pipeline' para el proceso completo, 'narrate' para generar las narrativas, 'synthesis' para el reporte final."
     )
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help="Rehace las fases que se omiten cuando sus entradas no han cambiado (p. ej. la categorización)."
+    )
     args = parser.parse_args()
 
     try:
@@ -44,7 +49,7 @@ def main():
         config = load_json_file("config_proyecto.json")
         
         # 1. Crear una instancia del orquestador con la configuración
-        pipeline_orchestrator = Orchestrator(config)
+        pipeline_orchestrator = Orchestrator(config, force=args.force)
 
         # 2. Ejecutar la tarea seleccionada
         if args.task == 'narrate':
@@ -1,6 +1,7 @@
 # models/data_models.py
-from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+import sys
+from pydantic import BaseModel, Field, PrivateAttr
+from typing import List, Optional, Dict, Any, FrozenSet
 
 # --- Modelos para 'categorias.json' ---
 
@@ -15,6 +16,19 @@ class Category(BaseModel):
     description: Optional[str] = None
     code_assignments: List[CodeAssignment] = []
 
+    _code_id_set: Optional[FrozenSet[str]] = PrivateAttr(default=None)
+
+    @property
+    def code_id_set(self) -> FrozenSet[str]:
+        """
+        Conjunto inmutable (e internado) de los IDs de código asignados.
+        Se calcula la primera vez que se consulta, así que debe usarse sobre
+        categorías cuyas asignaciones ya no van a cambiar (p.ej. tras fusionarlas).
+        """
+        if self._code_id_set is None:
+            self._code_id_set = frozenset(sys.intern(a.code_id) for a in self.code_assignments)
+        return self._code_id_set
+
 # --- Modelos para 'codebook.json' ---
 
 class Code(BaseModel):
@@ -1,7 +1,8 @@
 # orchestrator.py
 
+import asyncio
 import os
-import json
+import orjson
 import logging
 from typing import List, Dict, Any
 from dotenv import load_dotenv
@@ -26,9 +27,11 @@ class Orchestrator:
     5. Usa el mapa para enriquecer los datos con los IDs unificados.
     6. Guarda el resultado final.
     """
-    def __init__(self, config: Dict[str, Any]):
+    def __init__(self, config: Dict[str, Any], force: bool = False):
         load_dotenv()
         self.config = config
+        # Si es True, las fases que pueden omitirse cuando sus entradas no cambian se rehacen igualmente
+        self.force = force
         google_api_key = os.getenv("GOOGLE_API_KEY")
         if not google_api_key:
             raise ValueError("La variable de entorno GOOGLE_API_KEY no está configurada.")
@@ -37,10 +40,29 @@ class Orchestrator:
         # 1. Crear una única instancia de los servicios compartidos
         self.llm_service = LLMService(model=self.config["llm"]["default_model"])
         self.codebook_repo = CodebookRepository(codebook_path=self.config["data"]["codebook"])
-        self.embedding_client = EmbeddingClient(api_key=google_api_key)
+        # Un solo cliente de embeddings (con su pool HTTP y su caché en disco) para todos los
+        # agentes que lo usan: la caché semántica del codificador y el sintetizador
+        self.embedding_client = EmbeddingClient(
+            api_key=google_api_key,
+            cache_dir=self.config["data"].get("embeddings_cache", "data/embeddings.llmcache"),
+            max_concurrency=self.config["llm"].get("max_concurrency", 4)
+        )
         
         # 2. Inyectar los servicios en los agentes que los necesitan
-        self.coder = CoderAgent(llm_service=self.llm_service) 
+        self.coder = CoderAgent(
+            llm_service=self.llm_service,
+            prompt_template_path=self.config["prompts"].get("open_coding", "prompts/open_coding.md"),
+            batch_prompt_template_path=self.config["prompts"].get("open_coding_batch", "prompts/open_coding_batch.md"),
+            # Insights codificados por llamada al LLM (1 = un prompt por insight)
+            batch_size=self.config["llm"].get("coding_batch_size", 1),
+            # Envía la parte fija del prompt como prefijo cacheable por el proveedor
+            prompt_caching=self.config["llm"].get("prompt_caching", False),
+            # Caché semántica opcional: reutiliza códigos de fragmentos casi idénticos
+            embedding_client=self.embedding_client if self.config["llm"].get("semantic_cache", False) else None,
+            semantic_cache_threshold=self.config["llm"].get("semantic_cache_threshold", 0.95)
+        )
+        # Llamadas al LLM en vuelo durante la codificación abierta (1 = secuencial)
+        self.coding_concurrency = self.config["llm"].get("coding_concurrency", self.config["llm"].get("max_concurrency", 1))
         
         self.synthesizer = SynthesizerAgent(
             repository=self.codebook_repo, 
@@ -48,7 +70,10 @@ class Orchestrator:
             similarity_threshold=0.90
         )
         
-        self.categorizer = CategorizerAgent(llm_service=self.llm_service)
+        self.categorizer = CategorizerAgent(
+            llm_service=self.llm_service,
+            max_concurrency=self.config["llm"].get("max_concurrency", 1)
+        )
         
         self.axial_analyst = AxialAnalystAgent(llm_service=self.llm_service)
 
@@ -92,6 +117,55 @@ class Orchestrator:
         logging.info(f"✅ {len(enriched_insights)} insights han sido enriquecidos.")
         return enriched_insights
 
+    def _record_coding_result(self, insight: Dict[str, Any], coding_result, checkpoint_f, coded_insights: List[Dict[str, Any]]):
+        """Añade un insight codificado al checkpoint (con fsync) y a la lista en memoria."""
+        if coding_result.error:
+            logging.warning(f"Error al codificar insight {coding_result.id_fragmento}: {coding_result.error}. Se omitirá.")
+            coded_insight = {
+                **insight,  # Preservar datos originales incluyendo 'id'
+                "id_fragmento": coding_result.id_fragmento,
+                "fragmento_original": coding_result.fragmento_original,
+                "codigos_abiertos": [],
+                "error": coding_result.error
+            }
+        else:
+            generated_codes_dict = coding_result.model_dump()
+            coded_insight = {**insight, **generated_codes_dict}
+        
+        # Guardado incremental
+        checkpoint_f.write(orjson.dumps(coded_insight).decode('utf-8') + '\n')
+        checkpoint_f.flush(); os.fsync(checkpoint_f.fileno())
+        coded_insights.append(coded_insight)
+
+    def _record_coding_failure(self, insight: Dict[str, Any], error: Exception):
+        """Guarda el insight fallido para análisis posterior."""
+        logging.error(f"Fallo CRÍTICO al procesar insight {insight.get('id', 'N/A')}: {error}", exc_info=error)
+        with open(self.failed_data_path, 'a', encoding='utf-8') as failed_f:
+            failed_data = {
+                "id": insight.get("id"),  # Mantener consistencia con la key original
+                "insight_original": insight,
+                "error": str(error)
+            }
+            failed_f.write(orjson.dumps(failed_data).decode('utf-8') + '\n')
+
+    async def _code_insights_async(self, insights_to_process: List[Dict[str, Any]], checkpoint_f, coded_insights: List[Dict[str, Any]]):
+        """
+        Codifica los insights de forma concurrente. Cada resultado se guarda (con fsync) en un
+        hilo aparte, de uno en uno y en orden de llegada, para que la escritura a disco no
+        bloquee el bucle de eventos mientras hay otras llamadas al LLM en vuelo.
+        """
+        logging.info(f"Codificando con hasta {self.coding_concurrency} llamadas concurrentes al LLM ({self.coder.batch_size} insights por llamada)...")
+        done = 0
+        async for insight, coding_result, error in self.coder.generate_codes_batch(insights_to_process, self.coding_concurrency):
+            done += 1
+            logging.info(f"Insight {done}/{len(insights_to_process)} completado (ID: {insight.get('id', 'N/A')}).")
+            try:
+                if error is not None:
+                    raise error
+                await asyncio.to_thread(self._record_coding_result, insight, coding_result, checkpoint_f, coded_insights)
+            except Exception as e:
+                await asyncio.to_thread(self._record_coding_failure, insight, e)
+
     def run_pipeline(self):
         """
         Ejecuta el pipeline completo de orquestación de forma automática.
@@ -102,7 +176,7 @@ class Orchestrator:
         logging.info(f"Cargando datos crudos desde {self.raw_data_path}...")
         try:
             with open(self.raw_data_path, 'r', encoding='utf-8') as f:
-                raw_insights = [json.loads(line) for line in f]
+                raw_insights = [orjson.loads(line) for line in f]
             logging.info(f"Se cargaron {len(raw_insights)} insights crudos.")
         except FileNotFoundError:
             logging.error(f"FATAL: El archivo de entrada de datos crudos '{self.raw_data_path}' no existe.")
@@ -116,8 +190,8 @@ class Orchestrator:
             with open(self.coded_data_path, 'r', encoding='utf-8') as f:
                 for line in f:
                     try:
-                        coded_insight = json.loads(line)
-                    except json.JSONDecodeError:
+                        coded_insight = orjson.loads(line)
+                    except orjson.JSONDecodeError:
                         logging.error("Línea corrupta en checkpoint; se omitirá para evitar bloqueo de reanudación.")
                         continue
                     coded_insights.append(coded_insight)
@@ -136,40 +210,29 @@ class Orchestrator:
             
             # Abre el archivo de checkpoint en modo 'append' para guardar incrementalmente
             with open(self.coded_data_path, 'a', encoding='utf-8') as checkpoint_f:
-                for i, insight in enumerate(insights_to_process, 1):
-                    logging.info(f"Procesando insight {i}/{len(insights_to_process)} (ID: {insight.get('id', 'N/A')})...")
-                    try:
-                        coding_result = self.coder.generate_codes(insight)
-                        
-                        if coding_result.error:
-                            logging.warning(f"Error al codificar insight {coding_result.id_fragmento}: {coding_result.error}. Se omitirá.")
-                            coded_insight = {
-                                **insight,  # Preservar datos originales incluyendo 'id'
-                                "id_fragmento": coding_result.id_fragmento,
-                                "fragmento_original": coding_result.fragmento_original,
-                                "codigos_abiertos": [],
-                                "error": coding_result.error
-                            }
-                        else:
-                            generated_codes_dict = coding_result.model_dump()
-                            coded_insight = {**insight, **generated_codes_dict}
-                        
-                        # Guardado incremental
-                        checkpoint_f.write(json.dumps(coded_insight, ensure_ascii=False) + '\n')
-                        checkpoint_f.flush(); os.fsync(checkpoint_f.fileno())
-                        coded_insights.append(coded_insight)
-
-                    except Exception as e:
-                        logging.error(f"Fallo CRÍTICO al procesar insight {insight.get('id', 'N/A')}: {e}", exc_info=True)
-                        # Guardar el insight fallido para análisis posterior
-                        with open(self.failed_data_path, 'a', encoding='utf-8') as failed_f:
-                            failed_data = {
-                                "id": insight.get("id"),  # Mantener consistencia con la key original
-                                "insight_original": insight,
-                                "error": str(e)
-                            }
-                            failed_f.write(json.dumps(failed_data, ensure_ascii=False) + '\n')
-                        continue # Continuar con el siguiente insight
+                if self.coding_concurrency > 1:
+                    # Varias llamadas al LLM en vuelo; los resultados se guardan en orden de llegada
+                    asyncio.run(self._code_insights_async(insights_to_process, checkpoint_f, coded_insights))
+                elif self.coder.batch_size > 1:
+                    # Un prompt por lote de insights; los que fallen se recodifican individualmente
+                    outcomes = self.coder.generate_codes_batched(insights_to_process)
+                    for i, (insight, coding_result, error) in enumerate(outcomes, 1):
+                        logging.info(f"Insight {i}/{len(insights_to_process)} completado (ID: {insight.get('id', 'N/A')}).")
+                        try:
+                            if error is not None:
+                                raise error
+                            self._record_coding_result(insight, coding_result, checkpoint_f, coded_insights)
+                        except Exception as e:
+                            self._record_coding_failure(insight, e)
+                else:
+                    for i, insight in enumerate(insights_to_process, 1):
+                        logging.info(f"Procesando insight {i}/{len(insights_to_process)} (ID: {insight.get('id', 'N/A')})...")
+                        try:
+                            coding_result = self.coder.generate_codes(insight)
+                            self._record_coding_result(insight, coding_result, checkpoint_f, coded_insights)
+                        except Exception as e:
+                            self._record_coding_failure(insight, e)
+                            continue # Continuar con el siguiente insight
 
         # Recolectar todas las etiquetas de los insights codificados (ya sean de checkpoint o nuevos)
         all_code_labels = []
@@ -184,13 +247,14 @@ class Orchestrator:
         # --- FASE 2: Síntesis de Códigos ---
         logging.info("Iniciando la fase de síntesis para generar el mapa de traducción...")
         translation_map = self.synthesizer.process_batch(all_code_labels)
+        # Las fases siguientes leen el codebook directamente del JSON: se consolida el log
+        self.synthesizer.compact_codebook()
         logging.info("✅ Mapa de traducción generado exitosamente. El codebook.json ha sido actualizado.")
 
         # --- FASE 3: Categorización de Códigos ---
         logging.info("Iniciando la fase de categorización para agrupar códigos conceptualmente...")
         try:
-            categorized_result = self.categorizer.categorize_codes()
-            self.categorizer._save_output(categorized_result)
+            self.categorizer.run(force=self.force)
             logging.info("✅ Categorización completada. Las categorías han sido guardadas.")
         except Exception as e:
             logging.warning(f"Error en categorización (continuando pipeline): {e}")
@@ -206,7 +270,7 @@ class Orchestrator:
         logging.info(f"Guardando los datos enriquecidos en '{self.output_path}'...")
         with open(self.output_path, 'w', encoding='utf-8') as f:
             for item in enriched_data:
-                f.write(json.dumps(item, ensure_ascii=False) + '\n')
+                f.write(orjson.dumps(item).decode('utf-8') + '\n')
         
         # --- FASE 6: ANÁLISIS AXIAL ---
         logging.info("Iniciando la fase final de Análisis Axial...")
@@ -224,7 +288,10 @@ class Orchestrator:
         """
         logging.info("Orchestrating the Narrator Agent...")
         try:
-            narrator = NarratorAgent(llm_service=self.llm_service)
+            narrator = NarratorAgent(
+                llm_service=self.llm_service,
+                concurrency=self.config["llm"].get("max_concurrency", 1)
+            )
             narrator.run()
             logging.info("✅ Narrator Agent finished successfully.")
         except Exception as e:
@@ -235,7 +302,12 @@ class Orchestrator:
         Ejecuta el agente de síntesis para crear el reporte teórico final.
         """
         logging.info("Iniciando la generación de la síntesis teórica...")
-        synthesis_agent = SynthesisAgent(self.llm_service, self.config)
+        synthesis_agent = SynthesisAgent(
+            self.llm_service,
+            self.config,
+            # Caché semántica opcional: reutiliza la síntesis de narrativas casi idénticas
+            embedding_client=self.embedding_client if self.config["llm"].get("semantic_cache", False) else None
+        )
         output_path = synthesis_agent.run()
         logging.info(f"Síntesis teórica completada. El reporte se guardó en: {output_path}")
         return output_path
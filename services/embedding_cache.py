@@ -0,0 +1,72 @@
+# services/embedding_cache.py
+import hashlib
+import logging
+import os
+import tempfile
+from typing import Optional, Sequence
+
+import numpy as np
+
+
+class EmbeddingCache:
+    """
+    Caché persistente en disco de embeddings, direccionada por el hash del texto.
+
+    Sigue el mismo esquema que `LLMResponseCache`: un archivo por entrada en un directorio
+    fragmentado por los dos primeros caracteres de la clave y escrituras atómicas
+    (archivo temporal + `os.replace`). Cada vector se guarda como bytes `float32` crudos,
+    sin JSON de por medio.
+
+    La clave incluye el modelo y el tipo de tarea, así que cambiar cualquiera de los dos
+    invalida automáticamente las entradas anteriores.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.logger = logging.getLogger(__name__)
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(text: str, model: str, task_type: str) -> str:
+        """Calcula la clave de caché (BLAKE2b de 128 bits) para un texto, modelo y tipo de tarea."""
+        hasher = hashlib.blake2b(digest_size=16)
+        hasher.update(f"{model}\x00{task_type}\x00".encode('utf-8'))
+        hasher.update(text.encode('utf-8'))
+        return hasher.hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.f32")
+
+    def get(self, text: str, model: str, task_type: str) -> Optional[np.ndarray]:
+        """Devuelve el embedding cacheado para el texto, o None si no existe o está dañado."""
+        key = self.make_key(text, model, task_type)
+        try:
+            with open(self._entry_path(key), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            self.logger.warning(f"Entrada de caché de embeddings ilegible ({key}), se ignorará: {e}")
+            return None
+        if not data or len(data) % 4:
+            self.logger.warning(f"Entrada de caché de embeddings dañada ({key}), se ignorará.")
+            return None
+        return np.frombuffer(data, dtype=np.float32)
+
+    def put(self, text: str, model: str, task_type: str, embedding: Sequence[float]) -> None:
+        """Guarda el embedding de forma atómica. Los errores de escritura solo se registran."""
+        key = self.make_key(text, model, task_type)
+        entry_path = self._entry_path(key)
+        try:
+            entry_dir = os.path.dirname(entry_path)
+            os.makedirs(entry_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=entry_dir, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(np.asarray(embedding, dtype=np.float32).tobytes())
+                os.replace(tmp_path, entry_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError as e:
+            self.logger.warning(f"No se pudo guardar el embedding en la caché ({key}): {e}")
@@ -0,0 +1,75 @@
+# services/llm_response_cache.py
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from typing import Optional, Union
+
+import orjson
+
+
+class LLMResponseCache:
+    """
+    Caché persistente en disco de respuestas del LLM, direccionada por el hash del prompt.
+
+    Cada respuesta se guarda en su propio archivo JSON dentro de un directorio
+    fragmentado por los dos primeros caracteres de la clave (`<dir>/ab/abcdef....json`),
+    de modo que varios hilos pueden leer y escribir sin bloqueo: las escrituras son
+    atómicas (archivo temporal + `os.replace`) y nunca se deja un archivo a medias.
+
+    La clave incluye el modelo y la temperatura, así que cambiar cualquiera de los
+    dos invalida automáticamente las entradas anteriores.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.logger = logging.getLogger(__name__)
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(prompt: Union[str, bytes], model: str, temperature: float) -> str:
+        """
+        Calcula la clave de caché (BLAKE2b de 128 bits) para un prompt, modelo y temperatura.
+        Un prompt en `bytes` se hashea directamente; uno en `str` se codifica antes a UTF-8.
+        """
+        hasher = hashlib.blake2b(digest_size=16)
+        hasher.update(f"{model}\x00{temperature!r}\x00".encode('utf-8'))
+        hasher.update(prompt if isinstance(prompt, bytes) else prompt.encode('utf-8'))
+        return hasher.hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, prompt: Union[str, bytes], model: str, temperature: float) -> Optional[str]:
+        """Devuelve la respuesta cacheada para el prompt, o None si no existe o está dañada."""
+        key = self.make_key(prompt, model, temperature)
+        try:
+            with open(self._entry_path(key), 'rb') as f:
+                entry = orjson.loads(f.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, orjson.JSONDecodeError) as e:
+            self.logger.warning(f"Entrada de caché ilegible ({key}), se ignorará: {e}")
+            return None
+        self.logger.debug(f"Acierto de caché LLM ({key}).")
+        return entry.get('response')
+
+    def put(self, prompt: Union[str, bytes], model: str, temperature: float, response: str) -> None:
+        """Guarda la respuesta de forma atómica. Los errores de escritura solo se registran."""
+        key = self.make_key(prompt, model, temperature)
+        entry_path = self._entry_path(key)
+        entry = {'model': model, 'temperature': temperature, 'created_at': time.time(), 'response': response}
+        try:
+            entry_dir = os.path.dirname(entry_path)
+            os.makedirs(entry_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=entry_dir, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(orjson.dumps(entry))
+                os.replace(tmp_path, entry_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError as e:
+            self.logger.warning(f"No se pudo guardar la respuesta en la caché LLM ({key}): {e}")
@@ -1,9 +1,50 @@
 # services/llm_service.py
 import os
+import asyncio
 import logging
+import time
 import litellm
 from openai import APIError
-from typing import Union, Optional
+from typing import Any, Dict, List, Union, Optional
+from tenacity import RetryCallState, retry, stop_after_attempt, retry_if_exception_type
+
+from utils.retry_utils import wait_retry_after
+
+logger = logging.getLogger(__name__)
+
+# Errores transitorios del proveedor (429, 5xx, timeouts y cortes de conexión) que merece
+# la pena reintentar; liteLLM los normaliza a estas clases para todos los proveedores.
+RETRYABLE_EXCEPTIONS = (
+    litellm.RateLimitError,            # Error 429 por límite de velocidad
+    litellm.InternalServerError,       # Error 500 del servidor del proveedor
+    litellm.ServiceUnavailableError,   # Error 503 por mantenimiento o sobrecarga
+    litellm.Timeout,                   # La petición superó el tiempo límite
+    litellm.APIConnectionError,        # Fallo de red al conectar con el proveedor
+)
+
+# Tamaño mínimo (en tokens) que la caché de contexto de Gemini exige a un prefijo; los
+# modelos "pro" piden más. Por debajo, separar el prefijo no aporta nada y el proveedor
+# puede rechazar la petición.
+MIN_CACHEABLE_PREFIX_TOKENS = 1024
+MIN_CACHEABLE_PREFIX_TOKENS_PRO = 4096
+
+def _pause_service(retry_state: RetryCallState, delay: float) -> None:
+    """Ante un `Retry-After`, pausa también las demás llamadas del mismo servicio durante ese tiempo."""
+    service = retry_state.args[0] if retry_state.args else None
+    if isinstance(service, LLMService):
+        service._pause_until(time.monotonic() + delay)
+
+_llm_retry = retry(
+    # `Retry-After` del proveedor si lo hay; si no, backoff exponencial con jitter (1s..60s)
+    wait=wait_retry_after(on_retry_after=_pause_service),
+    stop=stop_after_attempt(6),
+    retry=retry_if_exception_type(RETRYABLE_EXCEPTIONS),
+    before_sleep=lambda retry_state: logger.warning(
+        f"Error transitorio del LLM ({retry_state.outcome.exception()}), reintentando... "
+        f"Intento {retry_state.attempt_number}, esperando {retry_state.next_action.sleep:.1f}s."
+    ),
+    reraise=True,
+)
 
 class LLMService:
     """
@@ -22,16 +63,30 @@ class LLMService:
         self.logger = logging.getLogger(__name__)
         self.model = model
         self.temperature = temperature
+        # Instante (reloj monotónico) hasta el que el proveedor pidió no enviar más peticiones
+        self._paused_until = 0.0
+        # Decisión de `supports_prefix_caching` por (modelo, prefijo): cada plantilla se mide una vez
+        self._cacheable_prefixes: Dict[Any, bool] = {}
         self.logger.info(f"LLMService inicializado con el modelo por defecto: {model} a través de liteLLM")
 
-    def invoke_llm(self, prompt: str, model: Optional[str] = None) -> Union[str, None]:
+    def invoke_llm(self,
+                   prompt: Union[str, bytes],
+                   model: Optional[str] = None,
+                   response_format: Optional[Dict[str, Any]] = None,
+                   system_prompt: Optional[Union[str, bytes]] = None) -> Union[str, None]:
         """
         Envía un prompt a un LLM a través de liteLLM y devuelve la respuesta.
         Puede usar un modelo específico para esta llamada, de lo contrario, utiliza el modelo predeterminado de la instancia.
 
         Args:
-            prompt: El prompt para enviar al modelo.
+            prompt: El prompt para enviar al modelo. Acepta `bytes` UTF-8 (p. ej. de
+                    `CompiledPromptTemplate.render_bytes`); se decodifica solo aquí, en la frontera con liteLLM.
             model (Optional[str]): Un nombre de modelo específico para usar en esta invocación.
+            response_format (Optional[Dict]): Formato de salida forzado (p. ej. un JSON schema),
+                    en el formato de OpenAI que liteLLM traduce para cada proveedor.
+            system_prompt (Optional[str | bytes]): Prefijo estático (instrucciones y ejemplos) que se
+                    envía como mensaje de sistema marcado con `cache_control`, para que el proveedor
+                    lo cachee entre llamadas (liteLLM lo traduce a la caché de contexto de cada uno).
 
         Returns:
             El contenido de texto de la respuesta del LLM, o None si ocurre un error.
@@ -39,36 +94,221 @@ class LLMService:
         model_to_use = model or self.model
         self.logger.debug(f"Invocando al modelo {model_to_use} vía liteLLM...")
         try:
-            messages = [{"role": "user", "content": prompt}]
-            
-            # Obtener API key explícitamente para asegurar autenticación
-            api_key = os.getenv("GOOGLE_API_KEY")
-            
-            response = litellm.completion(
-                model=model_to_use,
-                messages=messages,
-                temperature=self.temperature,
-                api_key=api_key,
-            )
+            response = self._completion(**self._completion_kwargs(self._build_messages(prompt, system_prompt), model_to_use, response_format))
+            return self._extract_content(response)
+        except Exception as e:
+            if system_prompt and self._is_prefix_cache_error(e):
+                self._warn_prefix_cache_failure(model_to_use, e)
+                return self.invoke_llm(self._inline_system_prompt(prompt, system_prompt), model, response_format)
+            self._log_invoke_error(model_to_use, e)
             
-            if not response.choices:
-                self.logger.warning("La respuesta del LLM no contiene 'choices'. La respuesta puede estar vacía o bloqueada.")
-                return None
+        return None
 
-            choice = response.choices[0]
-            if choice.finish_reason != "stop":
+    async def ainvoke_llm(self,
+                          prompt: Union[str, bytes],
+                          model: Optional[str] = None,
+                          response_format: Optional[Dict[str, Any]] = None,
+                          system_prompt: Optional[Union[str, bytes]] = None) -> Union[str, None]:
+        """
+        Versión asíncrona de `invoke_llm` (vía `litellm.acompletion`), para mantener
+        varias llamadas en vuelo desde un mismo hilo con asyncio.
+        Mismos argumentos y mismo contrato: devuelve None si ocurre un error.
+        """
+        model_to_use = model or self.model
+        self.logger.debug(f"Invocando (async) al modelo {model_to_use} vía liteLLM...")
+        try:
+            response = await self._acompletion(**self._completion_kwargs(self._build_messages(prompt, system_prompt), model_to_use, response_format))
+            return self._extract_content(response)
+        except Exception as e:
+            if system_prompt and self._is_prefix_cache_error(e):
+                self._warn_prefix_cache_failure(model_to_use, e)
+                return await self.ainvoke_llm(self._inline_system_prompt(prompt, system_prompt), model, response_format)
+            self._log_invoke_error(model_to_use, e)
+
+        return None
+
+    def invoke_llm_batch(self,
+                         prompts: List[Union[str, bytes]],
+                         model: Optional[str] = None,
+                         response_format: Optional[Dict[str, Any]] = None,
+                         system_prompt: Optional[Union[str, bytes]] = None) -> List[Union[str, None]]:
+        """
+        Envía varios prompts independientes con `litellm.batch_completion`, que lanza una
+        llamada en tiempo real por prompt en paralelo (hilos) y espera a todas. No es una API
+        de trabajos por lotes del proveedor: el coste por token es el mismo que con
+        `invoke_llm`. Con un modelo local (p. ej. Ollama o vLLM), el servidor puede atender
+        las peticiones simultáneas como un lote.
+        `system_prompt`, si se indica, es el mismo prefijo cacheable para todos los prompts.
+
+        Returns:
+            Una lista alineada con `prompts`: el texto de cada respuesta, o None en las que fallaron.
+        """
+        model_to_use = model or self.model
+        self.logger.debug(f"Invocando al modelo {model_to_use} con un lote de {len(prompts)} prompts vía liteLLM...")
+        try:
+            messages = [self._build_messages(prompt, system_prompt) for prompt in prompts]
+            responses = litellm.batch_completion(**self._completion_kwargs(messages, model_to_use, response_format))
+        except Exception as e:
+            self.logger.error(f"Un error inesperado ocurrió al invocar el LLM en lote ({model_to_use}): {e}")
+            return [None] * len(prompts)
+
+        results: List[Union[str, None]] = []
+        for response in responses:
+            if isinstance(response, Exception):
+                self.logger.error(f"Una petición del lote falló ({model_to_use}): {response}")
+                results.append(None)
+                continue
+            try:
+                results.append(self._extract_content(response))
+            except Exception as e:
+                self.logger.error(f"Respuesta inesperada en el lote ({model_to_use}): {e}")
+                results.append(None)
+        return results
+
+    def supports_prefix_caching(self, prefix: Union[str, bytes], model: Optional[str] = None) -> bool:
+        """
+        True si merece la pena enviar `prefix` como `system_prompt` cacheable: alcanza el
+        mínimo de tokens que la caché de contexto del proveedor exige para ese modelo.
+        El resultado se memoriza por modelo y prefijo (cada plantilla se mide una vez).
+        """
+        model_to_use = model or self.model
+        key = (model_to_use, prefix)
+        if key not in self._cacheable_prefixes:
+            minimum = MIN_CACHEABLE_PREFIX_TOKENS_PRO if "pro" in model_to_use else MIN_CACHEABLE_PREFIX_TOKENS
+            tokens = self.count_tokens(prefix, model_to_use)
+            self._cacheable_prefixes[key] = tokens >= minimum
+            if tokens < minimum:
                 self.logger.warning(
-                    f"La generación del LLM no finalizó normalmente. Razón: {choice.finish_reason}. "
-                    "Esto puede indicar que el contenido fue bloqueado por seguridad o por otras razones."
+                    f"El prefijo fijo del prompt ({tokens} tokens) no alcanza el mínimo de caché de contexto "
+                    f"de {model_to_use} ({minimum}); se envía completo en el mensaje de usuario."
                 )
-                return None
+        return self._cacheable_prefixes[key]
 
-            self.logger.debug("Respuesta recibida de liteLLM exitosamente.")
-            return choice.message.content
-            
-        except APIError as e:
-            self.logger.error(f"Error de API con el proveedor de LLM: {e}")
+    @staticmethod
+    def _is_prefix_cache_error(error: Exception) -> bool:
+        """
+        True si el proveedor rechazó la petición (400) por el bloque cacheable o el mensaje de
+        sistema. Los errores transitorios (ya agotados sus reintentos) y cualquier otro fallo
+        no justifican reenviar la petición.
+        """
+        if isinstance(error, RETRYABLE_EXCEPTIONS):
+            return False
+        bad_request = getattr(litellm, 'BadRequestError', None)
+        if not ((bad_request is not None and isinstance(error, bad_request)) or getattr(error, 'status_code', None) == 400):
+            return False
+        message = str(error).lower()
+        return any(marker in message for marker in ('cache', 'system_instruction', 'system message', 'system role'))
+
+    def _warn_prefix_cache_failure(self, model_to_use: str, error: Exception) -> None:
+        self.logger.warning(
+            f"{model_to_use} rechazó el prefijo cacheable ({error}); se reintenta una vez "
+            f"con el prompt completo en el mensaje de usuario."
+        )
+
+    def _log_invoke_error(self, model_to_use: str, error: Exception) -> None:
+        if isinstance(error, APIError):
+            self.logger.error(f"Error de API con el proveedor de LLM: {error}")
+        else:
+            self.logger.error(f"Un error inesperado ocurrió al invocar el LLM ({model_to_use}): {error}")
+
+    @staticmethod
+    def _inline_system_prompt(prompt: Union[str, bytes], system_prompt: Union[str, bytes]) -> str:
+        """Vuelve a unir el prefijo fijo y el resto del prompt en un único texto."""
+        if isinstance(prompt, bytes):
+            prompt = prompt.decode('utf-8')
+        if isinstance(system_prompt, bytes):
+            system_prompt = system_prompt.decode('utf-8')
+        return system_prompt + prompt
+
+    def _pause_until(self, deadline: float) -> None:
+        """Retiene las próximas llamadas de este servicio hasta `deadline` (reloj monotónico)."""
+        self._paused_until = max(self._paused_until, deadline)
+
+    def _remaining_pause(self) -> float:
+        return self._paused_until - time.monotonic()
+
+    @_llm_retry
+    def _completion(self, **kwargs: Any) -> Any:
+        """Llamada real a `litellm.completion`, con reintentos ante errores transitorios."""
+        remaining_pause = self._remaining_pause()
+        if remaining_pause > 0:
+            time.sleep(remaining_pause)
+        return litellm.completion(**kwargs)
+
+    @_llm_retry
+    async def _acompletion(self, **kwargs: Any) -> Any:
+        """
+        Llamada real a `litellm.acompletion`, con reintentos ante errores transitorios.
+        Si otra llamada concurrente recibió un `Retry-After`, espera a que venza antes de enviar.
+        """
+        remaining_pause = self._remaining_pause()
+        if remaining_pause > 0:
+            await asyncio.sleep(remaining_pause)
+        return await litellm.acompletion(**kwargs)
+
+    def count_tokens(self, text: Union[str, bytes], model: Optional[str] = None) -> int:
+        """
+        Cuenta los tokens de un texto con el tokenizador del modelo (`litellm.token_counter`).
+        Si el conteo falla, devuelve la aproximación habitual de ~4 caracteres por token.
+        """
+        if isinstance(text, bytes):
+            text = text.decode('utf-8')
+        model_to_use = model or self.model
+        try:
+            return litellm.token_counter(model=model_to_use, text=text)
         except Exception as e:
-            self.logger.error(f"Un error inesperado ocurrió al invocar el LLM ({model_to_use}): {e}")
-            
-        return None 
\ No newline at end of file
+            self.logger.debug(f"No se pudieron contar los tokens con el tokenizador de {model_to_use}, se aproxima: {e}")
+            return len(text) // 4
+
+    @staticmethod
+    def _build_messages(prompt: Union[str, bytes],
+                        system_prompt: Optional[Union[str, bytes]] = None) -> List[Dict[str, Any]]:
+        """
+        Construye la conversación de un solo turno; los prompts en bytes se decodifican aquí.
+        Si hay `system_prompt`, va primero como bloque cacheable (`cache_control: ephemeral`).
+        """
+        if isinstance(prompt, bytes):
+            prompt = prompt.decode('utf-8')
+        messages: List[Dict[str, Any]] = []
+        if system_prompt:
+            if isinstance(system_prompt, bytes):
+                system_prompt = system_prompt.decode('utf-8')
+            messages.append({
+                "role": "system",
+                "content": [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}],
+            })
+        messages.append({"role": "user", "content": prompt})
+        return messages
+
+    def _completion_kwargs(self,
+                           messages: List[Any],
+                           model_to_use: str,
+                           response_format: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Construye los argumentos comunes de `completion`/`acompletion`/`batch_completion`."""
+        kwargs = {
+            "model": model_to_use,
+            "messages": messages,
+            "temperature": self.temperature,
+            # Obtener API key explícitamente para asegurar autenticación
+            "api_key": os.getenv("GOOGLE_API_KEY"),
+        }
+        if response_format is not None:
+            kwargs["response_format"] = response_format
+        return kwargs
+
+    def _extract_content(self, response: Any) -> Union[str, None]:
+        """Extrae el texto de una respuesta de liteLLM, o None si está vacía o se cortó."""
+        if not response.choices:
+            self.logger.warning("La respuesta del LLM no contiene 'choices'. La respuesta puede estar vacía o bloqueada.")
+            return None
+
+        choice = response.choices[0]
+        if choice.finish_reason != "stop":
+            self.logger.warning(
+                f"La generación del LLM no finalizó normalmente. Razón: {choice.finish_reason}. "
+                "Esto puede indicar que el contenido fue bloqueado por seguridad o por otras razones."
+            )
+            return None
+
+        self.logger.debug("Respuesta recibida de liteLLM exitosamente.")
+        return choice.message.content
@@ -0,0 +1,96 @@
+# services/semantic_response_cache.py
+import logging
+import os
+import threading
+from typing import List, Optional, Sequence
+
+import numpy as np
+import orjson
+
+
+class SemanticResponseCache:
+    """
+    Caché semántica de respuestas: reutiliza la respuesta de un texto anterior cuando el
+    embedding del nuevo es lo bastante parecido (similitud coseno >= `threshold`).
+
+    Los vectores se guardan normalizados en una matriz en memoria (búsqueda por producto
+    escalar) y se persisten en un JSONL de solo anexado, una entrada por línea. Cada
+    entrada lleva un `namespace` (p. ej. modelo + versión del prompt): al cargar, solo se
+    usan las del namespace actual, así que cambiar el prompt o el modelo la invalida.
+    """
+
+    def __init__(self, index_path: str, namespace: str, threshold: float = 0.95):
+        self.logger = logging.getLogger(__name__)
+        self.index_path = index_path
+        self.namespace = namespace
+        self.threshold = threshold
+        self._responses: List[str] = []
+        self._matrix: Optional[np.ndarray] = None
+        self._size = 0
+        # Protege la matriz y el archivo cuando se consulta desde varios hilos
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self) -> None:
+        """Carga las entradas del namespace actual; las líneas ilegibles se descartan."""
+        try:
+            index_file = open(self.index_path, 'rb')
+        except FileNotFoundError:
+            return
+        with index_file:
+            for line in index_file:
+                try:
+                    entry = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    continue
+                if entry.get('namespace') == self.namespace:
+                    self._add_to_matrix(entry['vector'], entry['response'])
+        self.logger.info(f"Caché semántica cargada con {self._size} entradas ({self.index_path}).")
+
+    @staticmethod
+    def _normalize(vector: Sequence[float]) -> Optional[np.ndarray]:
+        array = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(array)
+        return array / norm if norm > 0 else None
+
+    def _add_to_matrix(self, vector: Sequence[float], response: str) -> None:
+        normalized = self._normalize(vector)
+        if normalized is None:
+            return
+        if self._matrix is None:
+            self._matrix = np.empty((16, normalized.shape[0]), dtype=np.float32)
+        elif normalized.shape[0] != self._matrix.shape[1]:
+            return  # Vector de otro modelo de embeddings: no es comparable
+        elif self._size == self._matrix.shape[0]:
+            # Crecimiento geométrico: copias amortizadas O(1) por entrada
+            grown = np.empty((self._matrix.shape[0] * 2, self._matrix.shape[1]), dtype=np.float32)
+            grown[:self._size] = self._matrix[:self._size]
+            self._matrix = grown
+        self._matrix[self._size] = normalized
+        self._responses.append(response)
+        self._size += 1
+
+    def get(self, vector: Sequence[float]) -> Optional[str]:
+        """Devuelve la respuesta del texto más parecido si supera el umbral, o None."""
+        normalized = self._normalize(vector)
+        with self._lock:
+            if self._size == 0 or normalized is None or normalized.shape[0] != self._matrix.shape[1]:
+                return None
+            similarities = self._matrix[:self._size] @ normalized
+            best_idx = int(np.argmax(similarities))
+            if similarities[best_idx] < self.threshold:
+                return None
+            self.logger.debug(f"Acierto de caché semántica (similitud {similarities[best_idx]:.3f}).")
+            return self._responses[best_idx]
+
+    def put(self, vector: Sequence[float], response: str) -> None:
+        """Añade una entrada en memoria y en el JSONL. Los errores de escritura solo se registran."""
+        entry = {'namespace': self.namespace, 'vector': [float(x) for x in vector], 'response': response}
+        try:
+            with self._lock:
+                self._add_to_matrix(vector, response)
+                os.makedirs(os.path.dirname(self.index_path) or '.', exist_ok=True)
+                with open(self.index_path, 'ab') as index_file:
+                    index_file.write(orjson.dumps(entry) + b'\n')
+        except OSError as e:
+            self.logger.warning(f"No se pudo guardar la entrada en la caché semántica: {e}")
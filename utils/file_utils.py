@@ -1,75 +1,149 @@
 # utils/file_utils.py
-import json
+import functools
 import logging
-import re
-from typing import List, Dict, Any, Iterator, Optional, Union
+import os
+import orjson
+from typing import List, Dict, Any, BinaryIO, Iterable, Iterator, Optional, Union
 
 logger = logging.getLogger(__name__)
 
-def extract_json_from_text(text: str) -> Optional[Union[Dict[str, Any], List[Dict[str, Any]]]]:
+_FENCE = '```'
+
+_JSON_CLOSERS = {'{': '}', '[': ']'}
+
+def _fenced_block(text: str) -> Optional[str]:
     """
-    Busca y extrae el primer bloque JSON válido de un string de texto usando una expresión regular.
-    Es más robusto que buscar simplemente llaves, ya que maneja JSON anidado y texto circundante.
+    Contenido del primer bloque de código markdown (```json ... ``` o ``` ... ```), sin los
+    espacios de alrededor. Equivale a la regex `` ```(?:json)?\\s*(.*?)\\s*``` `` pero con dos
+    búsquedas lineales: sin retroceso aunque la respuesta sea larga o no cierre el bloque.
     """
-    # Expresión regular para encontrar un bloque de código JSON (objeto o array)
-    # que puede estar encerrado en ```json ... ```
-    json_pattern = re.compile(r'```json\s*(\{.*\}|\[.*\])\s*```|(\{.*\}|\[.*\])', re.DOTALL)
-    
-    match = json_pattern.search(text)
-    
-    if not match:
-        logger.warning("No se encontró ningún bloque de código JSON en el texto.")
+    start = text.find(_FENCE)
+    if start == -1:
+        return None
+    start += len(_FENCE)
+    end = text.find(_FENCE, start)
+    if end == -1:
         return None
+    if text[start:start + 4].lower() == 'json':
+        start += 4
+    return text[start:end].strip()
+
+def _slice_outer_json(text: str) -> Optional[str]:
+    """
+    Devuelve el tramo desde la primera llave/corchete de apertura hasta el último cierre
+    correspondiente (equivalente a buscar `\{.*\}` o `\[.*\]` con una regex voraz,
+    pero con dos búsquedas lineales en lugar de retroceso).
+    """
+    openings = sorted(i for i in (text.find('{'), text.find('[')) if i != -1)
+    for start in openings:
+        end = text.rfind(_JSON_CLOSERS[text[start]])
+        if end > start:
+            return text[start:end + 1]
+    return None
 
-    # El patrón tiene grupos de captura. El primer grupo que no sea None contiene el JSON.
-    json_str = next((group for group in match.groups() if group is not None), None)
+def extract_json_from_text(text: str) -> Optional[Union[Dict[str, Any], List[Dict[str, Any]]]]:
+    """
+    Busca y extrae el primer bloque JSON válido de un string de texto.
+    Maneja JSON anidado, bloques de código markdown y texto circundante.
+
+    Camino rápido: si la respuesta ya es JSON puro (lo habitual en modo JSON), se parsea
+    directamente con orjson. Si no, se prueba el contenido del primer bloque de código
+    y, por último, el tramo entre la primera apertura y el último cierre.
+    """
+    stripped = text.strip()
+    if stripped[:1] in ('{', '['):
+        try:
+            return orjson.loads(stripped)
+        except orjson.JSONDecodeError:
+            pass
+
+    json_str = _fenced_block(text)
+    if not json_str or json_str[:1] not in _JSON_CLOSERS:
+        json_str = _slice_outer_json(text)
 
     if not json_str:
-         logger.warning("La expresión regular encontró un patrón pero no pudo extraer el contenido JSON.")
-         return None
+        logger.warning("No se encontró ningún bloque de código JSON en el texto.")
+        return None
 
     try:
-        # Limpiar por si acaso el string tiene espacios extra al principio/final
-        return json.loads(json_str.strip())
-    except json.JSONDecodeError as e:
+        return orjson.loads(json_str)
+    except orjson.JSONDecodeError as e:
         logger.error(f"Se encontró un bloque JSON-like pero no se pudo parsear: {e}")
         logger.debug(f"Bloque JSON problemático: {json_str}")
         return None
 
 def load_json_file(file_path: str) -> Any:
-    """Carga un archivo JSON completo en memoria."""
+    """
+    Carga un archivo JSON completo en memoria.
+    Lee los bytes tal cual y los parsea con orjson (sin decodificar antes a `str`).
+    `orjson.JSONDecodeError` hereda de `json.JSONDecodeError`, así que los llamadores
+    que capturan este último siguen funcionando igual.
+    """
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        with open(file_path, 'rb') as f:
+            return orjson.loads(f.read())
     except FileNotFoundError:
         logger.error(f"El archivo no fue encontrado: {file_path}")
         raise
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         logger.error(f"Error al decodificar JSON del archivo: {file_path}")
         raise
     except Exception as e:
         logger.error(f"Ocurrió un error inesperado al leer {file_path}: {e}")
         raise
 
+def _sync_to_disk(file_handle: BinaryIO):
+    """
+    Vuelca el buffer y fuerza la escritura a disco antes del `os.replace`: sin esto, tras un
+    corte de energía el renombrado podría persistir antes que el contenido del archivo.
+    """
+    file_handle.flush()
+    os.fsync(file_handle.fileno())
+
+def _indent_4(json_bytes: bytes) -> bytes:
+    """
+    Pasa a indentación de 4 un JSON que orjson escribió con indentación de 2 (orjson no admite
+    otra): basta duplicar los espacios iniciales de cada línea, porque dentro de las cadenas
+    los saltos de línea siempre van escapados.
+    """
+    return b'\n'.join(b' ' * (len(line) - len(line.lstrip(b' '))) + line for line in json_bytes.split(b'\n'))
+
 def save_json_file(file_path: str, data: Any):
-    """Guarda los datos en un archivo JSON."""
+    """
+    Guarda los datos en un archivo JSON (serializado con orjson, en UTF-8 y con indentación de 4,
+    el formato de siempre de los archivos versionados en `data/`).
+    Se escribe en un archivo temporal, se sincroniza a disco y se renombra al final
+    (`os.replace` es atómico), así que un fallo a mitad nunca deja el archivo de destino truncado.
+
+    Si `data` ya es `bytes` (JSON serializado de antemano, p. ej. con `model_dump_json`),
+    se escribe tal cual, sin volver a pasar por orjson.
+    """
+    tmp_path = file_path + '.tmp'
     try:
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
+        with open(tmp_path, 'wb') as f:
+            f.write(data if isinstance(data, bytes) else _indent_4(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)))
+            _sync_to_disk(f)
+        os.replace(tmp_path, file_path)
     except Exception as e:
         logger.error(f"Ocurrió un error inesperado al guardar en {file_path}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
         raise
 
+JSONL_READ_BUFFER_SIZE = 1 << 20
+JSONL_WRITE_BUFFER_SIZE = 1 << 20
+
 def load_jsonl_file(file_path: str) -> Iterator[Dict[str, Any]]:
     """
     Carga un archivo JSONL (JSON Lines) de forma perezosa, línea por línea.
-    Esto es eficiente en memoria para archivos grandes.
+    Esto es eficiente en memoria para archivos grandes: solo se mantiene un registro
+    a la vez, leyendo en bloques de 1 MiB y parseando cada línea con orjson.
     """
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
+        with open(file_path, 'rb', buffering=JSONL_READ_BUFFER_SIZE) as f:
             for line in f:
                 if line.strip():
-                    yield json.loads(line)
+                    yield orjson.loads(line)
     except FileNotFoundError:
         logger.error(f"El archivo no fue encontrado: {file_path}")
         # Devolvemos un iterador vacío si el archivo no existe,
@@ -79,27 +153,112 @@ def load_jsonl_file(file_path: str) -> Iterator[Dict[str, Any]]:
         logger.error(f"Ocurrió un error inesperado al leer {file_path}: {e}")
         raise
 
+def count_jsonl_records(file_path: str) -> int:
+    """
+    Cuenta los registros (líneas no vacías) de un archivo JSONL sin parsearlos: sirve para
+    mostrar el progreso de un recorrido perezoso con `load_jsonl_file`.
+    """
+    with open(file_path, 'rb', buffering=JSONL_READ_BUFFER_SIZE) as f:
+        return sum(1 for line in f if line.strip())
+
 def append_to_jsonl_file(file_path: str, data: Dict[str, Any]):
     """
     Añade un único registro (diccionario) a un archivo JSONL.
-    Perfecto para guardado incremental.
+    Perfecto para guardado incremental. Se serializa con orjson (UTF-8, sin escapar).
     """
     try:
-        with open(file_path, 'a', encoding='utf-8') as f:
-            f.write(json.dumps(data, ensure_ascii=False) + '\n')
+        with open(file_path, 'ab') as f:
+            f.write(orjson.dumps(data) + b'\n')
     except Exception as e:
         logger.error(f"Ocurrió un error inesperado al añadir a {file_path}: {e}")
         raise
 
+def write_jsonl_record(file_handle: BinaryIO, data: Union[Dict[str, Any], bytes]):
+    """
+    Escribe un registro en un archivo JSONL ya abierto en modo binario.
+    Pensado para escrituras incrementales sobre un único handle con buffer,
+    evitando abrir y cerrar el archivo por cada registro.
+    Un registro que ya es `bytes` (JSON serializado de antemano) se escribe tal cual.
+    """
+    file_handle.write((data if isinstance(data, bytes) else orjson.dumps(data)) + b'\n')
+
+def save_json_array_stream(file_path: str, records: Iterable[Any]) -> int:
+    """
+    Escribe un array JSON elemento a elemento sobre un único handle binario con buffer,
+    sin construir nunca el documento completo en memoria (un elemento por línea).
+    Se escribe en un archivo temporal y se renombra al final, así que un fallo a mitad
+    no deja el archivo de destino truncado.
+
+    Los elementos que ya son `bytes` (JSON serializado de antemano, p. ej. con el
+    `dump_json` de Pydantic) se escriben tal cual, sin volver a pasar por orjson.
+
+    Returns:
+        El número de elementos escritos.
+    """
+    tmp_path = file_path + '.tmp'
+    count = 0
+    try:
+        with open(tmp_path, 'wb', buffering=JSONL_WRITE_BUFFER_SIZE) as f:
+            f.write(b'[')
+            for record in records:
+                f.write(b',\n' if count else b'\n')
+                f.write(record if isinstance(record, bytes) else orjson.dumps(record))
+                count += 1
+            f.write(b'\n]\n' if count else b']\n')
+            _sync_to_disk(f)
+        os.replace(tmp_path, file_path)
+    except Exception as e:
+        logger.error(f"Ocurrió un error inesperado al guardar en {file_path}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return count
+
+def save_json_object_stream(file_path: str,
+                            array_key: str,
+                            records: Iterable[Any],
+                            extra_fields: Optional[Dict[str, Any]] = None) -> int:
+    """
+    Escribe un objeto JSON `{array_key: [...], **extra_fields}` emitiendo el array elemento
+    a elemento (uno por línea) sobre un handle binario con buffer de 1 MiB, sin construir el
+    documento completo en memoria. Igual que `save_json_array_stream`: escritura atómica
+    mediante archivo temporal, y los elementos `bytes` se escriben tal cual.
+
+    Returns:
+        El número de elementos escritos.
+    """
+    tmp_path = file_path + '.tmp'
+    count = 0
+    try:
+        with open(tmp_path, 'wb', buffering=JSONL_WRITE_BUFFER_SIZE) as f:
+            f.write(b'{' + orjson.dumps(array_key) + b':[')
+            for record in records:
+                f.write(b',\n' if count else b'\n')
+                f.write(record if isinstance(record, bytes) else orjson.dumps(record))
+                count += 1
+            f.write(b'\n]' if count else b']')
+            for key, value in (extra_fields or {}).items():
+                f.write(b',\n' + orjson.dumps(key) + b':' + orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS))
+            f.write(b'}\n')
+            _sync_to_disk(f)
+        os.replace(tmp_path, file_path)
+    except Exception as e:
+        logger.error(f"Ocurrió un error inesperado al guardar en {file_path}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return count
+
 def save_insights_metadata(registry: Any, file_path: str):
     """
     Guarda el registro de metadatos de insights en un archivo JSON.
     El objeto 'registry' debe ser un modelo de Pydantic o tener un método 'dict()'.
     """
     try:
-        if hasattr(registry, 'model_dump'):
-            # Pydantic v2
-            data_to_save = registry.model_dump()
+        if hasattr(registry, 'model_dump_json'):
+            # Pydantic v2: modelo -> JSON directamente en pydantic-core, sin dict intermedio
+            # (indentación de 4, como el resto de JSON que escribe `save_json_file`)
+            data_to_save = registry.model_dump_json(indent=4).encode('utf-8')
         elif hasattr(registry, 'dict'):
             # Pydantic v1
             data_to_save = registry.dict()
@@ -129,16 +288,50 @@ def write_text_file(file_path: str, content: str):
         logger.error(f"Error escribiendo el archivo de texto {file_path}: {e}")
         raise
 
+@functools.lru_cache(maxsize=32)
+def _read_text_cached(file_path: str, mtime_ns: int) -> str:
+    """Lee un archivo de texto; memorizado por (ruta, mtime), así que una edición en disco invalida la entrada."""
+    with open(file_path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+@functools.lru_cache(maxsize=32)
+def _read_json_cached(file_path: str, mtime_ns: int) -> Any:
+    """Lee y parsea un archivo JSON; memorizado por (ruta, mtime), igual que `_read_text_cached`."""
+    with open(file_path, 'rb') as f:
+        return orjson.loads(f.read())
+
+def load_json_file_cached(file_path: str) -> Any:
+    """
+    Como `load_json_file`, pero memoriza el resultado a nivel de proceso mientras el
+    archivo no cambie (la clave incluye su mtime), así que las lecturas repetidas son gratis.
+
+    El objeto devuelto es compartido entre llamadas: debe tratarse como de solo lectura
+    (hacer una copia antes de modificarlo). Pensado para configuración y datos estáticos.
+    """
+    try:
+        return _read_json_cached(file_path, os.stat(file_path).st_mtime_ns)
+    except FileNotFoundError:
+        logger.error(f"El archivo no fue encontrado: {file_path}")
+        raise
+    except orjson.JSONDecodeError:
+        logger.error(f"Error al decodificar JSON del archivo: {file_path}")
+        raise
+    except Exception as e:
+        logger.error(f"Ocurrió un error inesperado al leer {file_path}: {e}")
+        raise
+
 def load_prompt_template(file_path: str) -> str:
     """
     Carga una plantilla de prompt desde un archivo de texto.
+    El resultado se memoriza a nivel de proceso por (ruta, mtime), de modo que distintas
+    instancias de agentes (o re-ejecuciones) no vuelven a leer el mismo archivo, pero
+    una plantilla editada en disco se recarga.
     """
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            return f.read()
+        return _read_text_cached(file_path, os.stat(file_path).st_mtime_ns)
     except FileNotFoundError:
         logger.error(f"Archivo de plantilla de prompt no encontrado: {file_path}")
         raise
     except Exception as e:
         logger.error(f"Error inesperado al cargar la plantilla de prompt {file_path}: {e}")
-        raise 
\ No newline at end of file
+        raise
@@ -0,0 +1,95 @@
+# utils/prompt_template.py
+import functools
+import string
+from typing import Any, List, Optional, Tuple, Union
+
+
+class CompiledPromptTemplate:
+    """
+    Plantilla de prompt pre-analizada una sola vez.
+
+    `str.format` vuelve a escanear la plantilla completa en cada llamada buscando
+    `{campo}`. Aquí la plantilla se divide una vez en segmentos literales y nombres
+    de campo, y el render es un simple `''.join` de segmentos y valores.
+    Respeta las mismas reglas de escape que `str.format` (`{{` y `}}`).
+    """
+
+    def __init__(self, template: str, segments: Optional[List[Tuple[str, Optional[str]]]] = None):
+        self.template = template
+        if segments is None:
+            segments = []
+            for literal, field_name, format_spec, conversion in string.Formatter().parse(template):
+                if field_name is not None and (format_spec or conversion):
+                    raise ValueError(f"Campo con formato no soportado en la plantilla: '{field_name}'")
+                segments.append((literal, field_name))
+        self._segments: List[Tuple[str, Optional[str]]] = segments
+        self.fields: Tuple[str, ...] = tuple(
+            dict.fromkeys(field for _, field in self._segments if field is not None)
+        )
+        # Los literales se codifican a UTF-8 una única vez para `render_bytes`
+        self._byte_segments: List[Tuple[bytes, Optional[str]]] = [
+            (literal.encode('utf-8'), field_name) for literal, field_name in self._segments
+        ]
+        # Texto fijo anterior al primer campo: idéntico byte a byte en todos los renders,
+        # así que puede enviarse como prefijo cacheable. Vacío si la plantilla no tiene campos.
+        # (`string.Formatter` corta los literales en cada `{{`/`}}`, así que se unen todos hasta el primer campo.)
+        prefix_parts: List[bytes] = []
+        for literal, field_name in self._byte_segments:
+            prefix_parts.append(literal)
+            if field_name is not None:
+                break
+        self.static_prefix: bytes = b''.join(prefix_parts) if self.fields else b''
+
+    def render(self, **values: Any) -> str:
+        """Rellena la plantilla. Lanza KeyError si falta un campo, igual que `str.format`."""
+        parts = []
+        for literal, field_name in self._segments:
+            parts.append(literal)
+            if field_name is not None:
+                parts.append(str(values[field_name]))
+        return ''.join(parts)
+
+    def partial(self, **values: Union[bytes, str, Any]) -> 'CompiledPromptTemplate':
+        """
+        Devuelve una nueva plantilla con algunos campos ya rellenados.
+
+        Los valores fijos se funden con los literales vecinos, así que un render posterior
+        solo concatena los campos restantes (p. ej. un prefijo estático grande más los
+        pocos campos que cambian en cada llamada).
+        """
+        segments: List[Tuple[str, Optional[str]]] = []
+        pending_literal: List[str] = []
+        for literal, field_name in self._segments:
+            pending_literal.append(literal)
+            if field_name is None:
+                continue
+            if field_name in values:
+                value = values[field_name]
+                pending_literal.append(value.decode('utf-8') if isinstance(value, bytes) else str(value))
+            else:
+                segments.append((''.join(pending_literal), field_name))
+                pending_literal = []
+        if pending_literal:
+            segments.append((''.join(pending_literal), None))
+        return CompiledPromptTemplate(self.template, segments)
+
+    def render_bytes(self, **values: Union[bytes, str, Any]) -> bytes:
+        """
+        Igual que `render`, pero produce el prompt directamente en UTF-8.
+
+        Los valores `bytes` (p. ej. la salida de `orjson.dumps`) se copian tal cual,
+        sin decodificarlos a `str` para volver a codificarlos después.
+        """
+        parts = []
+        for literal, field_name in self._byte_segments:
+            parts.append(literal)
+            if field_name is not None:
+                value = values[field_name]
+                parts.append(value if isinstance(value, bytes) else str(value).encode('utf-8'))
+        return b''.join(parts)
+
+
+@functools.lru_cache(maxsize=32)
+def compile_prompt_template(template: str) -> CompiledPromptTemplate:
+    """Compila (y memoriza) una plantilla de prompt con marcadores al estilo `str.format`."""
+    return CompiledPromptTemplate(template)
@@ -0,0 +1,58 @@
+# utils/retry_utils.py
+import time
+from email.utils import parsedate_to_datetime
+from typing import Callable, Optional
+
+from tenacity import RetryCallState, wait_random_exponential
+
+# Espera máxima entre reintentos, también para los `Retry-After` que indique el proveedor
+MAX_RETRY_WAIT_SECONDS = 60
+
+# Backoff exponencial con jitter (1s..60s): el jitter evita que varias llamadas
+# concurrentes limitadas a la vez reintenten todas al mismo tiempo.
+exponential_wait = wait_random_exponential(multiplier=1, min=1, max=MAX_RETRY_WAIT_SECONDS)
+
+def retry_after_seconds(exception: Optional[BaseException]) -> Optional[float]:
+    """
+    Segundos de espera que pide el proveedor en la cabecera `Retry-After` (en segundos o
+    como fecha HTTP), `x-ratelimit-reset-after` o `x-ratelimit-reset`, si la respuesta
+    los trae; None en otro caso.
+    """
+    if exception is None:
+        return None
+    headers = getattr(exception, 'litellm_response_headers', None)
+    if headers is None:
+        headers = getattr(getattr(exception, 'response', None), 'headers', None)
+    if not headers:
+        return None
+    for header in ('retry-after', 'x-ratelimit-reset-after', 'x-ratelimit-reset'):
+        value = headers.get(header) or headers.get(header.title())
+        if value is None:
+            continue
+        try:
+            return max(0.0, float(value))
+        except (TypeError, ValueError):
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            continue
+    return None
+
+def wait_retry_after(fallback: Callable[[RetryCallState], float] = exponential_wait,
+                     on_retry_after: Optional[Callable[[RetryCallState, float], None]] = None) -> Callable[[RetryCallState], float]:
+    """
+    Estrategia de espera para `tenacity`: respeta el `Retry-After` del servidor (con tope
+    `MAX_RETRY_WAIT_SECONDS`) y, si no lo hay, usa `fallback` (por defecto, backoff
+    exponencial con jitter). Si se indica `on_retry_after`, se le llama con la espera
+    pedida por el servidor (p. ej. para pausar también otras llamadas del mismo cliente).
+    """
+    def _wait(retry_state: RetryCallState) -> float:
+        retry_after = retry_after_seconds(retry_state.outcome.exception())
+        if retry_after is None:
+            return fallback(retry_state)
+        delay = min(retry_after, MAX_RETRY_WAIT_SECONDS)
+        if on_retry_after is not None:
+            on_retry_after(retry_state, delay)
+        return delay
+    return _wait